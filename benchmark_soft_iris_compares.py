@@ -0,0 +1,274 @@
+"""
+Benchmarks for the 'soft_iris_compares' comparison functions.
+
+Builds synthetic cubes shaped like those from real PP/FF loads : many scalar
+coords, 2D latitude+longitude aux coords, bounded time coords, and so on.
+Then times 'compare_coords', 'compare_cubes' and 'compare_cubelists' as the
+number of cubes, size of coords and number of dimensions grow, comparing
+against shuffled, transposed and inverted variants.
+
+Run as a script to save the results to a file, and optionally to check them
+against an earlier results file for slowdowns.
+
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import argparse
+import json
+import random
+import time
+import timeit
+
+import numpy as np
+
+import iris
+from iris.coords import AuxCoord, DimCoord
+from iris.cube import Cube, CubeList
+
+from soft_iris_compares import compare_coords, compare_cubes, compare_cubelists
+
+try:
+    import dask.array as da
+except ImportError:
+    da = None
+
+
+def _dummy_data(shape):
+    # Return lazy data for a cube if possible, as the comparisons should
+    # never need the values : this keeps big cubes cheap to make and copy.
+    if da is not None:
+        return da.zeros(shape, dtype=np.float32, chunks=shape)
+    return np.zeros(shape, dtype=np.float32)
+
+
+def synthetic_cube(name='air_temperature', n_times=4, n_levels=10,
+                   grid_shape=(100, 120), n_scalar_coords=8,
+                   stash_item=0):
+    """
+    Make a cube like one from a PP load.
+
+    It has dimensions (time, model_level_number, grid_latitude,
+    grid_longitude), omitting any of length 0.  The time coord is bounded,
+    with a forecast_reference_time aux coord, the levels have a
+    level_height aux coord, and the grid has 2D latitude and longitude aux
+    coords.  There are also 'n_scalar_coords' scalar coords.
+
+    """
+    n_lats, n_lons = grid_shape
+    shape = [n for n in (n_times, n_levels, n_lats, n_lons) if n]
+    cube = Cube(_dummy_data(shape), long_name=name, units='K')
+    cube.attributes['STASH'] = 'm01s{:02d}i{:03d}'.format(stash_item // 1000,
+                                                         stash_item % 1000)
+    cube.attributes['source'] = 'Data from Met Office Unified Model'
+
+    i_dim = 0
+    if n_times:
+        time_coord = DimCoord(np.arange(n_times) * 6.0 + 3.0,
+                              standard_name='time',
+                              units='hours since 1970-01-01 00:00:00')
+        time_coord.guess_bounds()
+        cube.add_dim_coord(time_coord, i_dim)
+        frt = AuxCoord(np.zeros(n_times),
+                       standard_name='forecast_reference_time',
+                       units=time_coord.units)
+        cube.add_aux_coord(frt, i_dim)
+        i_dim += 1
+    if n_levels:
+        cube.add_dim_coord(DimCoord(np.arange(1, n_levels + 1),
+                                    standard_name='model_level_number'),
+                           i_dim)
+        cube.add_aux_coord(AuxCoord(np.arange(n_levels) * 100.0 + 5.0,
+                                    long_name='level_height', units='m'),
+                           i_dim)
+        i_dim += 1
+    if n_lats and n_lons:
+        y_points = np.linspace(-30.0, 30.0, n_lats)
+        x_points = np.linspace(330.0, 390.0, n_lons)
+        y_coord = DimCoord(y_points, standard_name='grid_latitude',
+                           units='degrees')
+        x_coord = DimCoord(x_points, standard_name='grid_longitude',
+                           units='degrees')
+        y_coord.guess_bounds()
+        x_coord.guess_bounds()
+        cube.add_dim_coord(y_coord, i_dim)
+        cube.add_dim_coord(x_coord, i_dim + 1)
+        # Realistic-ish 2D true latitudes + longitudes of a rotated grid.
+        lons, lats = np.meshgrid(x_points, y_points)
+        cube.add_aux_coord(AuxCoord(lats + 0.1 * np.sin(np.radians(lons)),
+                                    standard_name='latitude',
+                                    units='degrees'),
+                           (i_dim, i_dim + 1))
+        cube.add_aux_coord(AuxCoord(lons + 0.1 * np.cos(np.radians(lats)),
+                                    standard_name='longitude',
+                                    units='degrees'),
+                           (i_dim, i_dim + 1))
+
+    for i_coord in range(n_scalar_coords):
+        cube.add_aux_coord(AuxCoord([float(i_coord)],
+                                    long_name='scalar_{}'.format(i_coord),
+                                    units='1'))
+    return cube
+
+
+def synthetic_cubelist(n_cubes, **cube_kwargs):
+    # Make a list of distinct synthetic cubes, like the load of a PP file
+    # with many different STASH codes.
+    names = ['air_temperature', 'specific_humidity', 'x_wind', 'y_wind']
+    return CubeList(synthetic_cube(name=names[i_cube % len(names)],
+                                   stash_item=i_cube, **cube_kwargs)
+                    for i_cube in range(n_cubes))
+
+
+def cube_variant(cube, transpose=True, invert=True, rng=None):
+    # Return a copy of a cube with its dimensions randomly re-ordered and/or
+    # inverted, which should still compare as a 'soft' match.
+    rng = rng or random.Random(0)
+    if invert:
+        cube = cube[tuple(slice(None, None, rng.choice((1, -1)))
+                          for _ in range(cube.ndim))]
+    else:
+        cube = cube.copy()
+    if transpose:
+        order = list(range(cube.ndim))
+        rng.shuffle(order)
+        cube.transpose(order)
+    return cube
+
+
+def cubelist_variant(cubelist, shuffle=True, transpose=True, invert=True,
+                     seed=0):
+    # Return a shuffled list of variants of the cubes of a cubelist.
+    rng = random.Random(seed)
+    cubes = [cube_variant(cube, transpose=transpose, invert=invert, rng=rng)
+             for cube in cubelist]
+    if shuffle:
+        rng.shuffle(cubes)
+    return CubeList(cubes)
+
+
+def time_call(func, *args, **kwargs):
+    # Return the best time of several calls of a function.
+    # Keyword 'repeats' sets the number of calls (default 3).
+    repeats = kwargs.pop('repeats', 3)
+    best = None
+    for _ in range(repeats):
+        start = timeit.default_timer()
+        func(*args, **kwargs)
+        elapsed = timeit.default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_compare_coords(size, ndim):
+    # Time compare_coords on an N-d coord and a transposed+inverted copy.
+    shape = (size,) * ndim
+    points = np.arange(size ** ndim, dtype=np.float64).reshape(shape)
+    coord = AuxCoord(points, long_name='x')
+    other = coord.copy(points.transpose()[::-1].copy())
+    return time_call(compare_coords, coord, other)
+
+
+def bench_compare_cubes(grid_size, n_scalar_coords):
+    # Time compare_cubes on a cube and a transposed+inverted variant.
+    cube = synthetic_cube(grid_shape=(grid_size, grid_size),
+                          n_scalar_coords=n_scalar_coords)
+    other = cube_variant(cube)
+    return time_call(compare_cubes, cube, other)
+
+
+def bench_compare_cubelists(n_cubes, grid_size):
+    # Time compare_cubelists on a cubelist and a shuffled variant.
+    cubes = synthetic_cubelist(n_cubes, grid_shape=(grid_size, grid_size),
+                               n_levels=3, n_times=2)
+    others = cubelist_variant(cubes)
+    return time_call(compare_cubelists, cubes, others, repeats=1)
+
+
+# The benchmarks, and the parameter settings to run them with.
+BENCHMARKS = [
+    (bench_compare_coords, [{'size': size, 'ndim': ndim}
+                            for ndim in (1, 2, 3)
+                            for size in (10, 100, 200)
+                            if size ** ndim <= 1.0e7]),
+    (bench_compare_cubes, [{'grid_size': grid_size,
+                            'n_scalar_coords': n_scalar_coords}
+                           for grid_size in (50, 200, 500)
+                           for n_scalar_coords in (0, 20)]),
+    (bench_compare_cubelists, [{'n_cubes': n_cubes, 'grid_size': 50}
+                               for n_cubes in (10, 50, 200)]),
+]
+
+QUICK_BENCHMARKS = [
+    (bench_compare_coords, [{'size': 100, 'ndim': 2}]),
+    (bench_compare_cubes, [{'grid_size': 50, 'n_scalar_coords': 10}]),
+    (bench_compare_cubelists, [{'n_cubes': 20, 'grid_size': 20}]),
+]
+
+
+def run_benchmarks(benchmarks=BENCHMARKS):
+    # Run the benchmarks, printing each result as it is done.
+    # Returns a list of result dicts, with keys 'name', 'params', 'seconds'.
+    results = []
+    for func, params_list in benchmarks:
+        for params in params_list:
+            seconds = func(**params)
+            result = {'name': func.__name__, 'params': params,
+                      'seconds': seconds}
+            print('{:26s} {:50s} {:10.4f}s'.format(
+                func.__name__, json.dumps(params, sort_keys=True), seconds))
+            results.append(result)
+    return results
+
+
+def save_results(path, results):
+    # Save benchmark results, with the versions they were run with.
+    content = {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'iris_version': iris.__version__,
+               'numpy_version': np.__version__,
+               'results': results}
+    with open(path, 'w') as fo:
+        json.dump(content, fo, indent=1, sort_keys=True)
+
+
+def _result_key(result):
+    return result['name'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare_results(old_path, results, threshold=1.25):
+    # Print any results which are slower than an earlier results file by
+    # more than the 'threshold' factor.
+    # Returns the number of such slowdowns.
+    with open(old_path) as fi:
+        old_results = json.load(fi)['results']
+    old_times = {_result_key(result): result['seconds']
+                 for result in old_results}
+    n_slower = 0
+    for result in results:
+        old_time = old_times.get(_result_key(result))
+        if old_time and result['seconds'] > old_time * threshold:
+            n_slower += 1
+            msg = 'SLOWER: {} {} : {:.4f}s --> {:.4f}s'
+            print(msg.format(result['name'], result['params'], old_time,
+                             result['seconds']))
+    print('{} slowdowns, of {} benchmarks.'.format(n_slower, len(results)))
+    return n_slower
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the soft cube comparison functions.')
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help='file to save the results in')
+    parser.add_argument('--compare', default=None,
+                        help='earlier results file, to check for slowdowns')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='time ratio counted as a slowdown '
+                             '(default 1.25)')
+    parser.add_argument('--quick', action='store_true',
+                        help='only run a small set of benchmarks')
+    args = parser.parse_args()
+    results = run_benchmarks(QUICK_BENCHMARKS if args.quick else BENCHMARKS)
+    save_results(args.output, results)
+    if args.compare:
+        compare_results(args.compare, results, threshold=args.threshold)
@@ -0,0 +1,104 @@
+"""
+A persistent cache of per-file scan results.
+
+Results are keyed on the file path, size and modification time, and are only
+valid for the iris version and comparison code that produced them.
+The cache is an append-only file of JSON records, one per line, written as
+each file completes, so that an interrupted scan can resume where it stopped.
+
+"""
+import hashlib
+import json
+import os
+import os.path
+
+import iris
+
+import soft_iris_compares
+
+
+def comparer_hash():
+    # Return a hash of the comparison code, i.e. the 'soft_iris_compares'
+    # source file (not the compiled one).
+    path = os.path.splitext(soft_iris_compares.__file__)[0] + '.py'
+    with open(path, 'rb') as fi:
+        return hashlib.sha1(fi.read()).hexdigest()
+
+
+def scan_context():
+    # Return the settings which a cached result is only valid for.
+    return {'iris_version': iris.__version__,
+            'comparer_hash': comparer_hash()}
+
+
+def file_key(path):
+    # Return the (size, mtime) of a file, which must match a cached result.
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+class ScanCache(object):
+    def __init__(self, path, context=None):
+        """
+        A record of scan results, stored in the file 'path'.
+
+        Only results recorded with the same 'context' are used : by default,
+        this is the current iris version and comparison code.
+
+        """
+        self.path = path
+        self.context = context if context is not None else scan_context()
+        self._records = {}
+        if os.path.exists(path):
+            with open(path) as fi:
+                for line in fi:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Skip any partial line from an interrupted write.
+                        continue
+                    # Later records replace earlier ones for the same file.
+                    self._records[record['path']] = record
+
+    def __len__(self):
+        return len(self._records)
+
+    def records(self):
+        # Return all the stored records, whether currently valid or not.
+        return list(self._records.values())
+
+    def _valid(self, record, path):
+        if record.get('context') != self.context:
+            return False
+        size, mtime = file_key(path)
+        return record['size'] == size and record['mtime'] == mtime
+
+    def lookup(self, path):
+        """
+        Return the stored result record for a file, or None if there is none
+        or the file (or the context) has changed since it was recorded.
+
+        """
+        record = self._records.get(path)
+        if record is not None and not self._valid(record, path):
+            record = None
+        return record
+
+    def store(self, record):
+        """
+        Record the result record for a file (a dict with at least 'path' and
+        'message' keys), and append it to the cache file immediately.
+
+        Returns the record as stored, i.e. with its validity information.
+        The context is stored as its 'context' entry, apart from the result
+        entries, as the context settings can share their names.
+
+        """
+        size, mtime = file_key(record['path'])
+        record = dict(record, size=size, mtime=mtime,
+                      context=dict(self.context))
+        self._records[record['path']] = record
+        with open(self.path, 'a') as fo:
+            fo.write(json.dumps(record, sort_keys=True) + '\n')
+            fo.flush()
+        return record
@@ -0,0 +1,328 @@
+"""
+A database of scan results, for querying the history of scans.
+
+Results are stored in an SQLite file, one row per file per scan run, with
+the outcome class, message and timings of each file (see 'scan_report' for
+the record contents).  Each run records the iris version and comparison
+code it used, and the comparison settings.
+
+Run as a script to query a database, e.g. for the slowest files, files that
+changed from OK to failing between two runs, or failures mentioning some
+text.  Old text scan logs and JSON-lines reports can also be imported.
+
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import argparse
+import json
+import re
+import sqlite3
+import time
+
+from scan_report import OUTCOMES, PHASES, read_report, record_peak_rss_mb
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started TEXT,
+    label TEXT,
+    iris_version TEXT,
+    comparer_hash TEXT,
+    settings TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    path TEXT NOT NULL,
+    size INTEGER,
+    outcome TEXT,
+    message TEXT,
+    detail TEXT,
+    n_normal INTEGER,
+    n_structured INTEGER,
+    total_time REAL,
+    normal_load_time REAL,
+    structured_load_time REAL,
+    compare_time REAL,
+    peak_rss_mb REAL,
+    record TEXT,
+    PRIMARY KEY (run_id, path)
+);
+CREATE INDEX IF NOT EXISTS results_path ON results (path);
+CREATE INDEX IF NOT EXISTS results_outcome ON results (run_id, outcome);
+CREATE INDEX IF NOT EXISTS results_time ON results (run_id, total_time);
+"""
+
+# The columns shown for results, by the query CLI.
+_RESULT_COLUMNS = ('run_id', 'path', 'outcome', 'total_time', 'message')
+
+
+class ResultsDB(object):
+    def __init__(self, path):
+        """
+        A database of scan results, in the SQLite file 'path'.
+
+        The file is created if it does not exist.
+
+        """
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def _query(self, sql, *args):
+        return self._connection.execute(sql, args).fetchall()
+
+    def start_run(self, context=None, label=None):
+        """
+        Record the start of a scan run, and return its run id.
+
+        The 'context' is a dict of the settings of the run, as in
+        'scan_cache.scan_context' : 'iris_version' and 'comparer_hash' are
+        stored in their own columns, and any others as JSON.
+
+        """
+        settings = dict(context or {})
+        iris_version = settings.pop('iris_version', None)
+        comparer_hash = settings.pop('comparer_hash', None)
+        with self._connection:
+            cursor = self._connection.execute(
+                'INSERT INTO runs (started, label, iris_version, '
+                'comparer_hash, settings) VALUES (?, ?, ?, ?, ?)',
+                (time.strftime('%Y-%m-%d %H:%M:%S'), label, iris_version,
+                 comparer_hash, json.dumps(settings, sort_keys=True)))
+        return cursor.lastrowid
+
+    def add_record(self, run_id, record):
+        """
+        Store the result record of a file (see 'scan_report') in a run.
+
+        It is committed at once, so an interrupted scan keeps its results.
+
+        """
+        phases = record.get('phases', {})
+        times = [phases[name]['time'] if name in phases else None
+                 for name in PHASES]
+        total_time = None
+        if phases:
+            total_time = sum(phase_time for phase_time in times
+                             if phase_time is not None)
+        with self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO results VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [run_id, record['path'], record.get('size'),
+                 record['outcome'], record['message'], record.get('detail'),
+                 record.get('n_normal'), record.get('n_structured'),
+                 total_time] + times +
+                [record_peak_rss_mb(record),
+                 json.dumps(record, sort_keys=True)])
+
+    def runs(self):
+        # Return all the runs, oldest first, with their numbers of results.
+        return self._query(
+            'SELECT runs.*, COUNT(results.path) AS n_files FROM runs '
+            'LEFT JOIN results USING (run_id) '
+            'GROUP BY runs.run_id ORDER BY runs.run_id')
+
+    def latest_run_ids(self, n_runs=1):
+        # Return the ids of the last 'n_runs' runs, oldest first.
+        rows = self._query('SELECT run_id FROM runs '
+                           'ORDER BY run_id DESC LIMIT ?', n_runs)
+        return [row['run_id'] for row in reversed(rows)]
+
+    def previous_run_id(self, run_id):
+        # Return the id of the run before 'run_id', or None if there is none.
+        rows = self._query('SELECT run_id FROM runs WHERE run_id < ? '
+                           'ORDER BY run_id DESC LIMIT 1', run_id)
+        return rows[0]['run_id'] if rows else None
+
+    def slowest(self, n_files=50, run_id=None):
+        # Return the results of the slowest files of a run (by default, the
+        # latest).
+        if run_id is None:
+            run_id, = self.latest_run_ids(1) or [None]
+        return self._query('SELECT * FROM results WHERE run_id = ? '
+                           'ORDER BY total_time DESC LIMIT ?',
+                           run_id, n_files)
+
+    def outcome_changes(self, old_run_id, new_run_id, regressions=False):
+        """
+        Return the files whose outcome differs between two runs, as rows
+        with the columns 'path', 'old_outcome', 'new_outcome', 'old_message'
+        and 'new_message'.
+
+        If 'regressions' is set, only files which were OK and now are not.
+
+        """
+        sql = ('SELECT new.path AS path, '
+               'old.outcome AS old_outcome, new.outcome AS new_outcome, '
+               'old.message AS old_message, new.message AS new_message '
+               'FROM results AS old JOIN results AS new USING (path) '
+               'WHERE old.run_id = ? AND new.run_id = ? '
+               "AND old.outcome != new.outcome "
+               "AND 'skip' NOT IN (old.outcome, new.outcome)")
+        if regressions:
+            sql += " AND old.outcome = 'ok'"
+        return self._query(sql + ' ORDER BY path', old_run_id, new_run_id)
+
+    def search(self, text, run_id=None, failures_only=True):
+        # Return the results whose message contains 'text', from one run or
+        # all of them, by default only failures.
+        sql = "SELECT * FROM results WHERE message LIKE ? ESCAPE '\\'"
+        pattern = '%{}%'.format(re.sub(r'([%_\\])', r'\\\1', text))
+        args = [pattern]
+        if run_id is not None:
+            sql += ' AND run_id = ?'
+            args.append(run_id)
+        if failures_only:
+            sql += " AND outcome NOT IN ('ok', 'skip')"
+        return self._query(sql + ' ORDER BY run_id, path', *args)
+
+    def import_report(self, report_path, label=None):
+        # Store the records of a JSON-lines report (see 'scan_report') as a
+        # new run.  Returns the run id.
+        run_id = self.start_run(label=label or report_path)
+        for record in read_report(report_path).values():
+            self.add_record(run_id, record)
+        return run_id
+
+    def import_scan_log(self, log_path, label=None):
+        # Store the results in the printed output of an old scan as a new
+        # run, without timings.  Returns the run id.
+        run_id = self.start_run(label=label or log_path)
+        for path, megs, message, skipped in parse_scan_log(log_path):
+            outcome = 'skip' if skipped else message_outcome(message)
+            record = {'path': path, 'size': int(megs * 1.0e6),
+                      'outcome': outcome, 'message': message}
+            self.add_record(run_id, record)
+        return run_id
+
+
+# The first line of each file result, in the printed output of a scan.
+# Files which were skipped are commented out, with a leading '#'.
+_LOG_FILE_LINE = re.compile(r'^(#\s*)?(\S+)\s+([\d.]+)Mb$')
+
+
+def parse_scan_log(log_path):
+    # Return a list of (path, megabytes, message, skipped) from the printed
+    # output of a scan.  A message may be several lines.
+    results = []
+    with open(log_path) as fi:
+        for line in fi:
+            line = line.rstrip('\n')
+            match = _LOG_FILE_LINE.match(line)
+            if match:
+                comment, path, megs = match.groups()
+                results.append([path, float(megs), [], bool(comment)])
+            elif results:
+                results[-1][2].append(line)
+    return [(path, megs, '\n'.join(lines).rstrip(), skipped)
+            for path, megs, lines, skipped in results]
+
+
+def message_outcome(message):
+    # Return the outcome class of a scan result message.
+    text = message.strip()
+    if 'worker crashed' in text:
+        return 'worker_crash'
+    if 'worker timed out' in text:
+        return 'worker_timeout'
+    # N.B. check the longest prefixes first, as '---' starts with '--'.
+    # Other '???' results are comparison crashes.
+    for outcome, prefix in sorted(OUTCOMES.items(),
+                                  key=lambda item: -len(item[1])):
+        if text.startswith(prefix) and not outcome.startswith('worker_'):
+            return outcome
+    return 'compare_crash'
+
+
+def _print_rows(rows, columns=_RESULT_COLUMNS):
+    for row in rows:
+        values = []
+        for name in columns:
+            value = row[name]
+            if isinstance(value, float):
+                value = '{:.2f}'.format(value)
+            elif name.endswith('message') and value:
+                # Only the first line of a message.
+                value = value.strip().split('\n')[0]
+            values.append(str(value))
+        print('  '.join(values))
+    print('({} rows)'.format(len(rows)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Query a database of scan results.')
+    parser.add_argument('db', help='the SQLite results database')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('runs', help='list the scan runs')
+    command = commands.add_parser('slowest', help='the slowest files')
+    command.add_argument('-n', type=int, default=50,
+                         help='number of files (default 50)')
+    command.add_argument('--run', type=int, default=None,
+                         help='run id (default the latest)')
+    for name, help_text in (('changed', 'files whose outcome changed'),
+                            ('regressions', 'files which were OK and now '
+                                            'are not')):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('old_run', type=int, nargs='?', default=None,
+                             help='earlier run id (default the last but one)')
+        command.add_argument('new_run', type=int, nargs='?', default=None,
+                             help='later run id (default the latest)')
+    command = commands.add_parser('search',
+                                  help='results mentioning some text')
+    command.add_argument('text')
+    command.add_argument('--run', type=int, default=None,
+                         help='run id (default all runs)')
+    command.add_argument('--all', action='store_true',
+                         help='include OK results, not just failures')
+    command = commands.add_parser('import-report',
+                                  help='add a JSON-lines report as a run')
+    command.add_argument('files', nargs='+')
+    command = commands.add_parser('import-log',
+                                  help='add the printed output of a scan '
+                                       'as a run')
+    command.add_argument('files', nargs='+')
+    args = parser.parse_args()
+
+    db = ResultsDB(args.db)
+    if args.command == 'runs':
+        _print_rows(db.runs(), ('run_id', 'started', 'label', 'iris_version',
+                                'n_files', 'settings'))
+    elif args.command == 'slowest':
+        _print_rows(db.slowest(args.n, run_id=args.run))
+    elif args.command in ('changed', 'regressions'):
+        # Only the run ids not given default : a single run id given is the
+        # earlier one, compared with the latest run.
+        old_run, new_run = args.old_run, args.new_run
+        if new_run is None:
+            new_run, = db.latest_run_ids(1) or [None]
+            if new_run is None:
+                parser.error('the database has no runs to compare')
+        if old_run is None:
+            old_run = db.previous_run_id(new_run)
+            if old_run is None:
+                parser.error('there is no run before run {} to compare it '
+                             'with'.format(new_run))
+        elif old_run >= new_run:
+            parser.error('run {} is not before run {}'.format(old_run,
+                                                              new_run))
+        _print_rows(db.outcome_changes(
+                        old_run, new_run,
+                        regressions=args.command == 'regressions'),
+                    ('path', 'old_outcome', 'new_outcome', 'new_message'))
+    elif args.command == 'search':
+        _print_rows(db.search(args.text, run_id=args.run,
+                              failures_only=not args.all))
+    elif args.command == 'import-report':
+        for path in args.files:
+            print('{} : run {}'.format(path, db.import_report(path)))
+    elif args.command == 'import-log':
+        for path in args.files:
+            print('{} : run {}'.format(path, db.import_scan_log(path)))
+    db.close()
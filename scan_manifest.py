@@ -0,0 +1,216 @@
+"""
+A persistent manifest of the files in a directory tree.
+
+The manifest records the size, modification time and type (PP, FF or
+unknown) of every file under some base directories, so that the scan
+iterators need not walk the whole tree each time.
+It is saved as a single JSON file, and is refreshed incrementally : the
+files in a directory are only re-listed if the directory itself has changed
+since the last refresh.
+Directories are listed with 'scandir', several at once, as on a networked
+filesystem the time is mostly spent waiting on each listing.
+
+"""
+from collections import namedtuple
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import os.path
+import struct
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # The backport, for Python 2.
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+# Number of directories to list at once.
+DEFAULT_N_THREADS = 16
+
+# The first word of a PP file, and the possible first words (i.e. header
+# version numbers) of a fieldsfile.
+_PP_FIRST_WORD = struct.pack('>i', 64 * 4)
+_FF_FIRST_WORDS = tuple(struct.pack('>q', version) for version in (15, 20))
+
+
+class ManifestEntry(namedtuple('ManifestEntry',
+                               ['path', 'size', 'mtime', 'type'])):
+    # A file in the manifest : 'type' is one of 'pp', 'ff' or None.
+    __slots__ = ()
+
+
+def file_type(path):
+    # Return the type of a file, 'pp' or 'ff', from its first word, or None
+    # if it is neither (or cannot be read).
+    try:
+        with open(path, 'rb') as fi:
+            start = fi.read(8)
+    except (IOError, OSError):
+        return None
+    if start[:4] == _PP_FIRST_WORD:
+        return 'pp'
+    if start in _FF_FIRST_WORDS:
+        return 'ff'
+    return None
+
+
+class _ListdirEntry(object):
+    # A minimal stand-in for a scandir entry, when there is no scandir.
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+def _dir_entries(dirpath):
+    if scandir is None:
+        return [_ListdirEntry(dirpath, name) for name in os.listdir(dirpath)]
+    return list(scandir(dirpath))
+
+
+def _list_dir(dirpath, old_listing=None, recheck_files=False):
+    # Return the manifest listing of a directory, as a dict with keys
+    # 'mtime', 'subdirs' (names) and 'files' ({name: [size, mtime, type]}).
+    # If the directory is unchanged since 'old_listing', that is returned,
+    # unless 'recheck_files' is set.
+    # Returns None if the directory cannot be read.
+    try:
+        mtime = os.stat(dirpath).st_mtime
+        if (old_listing is not None and not recheck_files and
+                old_listing['mtime'] == mtime):
+            return old_listing
+        entries = _dir_entries(dirpath)
+    except (IOError, OSError):
+        return None
+    old_files = old_listing['files'] if old_listing is not None else {}
+    subdirs = []
+    files = {}
+    for entry in entries:
+        try:
+            # N.B. follows symbolic links, like os.walk(followlinks=True).
+            if entry.is_dir():
+                subdirs.append(entry.name)
+                continue
+            stat = entry.stat()
+        except (IOError, OSError):
+            # e.g. a broken link.
+            continue
+        old_file = old_files.get(entry.name)
+        if old_file is not None and old_file[:2] == [stat.st_size,
+                                                     stat.st_mtime]:
+            files[entry.name] = old_file
+        else:
+            files[entry.name] = [stat.st_size, stat.st_mtime,
+                                 file_type(entry.path)]
+    return {'mtime': mtime, 'subdirs': sorted(subdirs), 'files': files}
+
+
+def _under(path, base_path):
+    return path == base_path or path.startswith(base_path + os.sep)
+
+
+class FileManifest(object):
+    def __init__(self, path=None):
+        """
+        A manifest of files, saved in the file 'path' (if given).
+
+        Any existing manifest file is read, but is not refreshed : call
+        'refresh' for each base directory to bring it up to date.
+
+        """
+        self.path = path
+        # {directory-path: listing}, see '_list_dir'.
+        self._dirs = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as fi:
+                self._dirs = json.load(fi)['dirs']
+
+    def refresh(self, base_path, n_threads=DEFAULT_N_THREADS,
+                recheck_files=False):
+        """
+        Bring the manifest up to date for all files under 'base_path', and
+        save it.
+
+        Directories whose modification time is unchanged keep their old
+        listing, so a file changed in place (without being re-created) is
+        only noticed if 'recheck_files' is set.
+
+        """
+        base_path = os.path.normpath(base_path)
+        dirs = {}
+        # Real paths, to avoid looping through symbolic links.
+        seen = set()
+        pool = ThreadPool(n_threads)
+        try:
+            todo = [base_path]
+            while todo:
+                todo = [dirpath for dirpath in todo
+                        if os.path.realpath(dirpath) not in seen]
+                seen.update(os.path.realpath(dirpath) for dirpath in todo)
+                listings = pool.map(
+                    lambda dirpath: _list_dir(dirpath,
+                                              self._dirs.get(dirpath),
+                                              recheck_files),
+                    todo)
+                next_todo = []
+                for dirpath, listing in zip(todo, listings):
+                    if listing is not None:
+                        dirs[dirpath] = listing
+                        next_todo.extend(os.path.join(dirpath, name)
+                                         for name in listing['subdirs'])
+                todo = next_todo
+        finally:
+            pool.close()
+            pool.join()
+        # Replace everything under the base path, dropping removed dirs.
+        self._dirs = {dirpath: listing
+                      for dirpath, listing in self._dirs.items()
+                      if not _under(dirpath, base_path)}
+        self._dirs.update(dirs)
+        self.save()
+
+    def save(self):
+        # Write the manifest file, if there is one.
+        # It is replaced in one step, so an interrupted save does no harm.
+        if self.path is None:
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as fo:
+            json.dump({'dirs': self._dirs}, fo)
+        os.rename(temp_path, self.path)
+
+    def dirs(self, base_path):
+        # Return the paths of the directories under 'base_path', in order.
+        base_path = os.path.normpath(base_path)
+        return sorted(dirpath for dirpath in self._dirs
+                      if _under(dirpath, base_path))
+
+    def files(self, base_path, dirpath_only=False):
+        """
+        Return the ManifestEntry of each file under 'base_path', in order of
+        directory then filename.
+
+        If 'dirpath_only' is set, only files directly in 'base_path' are
+        included.
+
+        """
+        if dirpath_only:
+            dirpaths = [os.path.normpath(base_path)]
+        else:
+            dirpaths = self.dirs(base_path)
+        entries = []
+        for dirpath in dirpaths:
+            files = self._dirs.get(dirpath, {}).get('files', {})
+            entries.extend(ManifestEntry(os.path.join(dirpath, name),
+                                         *files[name])
+                           for name in sorted(files))
+        return entries
@@ -1,20 +1,90 @@
-from glob import glob
+from __future__ import (absolute_import, division, print_function)
+
+import argparse
+import bisect
+from collections import OrderedDict, deque
+import multiprocessing
 import os
 import os.path
+import random
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-from iris.experimental.fieldsfile import load as structured_load
+from iris.cube import CubeList
+from iris.exceptions import IgnoreCubeException
+import iris.fileformats.pp as pp
+from iris.fileformats.rules import Loader, load_cubes
+from iris.fileformats.um._fast_load_structured_fields import \
+    group_structured_fields
 from iris import load as normal_load
+try:
+    from iris.fileformats.um._fast_load import _convert_collation
+except ImportError:
+    # Older iris (1.x) has this in the experimental module.
+    from iris.experimental.fieldsfile import _convert_collation
+try:
+    import iris.fileformats.ff as ff
+    import iris.fileformats.pp_rules as pp_rules
+except ImportError:
+    # Newer iris (2+) has renamed these.
+    import iris.fileformats._ff as ff
+    import iris.fileformats.pp_load_rules as pp_rules
 
-from soft_iris_compares import compare_cubes, compare_cubelists
+from scan_cache import ScanCache, scan_context
+from scan_db import ResultsDB
+from scan_manifest import FileManifest, file_type
+from scan_report import (current_rss_mb, format_stats, measure_phase,
+                         write_record)
+from scan_scheduler import MemoryModel
+from scan_summaries import LOADERS, SummaryStore
+from soft_iris_compares import (STATS_ENV_VAR, compare_cubes,
+                                compare_cubelists, fingerprints_cached,
+                                instrumented, summaries_cached)
 
 
 datazoo_path = '/data/local/dataZoo'
 
+# The memory (in Mb) allowed for comparing one file : files expected to need
+# more are compared in parts.
+DEFAULT_MEMORY_BUDGET_MB = 750.0
+
+# The time (in seconds) allowed for comparing a file in a worker process, by
+# default : a fixed allowance, plus some for each Mb of the file.
+DEFAULT_TIMEOUT = 600.0
+DEFAULT_TIMEOUT_PER_MB = 1.0
+
+# The file size bands (upper limits, in Mb) which budgeted samples are
+# spread across.
+SAMPLE_SIZE_BANDS_MB = (1.0, 10.0, 100.0)
+
+
+# The manifest of dataZoo files, which the file iterators use.
+manifest_path = 'dataZoo_manifest.json'
+
+_manifest = None
+_refreshed_paths = set()
+
+
+def datazoo_manifest(base_path=datazoo_path):
+    # Return the files manifest, refreshed for 'base_path' if it has not
+    # been already, in this run.
+    global _manifest
+    if _manifest is None:
+        _manifest = FileManifest(manifest_path)
+    if not any(base_path == path or base_path.startswith(path + os.sep)
+               for path in _refreshed_paths):
+        _manifest.refresh(base_path)
+        _refreshed_paths.add(base_path)
+    return _manifest
+
 
 def all_files_iter(base_path):
-    for dirpath, dirnames, filenames in os.walk(base_path, followlinks=True):
-        for filename in filenames:
-            yield os.path.join(dirpath, filename)
+    for entry in datazoo_manifest(base_path).files(base_path):
+        yield entry.path
 
 def all_ff_files_iter():
     for filepath in all_files_iter(os.path.join(datazoo_path, 'FF')):
@@ -29,34 +99,87 @@ def all_pp_files_iter(non_pp_only=False):
 
 def all_pp_dirs():
     base_path = os.path.join(datazoo_path, 'PP')
+    manifest = datazoo_manifest(base_path)
     return (dirpath
-            for dirpath, dirnames, filenames
-            in os.walk(base_path, followlinks=True)
-            if any(filename.endswith('.pp') for filename in filenames))
+            for dirpath in manifest.dirs(base_path)
+            if any(entry.path.endswith('.pp')
+                   for entry in manifest.files(dirpath, dirpath_only=True)))
 
 
 def sample_pp_files(n_max_per_dir=3):
+    manifest = datazoo_manifest(os.path.join(datazoo_path, 'PP'))
     for pp_dirpath in all_pp_dirs():
-        filenames = glob(os.path.join(pp_dirpath, '*.pp'))
+        filenames = [entry.path
+                     for entry in manifest.files(pp_dirpath,
+                                                 dirpath_only=True)
+                     if entry.path.endswith('.pp')]
         if n_max_per_dir:
             filenames = filenames[:n_max_per_dir]
-        filenames = [os.path.join(pp_dirpath, filename)
-                     for filename in filenames]
         for i_name in range(1, len(filenames)):
             filenames[i_name] = '  + ' + filenames[i_name]
         for filename in filenames:
             yield filename
 
+
+def budget_sample_files(entries, byte_budget_mb=None, cache=None, seed=0):
+    # Choose a sample of files, spread across directories and size bands.
+    # 'entries' are the manifest entries of the files to choose from.
+    # Yields file paths, taking one from each (directory, size-band) group in
+    # turn, in random order within each group, until all are used or their
+    # total size reaches 'byte_budget_mb'.
+    # If a 'cache' is given, files with no valid cached result (i.e. unknown
+    # or stale) come first in each group, and cached files do not count
+    # towards the budget, as they take no time.
+    rng = random.Random(seed)
+    groups = OrderedDict()
+    for entry in entries:
+        band = bisect.bisect(SAMPLE_SIZE_BANDS_MB, entry.size * 1.0e-6)
+        key = (os.path.dirname(entry.path), band)
+        groups.setdefault(key, []).append(entry)
+    queues = []
+    for group in groups.values():
+        rng.shuffle(group)
+        if cache is not None:
+            # N.B. a stable sort, so the random order is kept within each.
+            group.sort(key=lambda entry: cache.lookup(entry.path) is not None)
+        queues.append(deque(group))
+
+    budget_bytes = None
+    if byte_budget_mb is not None:
+        budget_bytes = byte_budget_mb * 1.0e6
+    while queues:
+        for group_queue in queues:
+            entry = group_queue.popleft()
+            if budget_bytes is None:
+                yield entry.path
+            elif cache is not None and cache.lookup(entry.path) is not None:
+                yield entry.path
+            elif entry.size <= budget_bytes:
+                budget_bytes -= entry.size
+                yield entry.path
+        queues = [group_queue for group_queue in queues if group_queue]
+
+
+def _until_deadline(filenames, deadline):
+    # Yield from 'filenames' until the time is past 'deadline'.
+    for filename in filenames:
+        if time.time() > deadline:
+            print()
+            print('((time budget used : no more files started))')
+            return
+        yield filename
+
+
 def show_all_files():
-    print
-    print 'FF files...'
-    print '\n'.join('{!r},'.format(path)
-                    for path in all_ff_files_iter())
+    print()
+    print('FF files...')
+    print('\n'.join('{!r},'.format(path)
+                     for path in all_ff_files_iter()))
     
-    print
-    print 'PP files...'
-    print '\n'.join('{!r},'.format(path)
-                    for path in all_pp_files_iter(non_pp_only=False))
+    print()
+    print('PP files...')
+    print('\n'.join('{!r},'.format(path)
+                     for path in all_pp_files_iter(non_pp_only=False)))
 
 
 def tst1():
@@ -65,16 +188,16 @@ def tst1():
     tsts = ccs[3]
     tstn = ccn[5]
     result, msg = compare_cubes(tsts, tstn)
-    print 'Cubes equal? = ', result
-    print msg
+    print('Cubes equal? = ', result)
+    print(msg)
 
 def tst2():
     # Compare all results from loading file twice...
     ccs = structured_load('/data/local/dataZoo/PP/mogrepssubsets/2010031612.qteg12.oper18.060.pp468.pp')
     ccn = normal_load('/data/local/dataZoo/PP/mogrepssubsets/2010031612.qteg12.oper18.060.pp468.pp')
     result, msg = compare_cubelists(ccs, ccn)
-    print 'Cubelists equal? = ', result
-    print msg
+    print('Cubelists equal? = ', result)
+    print(msg)
 
     #
     # NOTE:
@@ -83,62 +206,891 @@ def tst2():
     #  'normal' has decreasing values 1000...250, 'structured' is ascending
     #
 
-def tst_compare_all_files(filenames):
-#    for filename in sample_pp_files(1):
-#    for filename in all_ff_files_iter():
-    for filename in filenames:
-        skip = False
-        truename = filename
-        if filename.startswith('#'):
-            truename = filename[1:].strip()
-            skip = True
-        megs = os.stat(truename).st_size * 1.0e-6
-        if megs > 750.0:
-            skip = True
-
-        print
-        print '{}   {:8.3f}Mb'.format(filename.ljust(60), megs)
-        if skip:
-            print '  ((skip))'
-            continue
+def _file_entry(filename):
+    # Interpret an entry of a files list, returning (path, megabytes, skip).
+    # Entries starting with '#' are commented out.
+    skip = False
+    truename = filename
+    if filename.startswith('#'):
+        truename = filename[1:].strip()
+        skip = True
+    megs = os.stat(truename).st_size * 1.0e-6
+    return truename, megs, skip
+
+
+def _result_record(filename, outcome, message, detail=''):
+    # Make a basic result record for a file (see 'scan_report').
+    return {'path': filename, 'size': os.stat(filename).st_size,
+            'outcome': outcome, 'message': message, 'detail': detail,
+            'n_normal': None, 'n_structured': None, 'phases': {}}
+
+
+def _result_message(outcome, detail):
+    # Return the scan message for a result outcome and its details.
+    if outcome == 'ok':
+        msg = '  + OK'
+        if detail:
+            msg += '   ({})'.format(detail)
+    elif outcome == 'match_fail':
+        msg = '  -- MATCH FAIL: {}'.format(detail)
+    elif outcome == 'normal_load_fail':
+        msg = '  XXX normal load fails : {}'.format(detail)
+    elif outcome == 'structured_load_fail':
+        msg = '  --- structured load fails : ' + detail
+    elif outcome == 'skip':
+        msg = '  ((skip)) ' + detail
+    else:
+        msg = '  ??? comparison crashed : {}'.format(detail)
+    return msg
+
+
+def read_fields(filename):
+    # Return an iterator over the fields of a PP or FF file.
+    # N.B. this only reads the field headers : the data is deferred.
+    if file_type(filename) == 'pp':
+        return pp.load(filename)
+    return ff.FF2PP(filename)
+
 
+def _fields_loader(field_generator, converter):
+    # Make a rules.Loader, to convert pre-read fields into cubes.
+    if 'legacy_custom_rules' in Loader._fields:
+        return Loader(field_generator, {}, converter, None)
+    return Loader(field_generator, {}, converter)
+
+
+def normal_load_fields(fields, filename, callback=None):
+    # Make cubes from a list of fields, as 'normal_load' would from the file.
+    loader = _fields_loader(lambda filename: iter(fields), pp_rules.convert)
+    cubes = CubeList(load_cubes([filename], callback, loader))
+    return cubes.merge(unique=False)
+
+
+def structured_load_fields(fields, filename, callback=None):
+    # Make cubes from a list of fields, as 'structured_load' would from the
+    # file.
+    # N.B. that does not merge : each collation of fields makes one cube.
+    loader = _fields_loader(lambda filename: group_structured_fields(fields),
+                            _convert_collation)
+    return CubeList(load_cubes([filename], callback, loader))
+
+
+try:
+    from iris.experimental.fieldsfile import load as structured_load
+except ImportError:
+    # Newer iris (2+) has no separate structured loader, but it is the same
+    # as loading the fields structured, without a merge.
+    def structured_load(filename, callback=None):
+        return structured_load_fields(read_fields(filename), filename,
+                                      callback)
+
+
+def _set_outcome(record, outcome, detail):
+    # Set the outcome of a result record, and its message.
+    record['outcome'], record['detail'] = outcome, detail
+    record['message'] = _result_message(outcome, detail)
+
+
+def load_file(filename, callback=None, load_once=False, only=None):
+    # Load a file in both ways, for 'compare_loaded'.
+    # Returns (record, normal-cubes, structured-cubes).  If either load
+    # fails, the record outcome is set and the cubes are None.
+    # If 'only' is 'normal' or 'structured', just that load is done, and the
+    # cubes of the other are None.
+    # See 'compare_file' for the other arguments.
+    record = _result_record(filename, None, None)
+    phases = record['phases']
+    if load_once:
+        # The fields are read as part of the normal load, and re-used.
+        fields = []
+
+        def load_normal():
+            with measure_phase(phases, 'read_fields'):
+                fields.extend(read_fields(filename))
+            return normal_load_fields(fields, filename, callback)
+
+        def load_structured():
+            return structured_load_fields(fields, filename, callback)
+    else:
+        def load_normal():
+            return normal_load(filename, callback=callback)
+
+        def load_structured():
+            return structured_load(filename, callback=callback)
+
+    d_normal = d_struct = None
+    if only != 'structured':
+        try:
+            with measure_phase(phases, 'normal_load'):
+                d_normal = load_normal()
+        except Exception as err:
+            _set_outcome(record, 'normal_load_fail', str(err))
+            return record, None, None
+        record['n_normal'] = len(d_normal)
+    if only != 'normal':
         try:
-            d_normal = normal_load(filename)
+            with measure_phase(phases, 'structured_load'):
+                d_struct = load_structured()
         except Exception as err:
-            msg = '  XXX normal load fails : {}'.format(err)
+            _set_outcome(record, 'structured_load_fail', str(err))
+            return record, None, None
+        record['n_structured'] = len(d_struct)
+    return record, d_normal, d_struct
+
+
+def _compare_stored(record, cubes, store, against, loader, stash_codes):
+    # Compare the cubes of one loader with those stored for iris version
+    # 'against', and set the record outcome.
+    stored = store.load(record['path'], loader, against, stash_codes)
+    if stored is None:
+        msg = 'no {} summary stored for iris {}'.format(loader, against)
+        _set_outcome(record, 'skip', msg)
+        return
+    try:
+        with measure_phase(record['phases'], 'compare'):
+            result, message = compare_cubelists(stored, cubes)
+    except Exception as e:
+        _set_outcome(record, 'compare_crash', str(e))
+    else:
+        _set_outcome(record, 'ok' if result else 'match_fail', message)
+
+
+def compare_loaded(record, d_normal, d_struct, check_data=False,
+                   summaries_path=None, against=None, loader='structured',
+                   stash_codes=None, stats=False):
+    # Compare the cubes from 'load_file', and set the record outcome.
+    # See 'compare_file' for the other arguments.
+    if stats:
+        with instrumented() as stage_stats:
+            compare_loaded(record, d_normal, d_struct, check_data=check_data,
+                           summaries_path=summaries_path, against=against,
+                           loader=loader, stash_codes=stash_codes)
+        record['stats'] = stage_stats.as_dict()
+        return record
+    store = SummaryStore(summaries_path) if summaries_path else None
+    if against:
+        cubes = d_normal if loader == 'normal' else d_struct
+        _compare_stored(record, cubes, store, against, loader, stash_codes)
+        return record
+    # Saving the summaries re-uses the coord fingerprints of the compare.
+    with fingerprints_cached(), summaries_cached():
+        try:
+            with measure_phase(record['phases'], 'compare'):
+                result, message = compare_cubelists(d_normal, d_struct,
+                                                    check_data=check_data)
+        except Exception as e:
+            _set_outcome(record, 'compare_crash', str(e))
         else:
+            _set_outcome(record, 'ok' if result else 'match_fail', message)
+        if store is not None:
             try:
-                d_struct = structured_load(filename)
-            except Exception as err:
-                msg = '  --- structured load fails : ' + str(err)
+                with measure_phase(record['phases'], 'save_summaries'):
+                    for name, cubes in zip(LOADERS, (d_normal, d_struct)):
+                        store.save(record['path'], name, cubes, stash_codes)
+            except Exception as e:
+                record['summary_error'] = str(e)
+    return record
+
+
+def compare_file(filename, callback=None, check_data=False, load_once=False,
+                 stash_codes=None, summaries_path=None, against=None,
+                 loader='structured', stats=False):
+    # Load a file in both ways, and compare the results.
+    # Returns a result record (see 'scan_report'), whose 'message' is the
+    # (indented) result message printed for the file.
+    # Any 'callback' is passed to both loads.
+    # If 'check_data' is set, the cube data is also compared.
+    # If 'load_once' is set, the file is read only once, and both loads make
+    # their cubes from the same field objects.
+    # If 'stash_codes' is set, only cubes of those STASH codes are loaded
+    # (instead of using any 'callback').
+    # If 'summaries_path' is set, the summaries of both loads are saved in
+    # that SummaryStore, for this iris version.  If 'against' is also set,
+    # instead the file is only loaded by the 'loader', and its cubes are
+    # compared with those stored for the iris version 'against'.
+    # If 'stats' is set, the record also has the 'stats' of the comparison
+    # stages, see 'soft_iris_compares.instrumented'.
+    if stash_codes is not None:
+        callback = _stash_callback(stash_codes)
+    record, d_normal, d_struct = load_file(
+        filename, callback=callback, load_once=load_once,
+        only=loader if against else None)
+    if record['outcome'] is None:
+        compare_loaded(record, d_normal, d_struct, check_data=check_data,
+                       summaries_path=summaries_path, against=against,
+                       loader=loader, stash_codes=stash_codes, stats=stats)
+    return record
+
+
+def _field_bytes(field):
+    # Estimate the in-memory size of the data of a field.
+    # N.B. 'lblrec' is the stored length, which may be packed.
+    return 4 * max(field.lblrec, field.lbrow * field.lbnpt)
+
+
+def stash_chunks(filename, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    # Divide the fields of a file into groups of STASH codes, each group
+    # having no more than 'memory_budget_mb' of data, unless a single STASH
+    # code on its own is bigger than that.
+    # Returns a list of sets of STASH code strings.
+    # N.B. this only reads the field headers.
+    stash_bytes = OrderedDict()
+    for field in read_fields(filename):
+        stash = str(field.stash)
+        stash_bytes[stash] = stash_bytes.get(stash, 0) + _field_bytes(field)
+
+    budget = memory_budget_mb * 1.0e6
+    chunks, chunk, chunk_bytes = [], set(), 0
+    for stash, n_bytes in stash_bytes.items():
+        if chunk and chunk_bytes + n_bytes > budget:
+            chunks.append(chunk)
+            chunk, chunk_bytes = set(), 0
+        chunk.add(stash)
+        chunk_bytes += n_bytes
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _stash_callback(stash_codes):
+    # Make a load callback which discards cubes not of the given STASH codes.
+    def callback(cube, field, filename):
+        if str(cube.attributes.get('STASH')) not in stash_codes:
+            raise IgnoreCubeException()
+    return callback
+
+
+def compare_file_chunked(filename, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                         **compare_kwargs):
+    # Compare a big file in parts, each part loading only a group of STASH
+    # codes, so that the memory used depends on the budget and not on the
+    # file size.  As cubes never combine different STASH codes, this gives
+    # the same cubes overall as loading the whole file.
+    # Returns a single result record, merged from those of the parts : this
+    # is only OK if all parts are, otherwise it is the first part failure.
+    # Any 'compare_kwargs' are passed to 'compare_file'.
+    try:
+        chunks = stash_chunks(filename, memory_budget_mb)
+    except Exception as err:
+        # The normal load would fail the same way, reading the same fields.
+        record = _result_record(filename, None, None)
+        _set_outcome(record, 'normal_load_fail', str(err))
+        return record
+    record = _result_record(filename, 'ok', None)
+    record.update(n_normal=0, n_structured=0)
+    phases = record['phases']
+    details = []
+    for i_chunk, stash_codes in enumerate(chunks):
+        chunk_record = compare_file(filename, stash_codes=stash_codes,
+                                    **compare_kwargs)
+        for name in ('n_normal', 'n_structured'):
+            if record[name] is not None and chunk_record[name] is not None:
+                record[name] += chunk_record[name]
             else:
+                record[name] = None
+        for name, phase in chunk_record['phases'].items():
+            total = phases.setdefault(name, {'time': 0.0, 'peak_rss_mb': 0.0})
+            total['time'] += phase['time']
+            total['peak_rss_mb'] = max(total['peak_rss_mb'],
+                                       phase['peak_rss_mb'])
+        for stage, counts in chunk_record.get('stats', {}).items():
+            total = record.setdefault('stats', {}).setdefault(
+                stage, {'calls': 0, 'time': 0.0, 'bytes': 0})
+            for name in total:
+                total[name] += counts[name]
+        if chunk_record['outcome'] != 'ok':
+            msg = 'chunk {}/{} (STASH {}) : {}'
+            record['outcome'] = chunk_record['outcome']
+            details = [msg.format(i_chunk + 1, len(chunks),
+                                  sorted(stash_codes),
+                                  chunk_record['detail'])]
+            break
+        elif chunk_record['detail']:
+            details.append(chunk_record['detail'])
+    record['detail'] = '; '.join(details)
+    record['message'] = _result_message(record['outcome'], record['detail'])
+    record['n_chunks'] = len(chunks)
+    return record
+
+
+def compare_file_within_budget(filename,
+                               memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                               **compare_kwargs):
+    # Compare a file whole, or in parts if it is bigger than the budget.
+    # N.B. the budget here is in Mb of the file, see
+    # 'MemoryModel.chunk_budget_mb'.
+    # Any 'compare_kwargs' are passed to 'compare_file'.
+    base_rss_mb = current_rss_mb()
+    if os.stat(filename).st_size * 1.0e-6 > memory_budget_mb:
+        record = compare_file_chunked(filename, memory_budget_mb,
+                                      **compare_kwargs)
+    else:
+        record = compare_file(filename, **compare_kwargs)
+    _add_memory_info(record, filename, base_rss_mb)
+    return record
+
+
+def _add_memory_info(record, filename, base_rss_mb):
+    # Add what a MemoryModel needs to learn from a result record.
+    record['base_rss_mb'] = base_rss_mb
+    record['file_type'] = file_type(filename)
+
+
+def _compare_file_worker(filename, memory_budget_mb, compare_kwargs,
+                         connection):
+    # Worker process body : send back the result record for a single file.
+    connection.send(compare_file_within_budget(filename, memory_budget_mb,
+                                               **compare_kwargs))
+    connection.close()
+
+
+def _start_worker(filename, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                  compare_kwargs=None):
+    # Start a worker process for one file.
+    # Returns (process, result-connection, start-time).
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_compare_file_worker,
+                                      args=(filename, memory_budget_mb,
+                                            compare_kwargs or {}, sender))
+    process.daemon = True
+    process.start()
+    # Close our copy of the sending end, so that we see an EOF on the
+    # receiving end if the worker dies without sending a result.
+    sender.close()
+    return process, receiver, time.time()
+
+
+def file_timeout(megs, timeout=None):
+    # Return the seconds to allow a worker for a file of 'megs' Mb, or 0 for
+    # no limit.  A 'timeout' of None means the default, which scales with the
+    # file size.
+    if timeout is None:
+        timeout = round(DEFAULT_TIMEOUT + megs * DEFAULT_TIMEOUT_PER_MB)
+    return timeout
+
+
+def _check_worker(filename, worker, timeout=None):
+    # Return (record, completed) for a worker, or None if it is still
+    # running.
+    # A worker which dies without a result, or runs for longer than 'timeout'
+    # seconds, gets a "???" result, and is not 'completed'.
+    process, receiver, start_time = worker
+    completed = False
+    if receiver.poll():
+        try:
+            record = receiver.recv()
+        except EOFError:
+            process.join()
+            msg = '  ??? worker crashed : exit code {}'.format(
+                process.exitcode)
+            record = _result_record(filename, 'worker_crash', msg)
+        else:
+            process.join()
+            completed = True
+    elif timeout and time.time() - start_time > timeout:
+        process.terminate()
+        process.join()
+        msg = '  ??? worker timed out after {}s'.format(timeout)
+        record = _result_record(filename, 'worker_timeout', msg)
+    else:
+        return None
+    receiver.close()
+    return record, completed
+
+
+def parallel_compare_files(filenames, n_workers, timeout=None, cache=None,
+                           memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                           compare_kwargs=None, poll_interval=0.1,
+                           memory_model=None):
+    # Compare files in up to 'n_workers' concurrent worker processes.
+    # Yields (filename, megs, record) for each file, in the input order.
+    # Each file gets its own worker process, so that a crash or hang on one
+    # bad file cannot affect any other.
+    # A worker is killed if it takes longer than 'timeout' seconds : by
+    # default, this scales with the file size (see 'file_timeout'), and 0
+    # means no limit.
+    # If a 'cache' is given, files with a valid cached result are not
+    # re-compared, and new results are added to it (but not worker failures,
+    # which are retried on the next run).
+    # A new worker only starts if the 'memory_model' estimates that there is
+    # memory for it, and the model decides which files are compared in parts.
+    # By default, this is a MemoryModel with 'memory_budget_mb'.
+    model = memory_model or MemoryModel(memory_budget_mb)
+    filenames = iter(filenames)
+    exhausted = False
+    # Don't run too far ahead of the oldest unfinished file.
+    max_ahead = 4 * n_workers
+    entries = {}
+    running = {}
+    estimates = {}
+    results = {}
+    # The next file, if there was no room to start it yet.
+    pending = None
+    i_next_start, i_next_result = 0, 0
+    while True:
+        # Start new workers, as far as we have capacity.
+        while (len(running) < n_workers and
+               i_next_start - i_next_result < max_ahead):
+            if pending is None:
+                if exhausted:
+                    break
                 try:
-                    result, message = compare_cubelists(d_normal, d_struct)
-                except Exception as e:
-                    msg = '  ??? comparison crashed : {}'
-                    msg = msg.format(e)
-                else:
-                    if result:
-                        msg = '  + OK'
-                        if message:
-                            msg += '   ({})'.format(message)
-                    else:
-                        msg = '  -- MATCH FAIL: {}'.format(message)
-        print msg
-
-def tst_compare_pps():
-    with open('selected_files.txt') as fo:
+                    filename = next(filenames)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending = (filename,) + _file_entry(filename)
+            filename, truename, megs, skip = pending
+            record = None
+            if not skip and cache is not None:
+                record = cache.lookup(filename)
+            if skip:
+                results[i_next_start] = _result_record(truename, 'skip',
+                                                       '  ((skip))')
+            elif record is not None:
+                results[i_next_start] = record
+            else:
+                estimate = model.estimate_mb(filename, megs * 1.0e6)
+                if not model.can_start(sum(estimates.values()), estimate):
+                    break
+                running[i_next_start] = _start_worker(
+                    filename, model.chunk_budget_mb(filename),
+                    compare_kwargs)
+                estimates[i_next_start] = estimate
+            entries[i_next_start] = (filename, megs)
+            pending = None
+            i_next_start += 1
+
+        # Collect results from any finished workers.
+        for i_file, worker in list(running.items()):
+            filename, megs = entries[i_file]
+            result = _check_worker(filename, worker,
+                                   file_timeout(megs, timeout))
+            if result is not None:
+                record, completed = result
+                del running[i_file], estimates[i_file]
+                if completed:
+                    model.observe(record)
+                    if cache is not None:
+                        record = cache.store(record)
+                results[i_file] = record
+
+        # Return all the results now available, in order.
+        while i_next_result in results:
+            filename, megs = entries.pop(i_next_result)
+            yield filename, megs, results.pop(i_next_result)
+            i_next_result += 1
+
+        if (exhausted and pending is None and not running and
+                not results):
+            break
+        time.sleep(poll_interval)
+
+
+def pipelined_compare_files(filenames, cache=None,
+                            memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                            compare_kwargs=None, memory_model=None):
+    # Compare files in this process, but load each file in a background
+    # thread while the previous ones are compared, so that the I/O of
+    # loading overlaps with the CPU work of comparing.
+    # Yields (filename, megs, record) for each file, in the input order.
+    # The loads run ahead only while the 'memory_model' estimates that the
+    # files loaded but not yet compared fit in its memory limit (but always
+    # at least one).  Files too big for its budget are not pre-loaded, but
+    # compared in parts (see 'compare_file_chunked') as usual.
+    # By default, the model is a MemoryModel with 'memory_budget_mb'.
+    # N.B. as loads and compares overlap, the phase memory measurements in
+    # the records are less meaningful than in a serial scan, and tend to
+    # overestimate.
+    model = memory_model or MemoryModel(memory_budget_mb)
+    compare_kwargs = compare_kwargs or {}
+    check_data = compare_kwargs.get('check_data', False)
+    load_once = compare_kwargs.get('load_once', False)
+    loaded_kwargs = {name: compare_kwargs[name]
+                     for name in ('summaries_path', 'against', 'loader',
+                                  'stats')
+                     if name in compare_kwargs}
+    only = None
+    if loaded_kwargs.get('against'):
+        only = loaded_kwargs.get('loader', 'structured')
+    loaded = queue.Queue()
+    budget = threading.Condition()
+    # The estimated Mb of memory for files loaded but not yet compared, and
+    # any error in the loader.
+    state = {'megs': 0.0, 'error': None}
+
+    def reserve(megs):
+        with budget:
+            while not model.can_start(state['megs'], megs):
+                budget.wait()
+            state['megs'] += megs
+
+    def release(megs):
+        with budget:
+            state['megs'] -= megs
+            budget.notify()
+
+    def load_ahead():
+        # Loader thread : queue (filename, megs, reserved-megs, content,
+        # base_rss_mb), where content is a final record, or a 'load_file'
+        # result, or None for a big file to compare in parts.
+        try:
+            for filename in filenames:
+                truename, megs, skip = _file_entry(filename)
+                if skip:
+                    record = _result_record(truename, 'skip', '  ((skip))')
+                    loaded.put((filename, megs, 0.0, record, None))
+                    continue
+                record = None
+                if cache is not None:
+                    record = cache.lookup(filename)
+                if record is not None:
+                    loaded.put((filename, megs, 0.0, record, None))
+                    continue
+                reserved = model.estimate_mb(filename, megs * 1.0e6)
+                reserve(reserved)
+                content = base_rss_mb = None
+                if megs <= model.chunk_budget_mb(filename):
+                    base_rss_mb = current_rss_mb()
+                    content = load_file(filename, load_once=load_once,
+                                        only=only)
+                loaded.put((filename, megs, reserved, content, base_rss_mb))
+        except Exception as err:
+            state['error'] = err
+        finally:
+            loaded.put(None)
+
+    loader = threading.Thread(target=load_ahead)
+    # Don't let the loader keep the process alive, if we stop early.
+    loader.daemon = True
+    loader.start()
+    while True:
+        item = loaded.get()
+        if item is None:
+            break
+        filename, megs, reserved, content, base_rss_mb = item
+        if isinstance(content, dict):
+            record = content
+        else:
+            if content is None:
+                record = compare_file_within_budget(
+                    filename, model.chunk_budget_mb(filename),
+                    **compare_kwargs)
+            else:
+                record = content[0]
+                # N.B. a load failure already set the outcome.
+                if record['outcome'] is None:
+                    compare_loaded(*content, check_data=check_data,
+                                   **loaded_kwargs)
+                _add_memory_info(record, filename, base_rss_mb)
+            # Drop the cubes before allowing more loads.
+            item = content = None
+            release(reserved)
+            model.observe(record)
+            if cache is not None:
+                record = cache.store(record)
+        yield filename, megs, record
+    if state['error'] is not None:
+        raise state['error']
+
+
+def _scan_cache(cache_path, compare_kwargs):
+    # Return the results cache for a scan, or None if there is no cache path.
+    # Results with different comparison settings are not re-used.
+    if not cache_path:
+        return None
+    context = scan_context()
+    context.update(compare_kwargs)
+    return ScanCache(cache_path, context=context)
+
+
+def _compare_kwargs(check_data=False, load_once=False, summaries_path=None,
+                    against=None, loader='structured', stats=False):
+    # The comparison settings of a scan, as keywords for 'compare_file'.
+    # These are also the cache context, so every scan of the same files with
+    # the same settings shares its cached results.
+    compare_kwargs = {'check_data': check_data, 'load_once': load_once}
+    if summaries_path:
+        compare_kwargs['summaries_path'] = summaries_path
+        if against:
+            compare_kwargs.update(against=against, loader=loader)
+    if stats:
+        compare_kwargs['stats'] = True
+    return compare_kwargs
+
+
+def tst_compare_all_files(filenames, n_workers=0, timeout=None,
+                          cache_path=None, report_path=None,
+                          memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                          check_data=False, load_once=False,
+                          time_budget=None, pipeline=False,
+                          memory_limit_mb=None, db_path=None,
+                          summaries_path=None, against=None,
+                          loader='structured', stats=False):
+    # Files expected to need more than 'memory_budget_mb' of memory are
+    # compared in parts, and no more files are compared at once than are
+    # expected to fit in 'memory_limit_mb' : see 'MemoryModel'.  The memory
+    # needs are learnt from the results of this scan, and any cached ones.
+    # If 'check_data' is set, cube data is compared as well as metadata.
+    # If 'load_once' is set, each file is read only once, for both loads.
+    # If 'time_budget' is set, no more files are started after that many
+    # seconds (but those already started are completed).
+    # If 'pipeline' is set (and there are no workers), each file is loaded
+    # while the previous ones are compared, see 'pipelined_compare_files'.
+    # If 'db_path' is set, the results are also stored there as a new run,
+    # see 'scan_db'.
+    # If 'summaries_path' is set, the summaries of the loaded cubes are saved
+    # in that SummaryStore.  If 'against' is also set, each file is instead
+    # loaded only by the 'loader', and compared with the summaries saved by
+    # that iris version : see 'compare_file'.
+    # If 'stats' is set, a breakdown of the comparison time of each file is
+    # printed and recorded : see 'compare_file'.
+#    for filename in sample_pp_files(1):
+#    for filename in all_ff_files_iter():
+    compare_kwargs = _compare_kwargs(check_data, load_once, summaries_path,
+                                     against, loader, stats)
+    cache = _scan_cache(cache_path, compare_kwargs)
+    model = MemoryModel(memory_budget_mb, memory_limit_mb)
+    if cache is not None:
+        for record in cache.records():
+            model.observe(record)
+    if time_budget is not None:
+        filenames = _until_deadline(filenames, time.time() + time_budget)
+    report_file = None
+    if report_path:
+        # Also write all results to a JSON-lines report.
+        report_file = open(report_path, 'a')
+    db, run_id = None, None
+    if db_path:
+        context = scan_context()
+        context.update(compare_kwargs)
+        db = ResultsDB(db_path)
+        run_id = db.start_run(context)
+
+    try:
+        if n_workers or pipeline:
+            # Run concurrently : results come back complete, but in order.
+            if n_workers:
+                results = parallel_compare_files(
+                    filenames, n_workers, timeout=timeout, cache=cache,
+                    compare_kwargs=compare_kwargs, memory_model=model)
+            else:
+                results = pipelined_compare_files(
+                    filenames, cache=cache, compare_kwargs=compare_kwargs,
+                    memory_model=model)
+            for filename, megs, record in results:
+                print()
+                print('{}   {:8.3f}Mb'.format(filename.ljust(60), megs))
+                print(record['message'])
+                if 'stats' in record:
+                    print(format_stats(record['stats']))
+                if report_file:
+                    write_record(report_file, record)
+                if db:
+                    db.add_record(run_id, record)
+            return
+
+        for filename in filenames:
+            truename, megs, skip = _file_entry(filename)
+
+            print()
+            print('{}   {:8.3f}Mb'.format(filename.ljust(60), megs))
+            if skip:
+                record = _result_record(truename, 'skip', '  ((skip))')
+            else:
+                record = None
+                if cache is not None:
+                    record = cache.lookup(filename)
+                if record is None:
+                    record = compare_file_within_budget(
+                        filename, model.chunk_budget_mb(filename),
+                        **compare_kwargs)
+                    model.observe(record)
+                    if cache is not None:
+                        record = cache.store(record)
+            print(record['message'])
+            if 'stats' in record:
+                print(format_stats(record['stats']))
+            if report_file:
+                write_record(report_file, record)
+            if db:
+                db.add_record(run_id, record)
+    finally:
+        if report_file:
+            report_file.close()
+        if db:
+            db.close()
+
+def tst_compare_pps(n_workers=0, timeout=None,
+                    files_list_path='selected_files.txt', cache_path=None,
+                    report_path=None,
+                    memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                    check_data=False, load_once=False, time_budget=None,
+                    pipeline=False, memory_limit_mb=None, db_path=None,
+                    summaries_path=None, against=None, loader='structured',
+                    stats=False):
+    with open(files_list_path) as fo:
         filenames = fo.readlines()
     filenames = [filename.strip()
                  for filename in filenames]
     filenames = [filename for filename in filenames if len(filename) > 0]
-    tst_compare_all_files(filenames)
+    tst_compare_all_files(filenames, n_workers=n_workers, timeout=timeout,
+                          cache_path=cache_path, report_path=report_path,
+                          memory_budget_mb=memory_budget_mb,
+                          check_data=check_data, load_once=load_once,
+                          time_budget=time_budget, pipeline=pipeline,
+                          memory_limit_mb=memory_limit_mb, db_path=db_path,
+                          summaries_path=summaries_path, against=against,
+                          loader=loader, stats=stats)
+
+def tst_compare_ffs(n_workers=0, timeout=None, cache_path=None,
+                    report_path=None,
+                    memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                    check_data=False, load_once=False, time_budget=None,
+                    pipeline=False, memory_limit_mb=None, db_path=None,
+                    summaries_path=None, against=None, loader='structured',
+                    stats=False):
+    tst_compare_all_files(all_ff_files_iter(),
+                          n_workers=n_workers, timeout=timeout,
+                          cache_path=cache_path, report_path=report_path,
+                          memory_budget_mb=memory_budget_mb,
+                          check_data=check_data, load_once=load_once,
+                          time_budget=time_budget, pipeline=pipeline,
+                          memory_limit_mb=memory_limit_mb, db_path=db_path,
+                          summaries_path=summaries_path, against=against,
+                          loader=loader, stats=stats)
 
-def tst_compare_ffs():
-    tst_compare_all_files(all_ff_files_iter())
+def tst_compare_sample(base_name='PP', byte_budget_mb=None, seed=0,
+                       cache_path=None, check_data=False, load_once=False,
+                       summaries_path=None, against=None, loader='structured',
+                       stats=False, **scan_kwargs):
+    # Scan a sample of the dataZoo PP or FF files, spread across directories
+    # and file sizes, preferring files with no up-to-date cached result.
+    # The sample is limited by 'byte_budget_mb' and/or a 'time_budget'.
+    base_path = os.path.join(datazoo_path, base_name)
+    entries = datazoo_manifest(base_path).files(base_path)
+    if base_name == 'PP':
+        entries = [entry for entry in entries if entry.path.endswith('.pp')]
+    # N.B. the same cache context as the scan itself, so that the sample
+    # knows which files it has already cached results for.
+    cache = _scan_cache(cache_path,
+                        _compare_kwargs(check_data, load_once, summaries_path,
+                                        against, loader, stats))
+    filenames = budget_sample_files(entries, byte_budget_mb=byte_budget_mb,
+                                    cache=cache, seed=seed)
+    tst_compare_all_files(filenames, cache_path=cache_path,
+                          check_data=check_data, load_once=load_once,
+                          summaries_path=summaries_path, against=against,
+                          loader=loader, stats=stats, **scan_kwargs)
 
 
 if __name__ == '__main__':
 #    tst1()
 #    tst2()
-    tst_compare_pps()
+    parser = argparse.ArgumentParser(
+        description='Compare normal and structured loading of PP/FF files.')
+    parser.add_argument('files_list', nargs='?', default='selected_files.txt',
+                        help='file containing the paths to scan, one per line')
+    parser.add_argument('-j', '--workers', type=int, default=0,
+                        help='number of parallel worker processes '
+                             '(default 0 = no workers, scan serially)')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds to allow each file in a worker '
+                             'before killing it (default {:g}, plus {:g} '
+                             'per Mb of the file; 0 = no limit)'.format(
+                                 DEFAULT_TIMEOUT, DEFAULT_TIMEOUT_PER_MB))
+    parser.add_argument('--cache', default=None,
+                        help='results cache file : unchanged files with a '
+                             'cached result are not re-compared, so an '
+                             'interrupted scan resumes where it stopped')
+    parser.add_argument('--report', default=None,
+                        help='JSON-lines report file to append results to, '
+                             'with timings : see "scan_report.py"')
+    parser.add_argument('--memory-budget', type=float,
+                        default=DEFAULT_MEMORY_BUDGET_MB,
+                        help='Mb of memory allowed for comparing one file : '
+                             'files expected to need more are compared in '
+                             'parts which fit in it.  Until the memory use '
+                             'of similar files is known, a file is assumed '
+                             'to need its own size '
+                             '(default {})'.format(DEFAULT_MEMORY_BUDGET_MB))
+    parser.add_argument('--memory-limit', type=float, default=None,
+                        help='Mb of memory for all the files compared at '
+                             'once, with workers or --pipeline (default '
+                             '80%% of the memory available at the start)')
+    parser.add_argument('--check-data', action='store_true',
+                        help='also compare the cube data values, '
+                             'a block at a time')
+    parser.add_argument('--load-once', action='store_true',
+                        help='read each file only once, making both the '
+                             'normal and structured cubes from the same '
+                             'fields')
+    parser.add_argument('--all', choices=('pp', 'ff'), default=None,
+                        help='scan all the dataZoo PP or FF files, as listed '
+                             'in the files manifest, instead of a files list')
+    parser.add_argument('--manifest', default=manifest_path,
+                        help='dataZoo files manifest, which is updated for '
+                             'any changes before use '
+                             '(default {})'.format(manifest_path))
+    parser.add_argument('--sample', choices=('pp', 'ff'), default=None,
+                        help='scan a sample of the dataZoo PP or FF files, '
+                             'spread over directories and file sizes, and '
+                             'preferring files with no cached result')
+    parser.add_argument('--byte-budget', type=float, default=None,
+                        help='with --sample, the total Mb of files to '
+                             'compare')
+    parser.add_argument('--time-budget', type=float, default=None,
+                        help='seconds after which no more files are started')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for --sample (default 0)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='without workers, load each file in the '
+                             'background while the previous ones are '
+                             'compared, within the memory budget')
+    parser.add_argument('--db', default=None,
+                        help='SQLite results database to add this scan to, '
+                             'as a new run : see "scan_db.py"')
+    parser.add_argument('--summaries', default=None,
+                        help='directory of data-free summaries of the '
+                             'loaded cubes, to which those of both loads '
+                             'are saved, for this iris version : see '
+                             '"scan_summaries.py"')
+    parser.add_argument('--against', default=None, metavar='IRIS_VERSION',
+                        help='instead of comparing the normal and structured '
+                             'loads, compare one load (see --loader) with '
+                             'the --summaries saved by that iris version')
+    parser.add_argument('--loader', choices=LOADERS, default='structured',
+                        help='with --against, the load to compare '
+                             '(default structured)')
+    parser.add_argument('--stats', action='store_true',
+                        default=bool(os.environ.get(STATS_ENV_VAR)),
+                        help='print and record the time spent in each stage '
+                             'of the comparison of each file (default on if '
+                             '${} is set)'.format(STATS_ENV_VAR))
+    args = parser.parse_args()
+    if args.against and not args.summaries:
+        parser.error('--against needs --summaries')
+    manifest_path = args.manifest
+    scan_kwargs = dict(n_workers=args.workers, timeout=args.timeout,
+                       cache_path=args.cache, report_path=args.report,
+                       memory_budget_mb=args.memory_budget,
+                       check_data=args.check_data,
+                       load_once=args.load_once,
+                       time_budget=args.time_budget,
+                       pipeline=args.pipeline,
+                       memory_limit_mb=args.memory_limit,
+                       db_path=args.db,
+                       summaries_path=args.summaries,
+                       against=args.against,
+                       loader=args.loader,
+                       stats=args.stats)
+    if args.sample:
+        tst_compare_sample(args.sample.upper(),
+                           byte_budget_mb=args.byte_budget, seed=args.seed,
+                           **scan_kwargs)
+    elif args.all == 'pp':
+        tst_compare_all_files(all_pp_files_iter(), **scan_kwargs)
+    elif args.all == 'ff':
+        tst_compare_ffs(**scan_kwargs)
+    else:
+        tst_compare_pps(files_list_path=args.files_list, **scan_kwargs)
@@ -0,0 +1,282 @@
+"""
+Machine-readable scan reports, and a tool to compare two of them.
+
+A report is a file of JSON records, one per line, one per scanned file.
+Each record has the keys :
+
+* 'path', 'size' : the file and its size in bytes.
+* 'outcome' : the result class, one of OUTCOMES.
+* 'message' : the result message, as printed by the scan.
+* 'detail' : the comparison message or error text within 'message'.
+* 'n_normal', 'n_structured' : the number of cubes from each loader, or None
+  if that load was not done.
+* 'phases' : a dict of {phase-name: {'time': seconds, 'peak_rss_mb': mb}}
+  for the phases 'normal_load', 'structured_load' and 'compare', as far as
+  they ran.  When both loads use fields read just once, there is also a
+  'read_fields' phase, which is part of 'normal_load'.  When cube summaries
+  are saved (see 'scan_summaries'), there is also a 'save_summaries' phase,
+  and any error in that is recorded as 'summary_error'.
+* 'base_rss_mb' : the memory usage of the scanning process before the file
+  was loaded, so the file's own memory use is 'record_peak_rss_mb' less this.
+* 'file_type' : 'pp' or 'ff', or None if the file is neither (see
+  'scan_manifest.file_type').
+* 'stats' : only if the scan was run with stage statistics, a dict of
+  {stage-name: {'calls': n, 'time': seconds, 'bytes': n}} for the stages of
+  the comparison (see 'soft_iris_compares.instrumented').
+
+Run as a script, to summarise a report or show the differences between two.
+
+"""
+from __future__ import (absolute_import, division, print_function)
+
+import argparse
+import contextlib
+import json
+import resource
+import time
+
+
+# The possible result classes, and the scan message prefix of each.
+OUTCOMES = {'ok': '+ OK',
+            'match_fail': '-- MATCH FAIL',
+            'normal_load_fail': 'XXX',
+            'structured_load_fail': '---',
+            'compare_crash': '???',
+            'worker_crash': '???',
+            'worker_timeout': '???',
+            'skip': '((skip))'}
+
+PHASES = ('normal_load', 'structured_load', 'compare')
+
+# Phases which are included in one of the main PHASES.
+SUB_PHASES = ('read_fields',)
+
+
+def reset_peak_rss():
+    # Reset the peak memory usage ("high water mark") of this process, if
+    # the system allows it (Linux only).
+    try:
+        with open('/proc/self/clear_refs', 'w') as fo:
+            fo.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def peak_rss_mb():
+    # Return the peak memory usage of this process, in Mb.
+    # Where possible, this is since the last 'reset_peak_rss'.
+    try:
+        with open('/proc/self/status') as fi:
+            for line in fi:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1.0e-3
+    except (IOError, OSError):
+        pass
+    # N.B. on Linux, 'ru_maxrss' is in kilobytes.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1.0e-3
+
+
+def current_rss_mb():
+    # Return the current memory usage of this process, in Mb, or None if the
+    # system does not tell us (Linux only).
+    try:
+        with open('/proc/self/status') as fi:
+            for line in fi:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1.0e-3
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def record_peak_rss_mb(record):
+    # Return the highest peak memory of all the phases in a report record,
+    # or None if it has no phases.
+    peaks = [phase['peak_rss_mb']
+             for phase in record.get('phases', {}).values()]
+    return max(peaks) if peaks else None
+
+
+@contextlib.contextmanager
+def measure_phase(phases, name):
+    # Record the wall time and peak memory of a block of code, as
+    # phases[name] = {'time': seconds, 'peak_rss_mb': mb}.
+    # The record is made even if the block raises an error.
+    reset_peak_rss()
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        phases[name] = {'time': time.time() - start_time,
+                        'peak_rss_mb': peak_rss_mb()}
+
+
+def total_time(record):
+    # Return the total time of all the phases in a report record.
+    phases = record.get('phases', {})
+    return sum(phases[name]['time'] for name in PHASES if name in phases)
+
+
+def write_record(fo, record):
+    # Append a record to an open report file.
+    fo.write(json.dumps(record, sort_keys=True) + '\n')
+    fo.flush()
+
+
+def read_report(path):
+    # Return a dict of {file-path: record} from a report file.
+    # A file which appears more than once takes its last record.
+    records = {}
+    with open(path) as fi:
+        for line in fi:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                records[record['path']] = record
+    return records
+
+
+def diff_reports(old_records, new_records, slowdown_factor=1.5,
+                 min_seconds=1.0):
+    """
+    Compare the records of two reports.
+
+    Returns a dict of lists of (path, old_record, new_record), with keys :
+
+    * 'regressions' : files which were OK and now are not.
+    * 'fixes' : files which were not OK and now are.
+    * 'changed' : other files whose outcome or message has changed.
+    * 'slowdowns', 'speedups' : files whose total time has changed by more
+      than 'slowdown_factor', and by at least 'min_seconds'.
+    * 'added', 'removed' : files in only one of the reports (with None for
+      the missing record).
+
+    Skipped files are ignored, except in 'added' and 'removed'.
+
+    """
+    diffs = {key: [] for key in ('regressions', 'fixes', 'changed',
+                                 'slowdowns', 'speedups',
+                                 'added', 'removed')}
+    for path in sorted(set(old_records) | set(new_records)):
+        old = old_records.get(path)
+        new = new_records.get(path)
+        if old is None:
+            diffs['added'].append((path, None, new))
+            continue
+        if new is None:
+            diffs['removed'].append((path, old, None))
+            continue
+        if 'skip' in (old['outcome'], new['outcome']):
+            continue
+        entry = (path, old, new)
+        old_ok, new_ok = old['outcome'] == 'ok', new['outcome'] == 'ok'
+        if old_ok and not new_ok:
+            diffs['regressions'].append(entry)
+        elif new_ok and not old_ok:
+            diffs['fixes'].append(entry)
+        elif (old['outcome'] != new['outcome'] or
+              old['message'] != new['message']):
+            diffs['changed'].append(entry)
+        old_time, new_time = total_time(old), total_time(new)
+        if abs(new_time - old_time) >= min_seconds:
+            if new_time > old_time * slowdown_factor:
+                diffs['slowdowns'].append(entry)
+            elif old_time > new_time * slowdown_factor:
+                diffs['speedups'].append(entry)
+    for key in ('slowdowns', 'speedups'):
+        diffs[key].sort(key=lambda entry: abs(total_time(entry[2]) -
+                                              total_time(entry[1])),
+                        reverse=True)
+    return diffs
+
+
+def _phase_times(record):
+    phases = record.get('phases', {})
+    return '  '.join('{}={:.2f}s'.format(name, phases[name]['time'])
+                     for name in PHASES + SUB_PHASES if name in phases)
+
+
+def format_stats(stats, n_stages=8):
+    # Return a one-line text of the slowest stages in a 'stats' record entry.
+    # N.B. stages include the time of the stages they call.
+    slowest = sorted(stats.items(), key=lambda item: item[1]['time'],
+                     reverse=True)
+    return '    stages: ' + '  '.join(
+        '{}={:.3f}s/{}/{:.1f}Mb'.format(stage, counts['time'],
+                                        counts['calls'],
+                                        counts['bytes'] * 1.0e-6)
+        for stage, counts in slowest[:n_stages])
+
+
+def print_summary(records, n_slowest=20):
+    # Print the outcome counts of a report, and its slowest files.
+    counts = {}
+    for record in records.values():
+        counts[record['outcome']] = counts.get(record['outcome'], 0) + 1
+    print('{} files'.format(len(records)))
+    for outcome in sorted(counts):
+        print('  {:22s} {:6d}'.format(outcome, counts[outcome]))
+    slowest = sorted(records.values(), key=total_time, reverse=True)
+    slowest = slowest[:n_slowest]
+    all_time = sum(total_time(record) for record in records.values())
+    print()
+    print('Slowest {} files, of total time {:.1f}s :'.format(len(slowest),
+                                                             all_time))
+    for record in slowest:
+        print('  {:8.1f}s  {}'.format(total_time(record), record['path']))
+        print('             {}'.format(_phase_times(record)))
+    all_stats = {}
+    for record in records.values():
+        for stage, counts in record.get('stats', {}).items():
+            total = all_stats.setdefault(stage,
+                                         {'calls': 0, 'time': 0.0, 'bytes': 0})
+            for name in total:
+                total[name] += counts[name]
+    if all_stats:
+        print()
+        print('Comparison stages, over all files :')
+        print(format_stats(all_stats, n_stages=len(all_stats)))
+
+
+def print_diffs(diffs):
+    # Print the result of 'diff_reports'.
+    for key in ('regressions', 'fixes', 'changed',
+                'slowdowns', 'speedups', 'added', 'removed'):
+        entries = diffs[key]
+        print()
+        print('{} : {}'.format(key.upper(), len(entries)))
+        for path, old, new in entries:
+            print('  ' + path)
+            if key in ('slowdowns', 'speedups'):
+                print('      {:.2f}s --> {:.2f}s'.format(total_time(old),
+                                                         total_time(new)))
+                print('      old: ' + _phase_times(old))
+                print('      new: ' + _phase_times(new))
+            elif key in ('regressions', 'fixes', 'changed'):
+                print('      old: ' + old['message'].strip())
+                print('      new: ' + new['message'].strip())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Summarise a scan report, or compare two of them.')
+    parser.add_argument('report', help='a JSON-lines scan report')
+    parser.add_argument('new_report', nargs='?', default=None,
+                        help='a later report, to compare with the first')
+    parser.add_argument('--slowest', type=int, default=20,
+                        help='number of slowest files to list (default 20)')
+    parser.add_argument('--slowdown-factor', type=float, default=1.5,
+                        help='relative time change counted as a slowdown '
+                             'or speedup (default 1.5)')
+    parser.add_argument('--min-seconds', type=float, default=1.0,
+                        help='smallest time change counted as a slowdown '
+                             'or speedup (default 1.0)')
+    args = parser.parse_args()
+    old_records = read_report(args.report)
+    if args.new_report is None:
+        print_summary(old_records, n_slowest=args.slowest)
+    else:
+        diffs = diff_reports(old_records, read_report(args.new_report),
+                             slowdown_factor=args.slowdown_factor,
+                             min_seconds=args.min_seconds)
+        print_diffs(diffs)
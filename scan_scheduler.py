@@ -0,0 +1,119 @@
+"""
+Memory-aware scheduling of file comparisons.
+
+A MemoryModel learns, from the result records of the files already compared,
+how much memory a comparison needs per Mb of file, separately for each file
+type (PP or FF) and directory.  From that it estimates the memory a new file
+will need, which decides whether the file must be compared in parts, and how
+many files can be compared at once within a total memory limit.
+
+"""
+import os.path
+
+from scan_manifest import file_type
+from scan_report import record_peak_rss_mb
+
+
+# The memory used per Mb of file, for files of a type not yet seen.
+# This is the same assumption as a plain file-size budget.
+DEFAULT_RATIO = 1.0
+
+# The smallest ratio assumed, however little memory a file seemed to need.
+MIN_RATIO = 0.1
+
+# The fraction of the available memory to use, by default.
+MEMORY_LIMIT_FRACTION = 0.8
+
+
+def available_memory_mb():
+    # Return the memory available for new work, in Mb, or None if the system
+    # does not tell us (Linux only).
+    try:
+        with open('/proc/meminfo') as fi:
+            for line in fi:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1.0e-3
+    except (IOError, OSError):
+        pass
+    return None
+
+
+class MemoryModel(object):
+    def __init__(self, memory_budget_mb, memory_limit_mb=None,
+                 default_ratio=DEFAULT_RATIO):
+        """
+        Estimates of the memory needed to compare files.
+
+        * 'memory_budget_mb' : the most memory that the comparison of any one
+          file should use.  Files expected to need more are compared in parts.
+        * 'memory_limit_mb' : the most memory for all the comparisons running
+          at once.  By default, a fraction of the currently available memory,
+          or unlimited if that is not known.
+
+        """
+        self.memory_budget_mb = memory_budget_mb
+        if memory_limit_mb is None:
+            available = available_memory_mb()
+            if available is not None:
+                memory_limit_mb = available * MEMORY_LIMIT_FRACTION
+        self.memory_limit_mb = memory_limit_mb
+        self.default_ratio = default_ratio
+        # The highest ratio seen, for each (type, directory) and each
+        # (type, None).
+        self._ratios = {}
+        self._types = {}
+
+    def _file_type(self, path):
+        if path not in self._types:
+            self._types[path] = file_type(path)
+        return self._types[path]
+
+    @staticmethod
+    def _keys(ftype, path):
+        return [(ftype, os.path.dirname(path)), (ftype, None)]
+
+    def observe(self, record):
+        """
+        Learn from the result record of a comparison (see 'scan_report').
+
+        Records without memory measurements are ignored.  For a file compared
+        in parts, the memory use is relative to the size of a part.
+
+        """
+        base_mb = record.get('base_rss_mb')
+        peak_mb = record_peak_rss_mb(record)
+        size_mb = record['size'] * 1.0e-6 / record.get('n_chunks', 1)
+        if base_mb is None or peak_mb is None or size_mb <= 0:
+            return
+        ratio = max((peak_mb - base_mb) / size_mb, MIN_RATIO)
+        # The type is recorded with the result, so needs no file access.
+        ftype = record.get('file_type') or self._file_type(record['path'])
+        for key in self._keys(ftype, record['path']):
+            # Keep the worst case, to stay on the safe side.
+            self._ratios[key] = max(self._ratios.get(key, 0.0), ratio)
+
+    def ratio(self, path):
+        # Return the memory use per Mb of a file, from the most specific
+        # experience we have.
+        for key in self._keys(self._file_type(path), path):
+            if key in self._ratios:
+                return self._ratios[key]
+        return self.default_ratio
+
+    def chunk_budget_mb(self, path):
+        # Return the Mb of the file which fits in the memory budget : a
+        # bigger file must be compared in parts of this size.
+        return self.memory_budget_mb / self.ratio(path)
+
+    def estimate_mb(self, path, size):
+        # Return the estimated memory needed to compare a file of 'size'
+        # bytes.  This is never more than the budget, as a file needing more
+        # is compared in parts.
+        return min(size * 1.0e-6 * self.ratio(path), self.memory_budget_mb)
+
+    def can_start(self, running_mb, estimate_mb):
+        # Return whether a comparison needing 'estimate_mb' can start, when
+        # those running are estimated to need 'running_mb' in all.
+        # There can always be at least one.
+        return (running_mb <= 0 or self.memory_limit_mb is None or
+                running_mb + estimate_mb <= self.memory_limit_mb)
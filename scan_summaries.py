@@ -0,0 +1,119 @@
+"""
+A store of data-free summaries of loaded cubes, for comparing loads across
+iris versions.
+
+For each file, the cubes from each loader ('normal' or 'structured') are
+saved as StoredCube summaries (see 'soft_iris_compares'), in a JSON file
+specific to the iris version.  A later scan with another iris version can
+then compare its own load of a file with the stored one, without loading the
+file with the old version again.
+
+The summaries of a file are grouped by STASH code, so a file scanned in
+parts (each part loading only some STASH codes) can be saved and compared
+part by part.  They are only valid while the file is unchanged.
+
+"""
+import hashlib
+import json
+import os
+import os.path
+
+import iris
+
+from scan_cache import file_key
+from soft_iris_compares import StoredCube, stored_cubes
+
+
+LOADERS = ('normal', 'structured')
+
+
+def _stash_key(cube):
+    return str(cube.attributes.get('STASH'))
+
+
+class SummaryStore(object):
+    def __init__(self, path):
+        """
+        A store of cube summaries, in the directory 'path'.
+
+        It contains a directory for each iris version, and in that one for
+        each loader, with a summary file for each scanned file.
+
+        """
+        self.path = path
+
+    def _summary_path(self, filename, loader, iris_version):
+        # N.B. the name includes a hash of the full path, as many dataZoo
+        # files have the same name.
+        path_hash = hashlib.sha1(
+            os.path.abspath(filename).encode('utf-8')).hexdigest()[:12]
+        name = '{}_{}.json'.format(os.path.basename(filename), path_hash)
+        return os.path.join(self.path, iris_version, loader, name)
+
+    def _read(self, filename, loader, iris_version):
+        # Return the content of the summary file for a file, or None if there
+        # is none or the file has changed since it was saved.
+        path = self._summary_path(filename, loader, iris_version)
+        if not os.path.exists(path):
+            return None
+        with open(path) as fi:
+            content = json.load(fi)
+        if [content['size'], content['mtime']] != list(file_key(filename)):
+            return None
+        return content
+
+    def save(self, filename, loader, cubes, stash_codes=None):
+        """
+        Save the summaries of the cubes from loading a file, for the current
+        iris version.
+
+        If 'stash_codes' is given, the cubes are only those of these STASH
+        codes, and replace just those in any existing summary of the file.
+
+        """
+        content = None
+        if stash_codes is not None:
+            content = self._read(filename, loader, iris.__version__)
+        if content is None:
+            size, mtime = file_key(filename)
+            content = {'path': filename, 'size': size, 'mtime': mtime,
+                       'iris_version': iris.__version__, 'loader': loader,
+                       'complete': stash_codes is None, 'stash': {}}
+        groups = content['stash']
+        for stash in stash_codes or []:
+            # Record that these were loaded, even if they made no cubes.
+            groups[stash] = []
+        for cube, stored in zip(cubes, stored_cubes(cubes)):
+            groups.setdefault(_stash_key(cube), []).append(stored.to_dict())
+
+        path = self._summary_path(filename, loader, iris.__version__)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # Replace the file in one step, so an interrupted save does no harm.
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as fo:
+            json.dump(content, fo)
+        os.rename(temp_path, path)
+
+    def load(self, filename, loader, iris_version, stash_codes=None):
+        """
+        Return the StoredCubes saved for a file, by a loader and iris
+        version, or None if there are none (or not for all the STASH codes
+        requested), or the file has changed since.
+
+        If 'stash_codes' is given, only the cubes of those STASH codes.
+
+        """
+        content = self._read(filename, loader, iris_version)
+        if content is None:
+            return None
+        groups = content['stash']
+        if stash_codes is None:
+            if not content['complete']:
+                return None
+            stash_codes = groups.keys()
+        elif not content['complete'] and not set(stash_codes) <= set(groups):
+            return None
+        return [StoredCube.from_dict(item)
+                for stash in sorted(stash_codes)
+                for item in groups.get(stash, [])]
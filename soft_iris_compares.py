@@ -1,45 +1,674 @@
+from collections import Counter, namedtuple
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+import contextlib
+import functools
+import hashlib
+import itertools
+import numbers
+import os
+import timeit
+import weakref
+
 import numpy as np
 
-import iris.analysis
+import iris.coord_systems
+from iris.coord_systems import CoordSystem, GeogCS
+from iris.coords import CellMethod
+from iris.cube import CubeMetadata
+from iris.fileformats.pp import STASH
+try:
+    from cf_units import Unit
+except ImportError:
+    # Older iris (1.x) has its own units module.
+    from iris.unit import Unit
+try:
+    from dask.callbacks import Callback as DaskCallback
+except ImportError:
+    # Older iris (1.x) uses biggus, not dask.
+    DaskCallback = None
+
+
+# The most array elements to fetch at once, when scanning through the whole
+# of a (possibly lazy) array.
+BLOCK_SIZE = 2 ** 20
+
+# The most possible dimension mappings to try, for an ambiguous cube pair.
+MAX_MAPPING_CANDIDATES = 256
+
+# The most orientations to hash, for the canonical hash of a coord whose
+# orientation is ambiguous (see 'canonical_orientations').
+MAX_CANONICAL_ORIENTATIONS = 64
+
+# The relative difference in axis profiles which counts as a real one, and
+# not from rounding (see 'canonical_orientations').
+PROFILE_RTOL = 1.0e-9
+
+# Default tolerances for comparing cube data, when requested.
+DATA_RTOL = 1.0e-5
+DATA_ATOL = 1.0e-8
+
+# The most differing items to list, for each kind of cubelist difference.
+MAX_LISTED_DIFFERENCES = 5
+
+# Attributes of coordinate systems which are only caches of the others.
+_COORD_SYSTEM_CACHES = ('_globe', '_crs')
+
+# An environment variable which, if set (non-empty), turns on the stage
+# statistics for the whole process : see 'instrumented'.
+STATS_ENV_VAR = 'SOFT_IRIS_COMPARES_STATS'
+
+
+# Instrumentation.
+#
+# The main stages of the comparisons are timed and counted, but only while
+# some ComparisonStats is collecting, within 'instrumented' (or in the whole
+# process, if STATS_ENV_VAR is set).  Otherwise, a stage costs just one
+# extra function call and test.
+# The time and bytes of a stage include those of any stages within it.
+# N.B. this is not thread-safe : only compare in one thread at a time.
+
+class ComparisonStats(object):
+    # The calls, total time (seconds) and bytes of array values fetched, of
+    # each comparison stage, as {stage-name: [calls, time, bytes]}.
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, stage, calls=0, seconds=0.0, nbytes=0):
+        totals = self.stages.setdefault(stage, [0, 0.0, 0])
+        totals[0] += calls
+        totals[1] += seconds
+        totals[2] += nbytes
+
+    def as_dict(self):
+        # Return a JSON-compatible form, {stage: {'calls', 'time', 'bytes'}}.
+        return {stage: {'calls': calls, 'time': seconds, 'bytes': nbytes}
+                for stage, (calls, seconds, nbytes) in self.stages.items()}
+
+
+# The active ComparisonStats, and the names of the stages now running.
+_COLLECTORS = []
+_RUNNING_STAGES = []
+
+# The process-wide stats, if turned on by the environment.
+GLOBAL_STATS = None
+if os.environ.get(STATS_ENV_VAR):
+    GLOBAL_STATS = ComparisonStats()
+    _COLLECTORS.append(GLOBAL_STATS)
+
+
+@contextlib.contextmanager
+def instrumented():
+    # Within this context, record the ComparisonStats of all comparisons.
+    # Yields the stats.  Stats of any outer contexts include these too.
+    stats = ComparisonStats()
+    _COLLECTORS.append(stats)
+    try:
+        yield stats
+    finally:
+        _COLLECTORS.remove(stats)
+
+
+def _stage(name):
+    # Decorate a function as a comparison stage, called 'name'.
+    def decorator(function):
+        @functools.wraps(function)
+        def staged(*args, **kwargs):
+            if not _COLLECTORS:
+                return function(*args, **kwargs)
+            _RUNNING_STAGES.append(name)
+            start = timeit.default_timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                seconds = timeit.default_timer() - start
+                _RUNNING_STAGES.pop()
+                for stats in _COLLECTORS:
+                    stats.add(name, calls=1, seconds=seconds)
+        return staged
+    return decorator
+
+
+def _count_bytes(array):
+    # Record the bytes of array values fetched, against the running stages.
+    if _COLLECTORS:
+        for name in set(_RUNNING_STAGES):
+            for stats in _COLLECTORS:
+                stats.add(name, nbytes=array.nbytes)
+
+
+def coord_metadata(coord):
+    # Return the metadata of a coord, for metadata-only comparisons.
+    # This never copies, or even accesses, the points and bounds arrays.
+    # Also ignore dtypes, and Coord subclass such as DimCoord/AuxCoord, as
+    # standard coordinate equality does.
+    return (coord.standard_name, coord.long_name, coord.var_name,
+            coord.units, coord.attributes, coord.coord_system)
+
+
+@_stage('coord_metadata')
+def coord_metadata_equal(ref_coord, tst_coord):
+    # Compare the metadata of two coords, without touching their arrays.
+    # As in the original 'co_nodata' comparison, boundedness counts as
+    # metadata : a coord with bounds never matches one without.
+    if coord_metadata(ref_coord) != coord_metadata(tst_coord):
+        return False
+    if ref_coord.has_bounds() != tst_coord.has_bounds():
+        return False
+    # Like standard equality, two DimCoords must also agree on 'circular'.
+    if hasattr(ref_coord, 'circular') and hasattr(tst_coord, 'circular'):
+        return ref_coord.circular == tst_coord.circular
+    return True
+
+
+def _is_lazy(array):
+    # Check whether an array is lazy (e.g. dask or biggus), and not real.
+    return hasattr(array, 'compute') or hasattr(array, 'ndarray')
 
-def co_nodata(coord):
-    # Reduce a coord to a single dimension and single zero value, with possible
-    # bounds, to enable metadata-only comparisons.
-    # Also ignore dtypes.
-    # NOTE: Surprisingly, standard coordinate equality *already* ignores dtype,
-    # and also Coord subclass such as DimCord/AuxCoord.
-    co_x = coord.copy()
-    for _ in range(coord.ndim):
-        co_x = co_x[0]
-    co_x.points = [0]
-    if co_x.has_bounds():
-        co_x.bounds = [0, 0]
-    return co_x
+
+def _is_numeric(array):
+    # Check whether an array holds numbers (or booleans), which can be
+    # compared within tolerances, unlike e.g. strings.
+    return np.dtype(array.dtype).kind in 'biufc'
+
+
+def _values_close(array1, array2):
+    # As np.allclose, but for arrays of any values : where either is not
+    # numeric, the values must be equal.
+    if _is_numeric(array1) and _is_numeric(array2):
+        return np.allclose(array1, array2)
+    return np.array_equal(array1, array2)
+
+
+def _realise(array):
+    # Return the real values of a possibly-lazy array.
+    # This is how the comparisons fetch all values, see '_lazy_guard'.
+    global _FETCHING
+    if hasattr(array, 'compute'):
+        _FETCHING = True
+        try:
+            array = array.compute()
+        finally:
+            _FETCHING = False
+    elif hasattr(array, 'ndarray'):
+        array = array.ndarray()
+    if _GUARDS:
+        _check_fetch(array)
+    return array
+
+
+def core_points(coord):
+    # Return the points array of a coord, without realising it if lazy.
+    if hasattr(coord, 'core_points'):
+        return coord.core_points()
+    return coord.points
+
+
+def core_bounds(coord):
+    # Return the bounds array of a coord, without realising it if lazy.
+    if hasattr(coord, 'core_bounds'):
+        return coord.core_bounds()
+    return coord.bounds
+
+
+@_stage('corners')
+def _corners(array):
+    # Return the real 'corner' values of an array, in their original order,
+    # taken in a single strided slice (see 'corner_values').
+    corners = _realise(array[tuple(slice(None, None, max(n - 1, 1))
+                                   for n in array.shape)])
+    _count_bytes(corners)
+    return corners
 
 
 def corner_values(array):
     # Return a sorted list of the 'corner' values of an array.
     # I.E. all combinations of the first+last indices in each dimension,
     # resulting in an array of 2**ndim values.
-    ndim = array.ndim
-    for i_dim in range(ndim):
-        slices = [slice(None)] * ndim
-        slices[i_dim] = [0, -1]
-        array = array[slices]
-    return np.sort(array.flat)
+    # The corners are taken in a single strided slice, which is just a view
+    # of a real array, and only fetches the corner elements (or chunks) of a
+    # memory-mapped or lazy one.
+    corners = _corners(array)
+    # Repeat the single value of any length-1 dimensions, so we always get
+    # 2**ndim values.
+    corners = corners[np.ix_(*[[0, -1]] * corners.ndim)]
+    return np.sort(corners.flat)
+
+
+def _coord_corners(coord):
+    # Return the corner points of a coord (see '_corners'), which a
+    # StoredCoord has stored.
+    if isinstance(coord, StoredCoord):
+        return coord.corners
+    return _corners(core_points(coord))
 
 
+@_stage('endpoint_values')
 def coord_endpoint_values(coord):
     # Return the min+max index point values of a coordinate, and add in the
     # bounds values if any.
     # N.B. multidimensional coords can't have bounds anyway.
-    points = corner_values(coord.points)
+    # N.B. this does not realise lazy points or bounds.
+    points = corner_values(core_points(coord))
     if coord.has_bounds():
         points = np.concatenate((points,
-                                 corner_values(coord.bounds)))
+                                 corner_values(core_bounds(coord))))
     return points
 
 
+def _iter_blocks(array, block_size=BLOCK_SIZE):
+    # Yield the real values of successive sections of a (possibly lazy)
+    # array, along its first dimension, each of about 'block_size' elements.
+    if array.ndim == 0:
+        block = _realise(array)
+        _count_bytes(block)
+        yield block
+        return
+    row_size = max(1, int(np.prod(array.shape[1:])))
+    n_rows = max(1, block_size // row_size)
+    for i_row in range(0, array.shape[0], n_rows):
+        block = _realise(array[i_row:i_row + n_rows])
+        _count_bytes(block)
+        yield block
+
+
+def _first_index(differs, start):
+    # Return the index of the first True element of a boolean block, which
+    # starts at index 'start' of its array, or None if there is none.
+    if not np.any(differs):
+        return None
+    index = np.unravel_index(np.argmax(differs), differs.shape)
+    return tuple(int(i) + i_start for i, i_start in zip(index, start))
+
+
+def _matched_chunks(ref_array, tst_array, whole_last=False):
+    # Return two same-shaped (possibly lazy) arrays, with any chunked (dask)
+    # ones rechunked alike, and those common chunks (or None if neither is
+    # chunked).
+    # The common chunks split each dimension wherever either array's chunks
+    # do, so each of them is within a single chunk of both arrays : e.g. the
+    # chunks of a y/x-transposed array, once mapped to the reference
+    # orientation, run across the reference ones.
+    # If 'whole_last', the last dimension is not split.
+    all_chunks = [array.chunks for array in (ref_array, tst_array)
+                  if getattr(array, 'chunks', None) is not None]
+    if not all_chunks:
+        return ref_array, tst_array, None
+    chunks = []
+    for dim_chunks in zip(*all_chunks):
+        edges = sorted(set(edge for one_chunks in dim_chunks
+                           for edge in np.cumsum((0,) + one_chunks)))
+        chunks.append(tuple(int(stop - start)
+                            for start, stop in zip(edges[:-1], edges[1:])))
+    if whole_last and chunks:
+        chunks[-1] = (sum(chunks[-1]),)
+    chunks = tuple(chunks)
+    arrays = []
+    for array in (ref_array, tst_array):
+        if getattr(array, 'chunks', None) not in (None, chunks):
+            array = array.rechunk(chunks)
+        arrays.append(array)
+    return arrays[0], arrays[1], chunks
+
+
+def _chunk_sections(chunks, block_size=BLOCK_SIZE):
+    # Yield the (start, keys) of successive sections of an array with the
+    # given chunks.  Each is whole chunks, those along the first dimension
+    # grouped up to about 'block_size' elements (or a single bigger one).
+    spans = [list(zip(np.cumsum((0,) + dim_chunks), np.cumsum(dim_chunks)))
+             for dim_chunks in chunks[1:]]
+    for cell in itertools.product(*spans):
+        cell_size = int(np.prod([stop - start for start, stop in cell]))
+        cell_keys = tuple(slice(int(start), int(stop))
+                          for start, stop in cell)
+        cell_start = tuple(int(start) for start, _ in cell)
+        row_spans = []
+        start = stop = 0
+        for n_rows in chunks[0]:
+            group_size = (stop + n_rows - start) * cell_size
+            if stop > start and group_size > block_size:
+                row_spans.append((start, stop))
+                start = stop
+            stop += n_rows
+        if stop > start:
+            row_spans.append((start, stop))
+        for start, stop in row_spans:
+            yield ((start,) + cell_start,
+                   (slice(start, stop),) + cell_keys)
+
+
+def _iter_block_pairs(ref_array, tst_array, block_size=BLOCK_SIZE,
+                      whole_last=False):
+    # Yield the start index and real values of successive matching sections
+    # of two same-shaped (possibly lazy) arrays, as for '_iter_blocks'.
+    # A lazy array may read the whole of a source chunk to fetch any part of
+    # it, so where either is chunked, the blocks follow the chunks common to
+    # both (see '_matched_chunks'), and never cut across them unless a chunk
+    # is bigger than a block.  The blocks are then in chunk order, which is
+    # not index order where the arrays are chunked across their later
+    # dimensions.
+    ref_array, tst_array, chunks = _matched_chunks(ref_array, tst_array,
+                                                   whole_last)
+    if chunks is None or ref_array.ndim == 0:
+        sections = [((0,) * ref_array.ndim, None)]
+    else:
+        sections = _chunk_sections(chunks, block_size)
+    for start, keys in sections:
+        ref_section, tst_section = ref_array, tst_array
+        if keys is not None:
+            ref_section, tst_section = ref_array[keys], tst_array[keys]
+        i_row = 0
+        for ref_block, tst_block in zip(
+                _iter_blocks(ref_section, block_size),
+                _iter_blocks(tst_section, block_size)):
+            block_start = start
+            if start:
+                block_start = (start[0] + i_row,) + start[1:]
+            yield block_start, ref_block, tst_block
+            i_row += ref_block.shape[0] if ref_block.ndim else 1
+
+
+@_stage('first_difference')
+def first_difference(ref_array, tst_array, rtol=0.0, atol=0.0,
+                     equal_nan=False, sort_last=False,
+                     block_size=BLOCK_SIZE):
+    # Return the index of the first element where two same-shaped (possibly
+    # lazy) arrays differ, or None if they do not.  For chunked arrays, that
+    # is the first in the order of their chunks (see '_iter_block_pairs').
+    # Values differ if they are not close within the tolerances (as for
+    # np.isclose) : the default is exact equality.  Values which are not
+    # numbers (e.g. strings) differ if they are not equal.  Masks are ignored.
+    # The arrays are fetched and compared a block at a time, stopping at the
+    # first block with a difference, so the extra memory used is only that
+    # of one block, however big the arrays.
+    # If 'sort_last', ignore the order of values along the last dimension,
+    # as for the bounds of a cell : the index is then that of the cell.
+    for start, ref_block, tst_block in _iter_block_pairs(
+            ref_array, tst_array, block_size, whole_last=sort_last):
+        ref_block = np.ma.getdata(ref_block)
+        tst_block = np.ma.getdata(tst_block)
+        if sort_last:
+            ref_block = np.sort(ref_block, axis=-1)
+            tst_block = np.sort(tst_block, axis=-1)
+        if _is_numeric(ref_block) and _is_numeric(tst_block):
+            differs = ~np.isclose(tst_block, ref_block, rtol=rtol,
+                                  atol=atol, equal_nan=equal_nan)
+        else:
+            differs = np.asarray(tst_block != ref_block)
+        index = _first_index(differs, start)
+        if index is not None:
+            return index[:-1] if sort_last else index
+    return None
+
+
+# The largest integer magnitude which float64 represents exactly.
+_MAX_EXACT_FLOAT_INT = 2 ** 53
+
+
+def _block_bytes(block):
+    # Return the bytes to hash for a block of array values.
+    # Numbers are taken as float64, so the result does not depend on dtype,
+    # except for integers too big for float64 to represent exactly.  Other
+    # values (e.g. strings) are taken one by one, with the dtype kind.
+    kind = block.dtype.kind
+    if kind in 'biuf':
+        if (kind in 'iu' and block.size and
+                (block.min() < -_MAX_EXACT_FLOAT_INT or
+                 block.max() > _MAX_EXACT_FLOAT_INT)):
+            return kind.encode('ascii') + np.ascontiguousarray(
+                block, dtype=kind + '8').tobytes()
+        return np.ascontiguousarray(block, dtype=np.float64).tobytes()
+    parts = [kind.encode('ascii')]
+    for value in block.ravel().tolist():
+        if not isinstance(value, bytes):
+            value = u'{}'.format(value).encode('utf-8')
+        parts.append('{}:'.format(len(value)).encode('ascii') + value)
+    return b''.join(parts)
+
+
+def _update_hash(hasher, array, sort_last=False):
+    # Add the shape and values of an array to a hash.
+    # The result does not depend on dtype, see '_block_bytes'.
+    # If 'sort_last' is set, values are sorted along the last dimension, so
+    # the result does not depend on their order there either.
+    hasher.update(repr(tuple(array.shape)).encode('ascii'))
+    for block in _iter_blocks(array):
+        block = np.ma.getdata(block)
+        if sort_last and block.ndim:
+            block = np.sort(block, axis=-1)
+        hasher.update(_block_bytes(block))
+
+
+def _arrays_hash(*arrays):
+    hasher = hashlib.sha1()
+    for array in arrays:
+        _update_hash(hasher, array)
+    return hasher.hexdigest()
+
+
+def _axis_profiles(array):
+    # Return, for each dimension of an array, the sums of the array over all
+    # the other dimensions.
+    # These do not depend on the order or direction of the other dimensions.
+    ndim = array.ndim
+    sums = [np.zeros(n) for n in array.shape]
+    i_row = 0
+    for block in _iter_blocks(array):
+        block = np.ma.getdata(block).astype(np.float64)
+        n_rows = block.shape[0]
+        for i_dim in range(ndim):
+            other_dims = tuple(i for i in range(ndim) if i != i_dim)
+            block_sums = block.sum(axis=other_dims) if other_dims else block
+            if i_dim == 0:
+                sums[0][i_row:i_row + n_rows] = block_sums
+            else:
+                sums[i_dim] += block_sums
+        i_row += n_rows
+    return sums
+
+
+def _profile_differences(profile1, profile2):
+    # Return where two same-length profiles differ, by more than rounding.
+    scale = max(np.max(np.abs(profile1)), np.max(np.abs(profile2)))
+    return ~np.isclose(profile1, profile2, rtol=0.0,
+                       atol=PROFILE_RTOL * scale)
+
+
+def _profile_flip(profile):
+    # Return whether to flip a dimension to make its profile "ascending",
+    # i.e. less than its reverse at the first value where they differ, or
+    # None if it is symmetric, so that either way is the same.
+    differs = _profile_differences(profile, profile[::-1])
+    if not np.any(differs):
+        return None
+    i_first = np.argmax(differs)
+    return bool(profile[i_first] > profile[::-1][i_first])
+
+
+def canonical_orientations(array):
+    # Return a list of (flips, axes) for an array, such that reversing the
+    # dimensions where 'flips' is True, and then transposing to 'axes', gives
+    # a 'canonical' orientation.  The set of these is the same for any
+    # transposed or inverted version of the array.
+    # Each dimension is flipped to make its profile (see '_axis_profiles')
+    # ascending, and dimensions are sorted by length and then by profile.
+    # Where that is ambiguous, because a profile is symmetric or dimensions
+    # have the same profiles (or the values are not numbers, so there are no
+    # profiles), there is one result for each possible orientation, up to
+    # MAX_CANONICAL_ORIENTATIONS.
+    ndim = array.ndim
+    if _is_numeric(array):
+        profiles = _axis_profiles(array)
+        flips = [_profile_flip(profile) for profile in profiles]
+        profiles = [profile[::-1] if flip else profile
+                    for profile, flip in zip(profiles, flips)]
+    else:
+        profiles = [np.zeros(n) for n in array.shape]
+        flips = [None] * ndim
+    order = sorted(range(ndim),
+                   key=lambda i_dim: (array.shape[i_dim],
+                                      tuple(profiles[i_dim])))
+    # Group the dimensions which sort the same, whose order is ambiguous.
+    groups = []
+    for i_dim in order:
+        if groups:
+            i_last = groups[-1][-1]
+            if (array.shape[i_dim] == array.shape[i_last] and
+                    not np.any(_profile_differences(profiles[i_dim],
+                                                    profiles[i_last]))):
+                groups[-1].append(i_dim)
+                continue
+        groups.append([i_dim])
+    # N.B. flipping or reordering length-1 dimensions changes nothing.
+    undecided = [i_dim for i_dim in range(ndim)
+                 if flips[i_dim] is None and array.shape[i_dim] > 1]
+    group_orders = [list(itertools.permutations(group))
+                    if array.shape[group[0]] > 1 else [tuple(group)]
+                    for group in groups]
+    results = []
+    for choice in itertools.product((False, True), repeat=len(undecided)):
+        choice_flips = [bool(flip) for flip in flips]
+        for i_dim, flip in zip(undecided, choice):
+            choice_flips[i_dim] = flip
+        for orders in itertools.product(*group_orders):
+            axes = [i_dim for order in orders for i_dim in order]
+            results.append((choice_flips, axes))
+            if len(results) >= MAX_CANONICAL_ORIENTATIONS:
+                return results
+    return results
+
+
+def reoriented(array, flips, axes):
+    # Return a view of an array with dimensions flipped and then transposed,
+    # as from 'canonical_orientations'.
+    # Any extra trailing dimensions, such as for bounds, are unchanged.
+    array = array[tuple(slice(None, None, -1) if flip else slice(None)
+                        for flip in flips)]
+    extra_dims = list(range(len(axes), array.ndim))
+    return array.transpose(list(axes) + extra_dims)
+
+
+class CoordFingerprint(object):
+    # Content hashes of the points and bounds of a coord, ignoring dtype
+    # (see '_block_bytes').
+    # 'points' and 'bounds' hash the arrays as stored ('bounds' is None if
+    # the coord has none).
+    # 'canonical' hashes both in the canonical orientation of the points, so
+    # is the same for transposed or inverted versions of a coord.  This is
+    # only calculated when first used.
+    @_stage('fingerprint')
+    def __init__(self, coord):
+        self.points = _arrays_hash(core_points(coord))
+        self.bounds = None
+        if coord.has_bounds():
+            self.bounds = _arrays_hash(core_bounds(coord))
+        # Don't keep the coord (or its arrays) alive just for this.
+        self._coord_ref = weakref.ref(coord)
+        self._canonical = None
+        self._endpoints = None
+
+    @property
+    def canonical(self):
+        if self._canonical is None:
+            self._canonical = _canonical_hash(self._coord_ref())
+        return self._canonical
+
+    @property
+    def endpoints(self):
+        # The 'coord_endpoint_values', also only calculated when first used.
+        if self._endpoints is None:
+            self._endpoints = coord_endpoint_values(self._coord_ref())
+        return self._endpoints
+
+    def exact_match(self, other):
+        return self.points == other.points and self.bounds == other.bounds
+
+    def to_dict(self):
+        # Return a JSON-compatible form of the fingerprint, with all its
+        # (otherwise lazy) parts calculated.
+        return {'points': self.points, 'bounds': self.bounds,
+                'canonical': self.canonical,
+                'endpoints': _encoded(np.asarray(self.endpoints))}
+
+    @classmethod
+    def from_dict(cls, content):
+        # Restore a fingerprint from 'to_dict', without any coord.
+        fingerprint = cls.__new__(cls)
+        fingerprint.points = content['points']
+        fingerprint.bounds = content['bounds']
+        fingerprint._coord_ref = None
+        fingerprint._canonical = content['canonical']
+        fingerprint._endpoints = _decoded(content['endpoints'])
+        return fingerprint
+
+
+@_stage('canonical_hash')
+def _canonical_hash(coord):
+    # Return the 'canonical' hash of a coord, see CoordFingerprint.
+    # Where its canonical orientation is ambiguous, this is the least of the
+    # hashes of all the possible ones.
+    points = core_points(coord)
+    hashes = []
+    for flips, axes in canonical_orientations(points):
+        hasher = hashlib.sha1()
+        _update_hash(hasher, reoriented(points, flips, axes))
+        if coord.has_bounds():
+            # Inverting a coord may also reverse the bounds of each cell
+            # (depending on the iris version), so ignore their order.
+            _update_hash(hasher, reoriented(core_bounds(coord), flips, axes),
+                         sort_last=True)
+        hashes.append(hasher.hexdigest())
+    return min(hashes)
+
+
+# Memoised coord fingerprints by coord id, within 'fingerprints_cached'.
+_FINGERPRINTS = None
+
+# Memoised cube summaries by cube id, within 'summaries_cached'.
+_SUMMARIES = None
+
+
+def _memoised(memo, obj, calculate):
+    # Return calculate(obj), stored in the dict 'memo' if that is not None.
+    # Entries hold only a weak reference to the object, so that temporary
+    # ones (e.g. derived coords) are not kept alive, and a new object which
+    # re-uses an old id is not mistaken for it.
+    if memo is None:
+        return calculate(obj)
+    entry = memo.get(id(obj))
+    if entry is not None and entry[0]() is obj:
+        return entry[1]
+    result = calculate(obj)
+    memo[id(obj)] = (weakref.ref(obj), result)
+    return result
+
+
+@contextlib.contextmanager
+def fingerprints_cached():
+    # Within this context, the fingerprint of each coord object is only
+    # calculated once.
+    global _FINGERPRINTS
+    outer = _FINGERPRINTS
+    if outer is None:
+        _FINGERPRINTS = {}
+    try:
+        yield
+    finally:
+        _FINGERPRINTS = outer
+
+
+def coord_fingerprint(coord):
+    # Return the CoordFingerprint of a coord, memoised within
+    # 'fingerprints_cached'.
+    # A StoredCoord has its fingerprint already.
+    if isinstance(coord, StoredCoord):
+        return coord.fingerprint
+    return _memoised(_FINGERPRINTS, coord, CoordFingerprint)
+
+
+@_stage('compare_coords')
 def compare_coords(ref_coord, tst_coord):
     # A tolerant coordinate comparison check.
     # Allows for different ordering of dimensions, and possible inversion of
@@ -51,76 +680,632 @@ def compare_coords(ref_coord, tst_coord):
     #       or a diagnostic error message if 'success' is False.
     success, message = True, ''
     coord_name = ref_coord.name()
-    if co_nodata(tst_coord) != co_nodata(ref_coord):
+    if not coord_metadata_equal(ref_coord, tst_coord):
         msg = 'Coords {!r} have different metadata.'
         success, message = False, msg.format(coord_name)
-    else:
-        # Check the data-endpoint values (ignoring dimension directions).
-        ref_ends = coord_endpoint_values(ref_coord)
-        tst_ends = coord_endpoint_values(tst_coord)
+        return success, message
+
+    ref_print = coord_fingerprint(ref_coord)
+    tst_print = coord_fingerprint(tst_coord)
+    if ref_print.exact_match(tst_print):
+        # Identical values (and shapes) : a full match.
+        return success, message
+
+    if ref_print.canonical != tst_print.canonical:
+        # Not the same values in any orientation, so check the data-endpoint
+        # values (ignoring dimension directions).
+        ref_ends = ref_print.endpoints
+        tst_ends = tst_print.endpoints
         try:
-            same = np.allclose(tst_ends, ref_ends)
+            same = _values_close(tst_ends, ref_ends)
         except Exception as e:
             # Something nasty happens in here sometimes ?
             msg = 'np.allclose error : {}'
             success, message = False, msg.format(str(e))
             return success, message
 
-        if not np.allclose(tst_ends, ref_ends):
+        if not same:
             msg = 'Coords {!r} have significantly different values.'
             success, message = False, msg.format(coord_name)
-        else:
-            # Report any 'soft' differences preventing total equality.
-            if ref_coord.shape != tst_coord.shape:
-                msg = 'Coords {!r} have different shapes: {!r} and {!r}.'
-                message = msg.format(coord_name,
-                                     ref_coord.shape, tst_coord.shape)
-            elif ref_coord.has_bounds() != tst_coord.has_bounds():
-                msg = 'Boundedness of {!r} coord are different: {} and {}.'
-                message = msg.format(coord_name,
-                                     ref_coord.has_bounds(),
-                                     tst_coord.has_bounds())
-            elif np.any(ref_coord.points != tst_coord.points):
-                msg = 'Coords {!r} have different points arrays.'
-                message = msg.format(coord_name)
-            elif (ref_coord.has_bounds() and tst_coord.has_bounds()
-                  and np.any(ref_coord.bounds != tst_coord.bounds)):
-                msg = 'Coords {!r} have different bounds arrays.'
-                message = msg.format(coord_name)
-
-    if not message and tst_coord != ref_coord:
-        success, message = False, 'Unidentified difference?'
+            return success, message
+
+    # Report the 'soft' differences preventing total equality.
+    if ref_coord.shape != tst_coord.shape:
+        msg = 'Coords {!r} have different shapes: {!r} and {!r}.'
+        message = msg.format(coord_name,
+                             ref_coord.shape, tst_coord.shape)
+    elif ref_coord.has_bounds() != tst_coord.has_bounds():
+        msg = 'Boundedness of {!r} coord are different: {} and {}.'
+        message = msg.format(coord_name,
+                             ref_coord.has_bounds(),
+                             tst_coord.has_bounds())
+    elif (ref_print.canonical != tst_print.canonical and
+          (isinstance(ref_coord, StoredCoord) or
+           isinstance(tst_coord, StoredCoord))):
+        # Only the hashes of stored values are known.
+        msg = 'Coords {!r} values differ (hash only).'
+        message = msg.format(coord_name)
+    elif ref_print.points != tst_print.points:
+        msg = 'Coords {!r} have different points arrays.'
+        message = msg.format(coord_name)
+    else:
+        msg = 'Coords {!r} have different bounds arrays.'
+        message = msg.format(coord_name)
 
     return success, message
 
 
-def cubes_equal_without_data(c1, c2):
+# A pair of same-named coords from two cubes, with their cube dimensions.
+# 'exact' is True if the coords are already known to be exactly equal, apart
+# from their dimensions.
+CoordPair = namedtuple('CoordPair', ['name', 'ref_coord', 'ref_dims',
+                                     'tst_coord', 'tst_dims', 'exact'])
+
+
+def coords_by_name(cube):
+    # Return a dict of {name: coord} for all the coords of a cube.
+    return {coord.name(): coord for coord in cube.coords()}
+
+
+def _coord_difference(pair):
+    # Describe how the coords of a CoordPair are not exactly equal, or return
+    # None if they are.
+    if pair.ref_dims != pair.tst_dims:
+        return '{!r} has dimensions {} and {}'.format(pair.name,
+                                                      pair.ref_dims,
+                                                      pair.tst_dims)
+    if pair.exact:
+        return None
+    if not coord_metadata_equal(pair.ref_coord, pair.tst_coord):
+        return '{!r} has different metadata'.format(pair.name)
+    ref_print = coord_fingerprint(pair.ref_coord)
+    tst_print = coord_fingerprint(pair.tst_coord)
+    for kind, core_values in (('points', core_points),
+                              ('bounds', core_bounds)):
+        if getattr(ref_print, kind) != getattr(tst_print, kind):
+            msg = '{!r} has different {}'.format(pair.name, kind)
+            ref_values = core_values(pair.ref_coord)
+            tst_values = core_values(pair.tst_coord)
+            if (ref_values is not None and tst_values is not None and
+                    ref_values.shape == tst_values.shape):
+                # Say where, as for a big coord that can be hard to find.
+                index = first_difference(ref_values, tst_values,
+                                         equal_nan=True)
+                if index is not None:
+                    msg += ', first at index {}'.format(index)
+            return msg
+    return None
+
+
+@_stage('cubes_equal_without_data')
+def cubes_equal_without_data(c1, c2, coord_pairs=None):
     # Copy logic from Cube.__eq__, but don't compare (or fetch) actual data.
     # Return (True, '') for actual equality, (False, "<reason>") otherwise.
     #
     # In usage context, we already compared the metadata so it can't be that.
     # Compare the coords (exactly), and the data shape (not the actual data).
-    success, message = True, ''
-    coord_comparison = iris.analysis.coord_comparison(c1, c2)
-    coord_names = sorted(set(
-        [coord.name()
-         for grouptype in ('not_equal', 'non_equal_data_dimension')
-         for group in coord_comparison[grouptype]
-         for coord in group]))
-    if coord_names:
-        # There are any coordinates which are not fully equal.
-        msg = 'Coords {!r} do not compare.'
-        success, message = False, msg.format(coord_names)
-    if success:
-        # Compare data shapes (in lieu of actual data values).
-        if c1.shape != c2.shape:
-            success, message = False, 'different shapes'
-    return success, message
+    # The 'coord_pairs' are the CoordPair of every coord, if already known :
+    # otherwise the coords are paired up by name.
+    if coord_pairs is None:
+        ref_coords, tst_coords = coords_by_name(c1), coords_by_name(c2)
+        unpaired = sorted(set(ref_coords) ^ set(tst_coords))
+        if unpaired:
+            msg = 'Coords {!r} do not compare: not in both cubes.'
+            return False, msg.format(unpaired)
+        coord_pairs = [CoordPair(name, ref_coords[name],
+                                 c1.coord_dims(ref_coords[name]),
+                                 tst_coords[name],
+                                 c2.coord_dims(tst_coords[name]),
+                                 False)
+                       for name in sorted(ref_coords)]
+    differences = [(pair.name, _coord_difference(pair))
+                   for pair in coord_pairs]
+    differences = [(name, difference) for name, difference in differences
+                   if difference is not None]
+    if differences:
+        # There are some coordinates which are not fully equal.
+        msg = 'Coords {!r} do not compare: {}.'
+        return False, msg.format([name for name, _ in differences],
+                                 '; '.join(difference
+                                           for _, difference in differences))
+    # Compare data shapes (in lieu of actual data values).
+    if c1.shape != c2.shape:
+        return False, 'different shapes'
+    return True, ''
+
+
+def dimension_coords_map(ndim, coord_dims):
+    # Return a dict of {dim: frozenset of names of coords mapped to dim}, for
+    # a cube of 'ndim' dimensions with coords of {name: dims} 'coord_dims'.
+    per_dim_coords = {dim:set() for dim in range(ndim)}
+    for name, dims in coord_dims.items():
+        for dim in dims:
+            # Include in the set of coords mapping to this dimension.
+            per_dim_coords[dim].add(name)
+    # Return a dict with all the values recast as frozen sets, so we can
+    # more easily make sets of those.
+    return {dim:frozenset(coords_set)
+            for dim, coords_set in per_dim_coords.items()}
+
+
+class CubeSummary(object):
+    # The properties of a cube which 'compare_cubes' uses, worked out once.
+    # * 'coords' : {name: coord}, and 'names' : the sorted coord names.
+    # * 'coord_dims' : {name: cube dims of the coord}.
+    # * 'dim_coords' : {dim: frozenset of names of coords mapped to dim}, see
+    #   'dimension_coords_map', and 'dim_groups' : the set of those.
+    # * 'metadata_key', 'signature' : see 'cube_signature'.
+    # The corner points of coords are only calculated when first used, by
+    # the 'corners' method.
+    @_stage('cube_summary')
+    def __init__(self, cube):
+        self.cube = cube
+        coords = cube.coords()
+        self.coords = {coord.name(): coord for coord in coords}
+        # Just check that all coords have different names, by which we can
+        # identify them, the contrary is very undesirable and confusing !
+        assert len(self.coords) == len(coords)
+        self.names = sorted(self.coords)
+        self.coord_dims = {name: cube.coord_dims(coord)
+                           for name, coord in self.coords.items()}
+        self.dim_coords = dimension_coords_map(cube.ndim, self.coord_dims)
+        self.dim_groups = frozenset(self.dim_coords.values())
+        self.metadata_key = (cube.standard_name, cube.long_name,
+                             cube.var_name,
+                             tuple(sorted(cube.attributes.keys())))
+        self.signature = (self.metadata_key, tuple(sorted(cube.shape)),
+                          tuple(self.names), self.dim_groups)
+        self._corners = {}
+
+    def corners(self, name):
+        # The corner points of a coord (see '_coord_corners').
+        if name not in self._corners:
+            self._corners[name] = _coord_corners(self.coords[name])
+        return self._corners[name]
+
 
+@contextlib.contextmanager
+def summaries_cached():
+    # Within this context, the CubeSummary of each cube object is only
+    # calculated once.
+    global _SUMMARIES
+    outer = _SUMMARIES
+    if outer is None:
+        _SUMMARIES = {}
+    try:
+        yield
+    finally:
+        _SUMMARIES = outer
 
-def compare_cubes(c1, c2):
+
+def cube_summary(cube):
+    # Return the CubeSummary of a cube, memoised within 'summaries_cached'.
+    # A CubeSummary is returned as it is.
+    if isinstance(cube, CubeSummary):
+        return cube
+    return _memoised(_SUMMARIES, cube, CubeSummary)
+
+
+def cube_signature(cube):
+    # Return a cheap, hashable and order-insensitive key for a cube.
+    # Any two cubes that 'compare_cubes' can match always have the same
+    # signature, so only cubes with equal signatures need comparing at all.
+    # NOTE: the metadata part is deliberately coarse (names and attribute
+    # keys only), as attribute values and units need not be hashable, and
+    # may compare equal without having identical representations.
+    return cube_summary(cube).signature
+
+
+# The parts of a cube signature, as (kind, function of signature), which are
+# compared as multisets between cubelists, to summarise their differences.
+_SIGNATURE_PARTS = (
+    ('names', lambda signature: next((name for name in signature[0][:3]
+                                      if name is not None), 'unknown')),
+    ('metadata', lambda signature: signature[0]),
+    ('shapes', lambda signature: signature[1]),
+    ('coords', lambda signature: signature[2]),
+    ('dimension coords', lambda signature: tuple(sorted(
+        tuple(sorted(group)) for group in signature[3]))),
+)
+
+
+# A difference in one kind of cube property between two cubelists : the
+# 'only_in_1' and 'only_in_2' are Counters of the unmatched values.
+CubelistMismatch = namedtuple('CubelistMismatch',
+                              ['kind', 'only_in_1', 'only_in_2'])
+
+
+@_stage('cubelist_prefilter')
+def signature_mismatches(signatures1, signatures2):
+    # Return a list of CubelistMismatch, for the parts of two lists of cube
+    # signatures which are different as multisets, i.e. regardless of order.
+    # If there are none, the signatures are the same (as multisets), except
+    # possibly in how the parts are combined.
+    mismatches = []
+    for kind, part in _SIGNATURE_PARTS:
+        counts1 = Counter(part(signature) for signature in signatures1)
+        counts2 = Counter(part(signature) for signature in signatures2)
+        if counts1 != counts2:
+            mismatches.append(CubelistMismatch(kind, counts1 - counts2,
+                                               counts2 - counts1))
+    return mismatches
+
+
+def cubelist_mismatches(cl1, cl2):
+    # Return a list of CubelistMismatch for two cubelists (see
+    # 'signature_mismatches') : a quick check which never needs to look at
+    # any coordinate values or data.
+    return signature_mismatches([cube_signature(cube) for cube in cl1],
+                                [cube_signature(cube) for cube in cl2])
+
+
+def _counter_summary(counts):
+    # Describe the contents of a Counter, in a consistent order.
+    items = sorted(counts.items(), key=lambda item: repr(item[0]))
+    texts = ['{!r}'.format(value) if count == 1 else
+             '{} x {!r}'.format(count, value)
+             for value, count in items[:MAX_LISTED_DIFFERENCES]]
+    if len(items) > MAX_LISTED_DIFFERENCES:
+        texts.append('...')
+    return '[' + ', '.join(texts) + ']'
+
+
+def mismatches_summary(mismatches):
+    # Return a description of a list of CubelistMismatch.
+    lines = ['  {} : only in #1 = {}, only in #2 = {}'.format(
+                 mismatch.kind, _counter_summary(mismatch.only_in_1),
+                 _counter_summary(mismatch.only_in_2))
+             for mismatch in mismatches]
+    return '\n'.join(lines)
+
+
+def core_data(cube):
+    # Return the data array of a cube, without realising it if lazy.
+    if hasattr(cube, 'core_data'):
+        return cube.core_data()
+    if cube.has_lazy_data():
+        return cube.lazy_data()
+    return cube.data
+
+
+# Guarding against realising lazy arrays.
+#
+# The comparisons should never realise the lazy data or coord values of a
+# cube, only fetch sections of them, as one realised array of a large file
+# can take gigabytes.  A "guarded" comparison (see 'compare_cubes' and
+# 'compare_cubelists') raises a LazyRealisationError if it did any of :
+# * leave any array of its cubes real which was lazy before.
+# * fetch more than a block of values at once (see '_iter_blocks').
+# * compute any dask array other than by the comparisons' own fetches (see
+#   '_realise'), as e.g. an equality test or np.asarray of a lazy array
+#   would, even without keeping the result.
+# N.B. dask computes in other threads, during a guarded comparison, are
+# also counted.
+
+class LazyRealisationError(AssertionError):
+    # A guarded comparison realised some lazy cube data or coord values.
+    pass
+
+
+# The active lazy guards, and whether '_realise' is computing.
+_GUARDS = []
+_FETCHING = False
+
+
+class _LazyGuard(object):
+    # The record of a guarded comparison.
+    def __init__(self, cubes):
+        # The lazy arrays of the cubes at the start, see '_lazy_parts'.
+        self.parts = _lazy_parts(cubes)
+        # The sizes of fetches bigger than a block.
+        self.big_fetches = []
+        # The number of dask computes not by '_realise'.
+        self.other_computes = 0
+
+    def failures(self):
+        # Return a list of descriptions of how the lazy arrays were realised.
+        realised = [description for description, core_array in self.parts
+                    if not _is_lazy(core_array())]
+        failures = realised[:MAX_LISTED_DIFFERENCES]
+        if len(realised) > MAX_LISTED_DIFFERENCES:
+            failures.append('...')
+        if self.big_fetches:
+            failures.append('{} fetches of more than a block, of up to {} '
+                            'values'.format(len(self.big_fetches),
+                                            max(self.big_fetches)))
+        if self.other_computes:
+            failures.append('{} computes not by block-wise fetches'.format(
+                self.other_computes))
+        return failures
+
+
+def _check_fetch(array):
+    # Record, in the active lazy guards, a fetch bigger than a block.
+    # N.B. '_iter_blocks' fetches whole rows, even if one is bigger.
+    size = np.size(array)
+    row_size = np.prod(np.shape(array)[1:], dtype=np.int64)
+    if size > BLOCK_SIZE and size > row_size:
+        for guard in _GUARDS:
+            guard.big_fetches.append(int(size))
+
+
+if DaskCallback is not None:
+    class _ComputeWatcher(DaskCallback):
+        # Record, in the active lazy guards, each dask compute not done by
+        # '_realise'.
+        def _start(self, dsk):
+            if not _FETCHING:
+                for guard in _GUARDS:
+                    guard.other_computes += 1
+
+    _COMPUTE_WATCHER = _ComputeWatcher()
+
+
+def _lazy_parts(cubes):
+    # Return a list of (description, get-array) for each lazy array of some
+    # cubes (or CubeSummaries) : their data, and coord points and bounds.
+    parts = []
+    for cube in cubes:
+        cube = getattr(cube, 'cube', cube)
+        if _is_lazy(core_data(cube)):
+            parts.append(('cube {!r} data'.format(cube.name()),
+                          functools.partial(core_data, cube)))
+        for coord in cube.coords():
+            for kind, core_values in (('points', core_points),
+                                      ('bounds', core_bounds)):
+                if _is_lazy(core_values(coord)):
+                    description = 'cube {!r} coord {!r} {}'.format(
+                        cube.name(), coord.name(), kind)
+                    parts.append((description,
+                                  functools.partial(core_values, coord)))
+    return parts
+
+
+@contextlib.contextmanager
+def _lazy_guard(cubes):
+    # Raise a LazyRealisationError if the block realised any lazy array of
+    # the cubes.  Not if the block raised an error itself.
+    guard = _LazyGuard(cubes)
+    if not _GUARDS and DaskCallback is not None:
+        _COMPUTE_WATCHER.register()
+    _GUARDS.append(guard)
+    try:
+        yield
+    finally:
+        _GUARDS.remove(guard)
+        if not _GUARDS and DaskCallback is not None:
+            _COMPUTE_WATCHER.unregister()
+    failures = guard.failures()
+    if failures:
+        raise LazyRealisationError('Comparison realised lazy values : ' +
+                                   ', '.join(failures) + '.')
+
+
+# How the dimensions of a test cube map onto those of a reference cube :
+# 'dims[i]' is the test cube dimension matching reference cube dimension i,
+# and 'flips[i]' is True if it runs in the opposite direction.
+DimensionMapping = namedtuple('DimensionMapping', ['dims', 'flips'])
+
+
+def mapped_array(tst_array, ref_dims, tst_dims, mapping):
+    # Return a view of a test coord array (points or bounds), transposed and
+    # flipped to match the dims of the reference coord, according to the
+    # DimensionMapping of their cubes.
+    # Returns None if the coords' cube dims do not correspond.
+    if len(ref_dims) != len(tst_dims):
+        return None
+    axes = []
+    for ref_dim in ref_dims:
+        tst_dim = mapping.dims[ref_dim]
+        if tst_dim not in tst_dims:
+            return None
+        axes.append(tst_dims.index(tst_dim))
+    flips = [False] * len(tst_dims)
+    for ref_dim, axis in zip(ref_dims, axes):
+        flips[axis] = mapping.flips[ref_dim]
+    return reoriented(tst_array, flips, axes)
+
+
+def _values_difference(kind, ref_array, tst_array, sort_last=False):
+    # Describe the first difference between the values of two (possibly
+    # lazy) coord arrays, or return None if they are all close (as for
+    # np.allclose).
+    if tst_array is None or ref_array.shape != tst_array.shape:
+        return '{} cannot be aligned'.format(kind)
+    index = first_difference(ref_array, tst_array,
+                             rtol=DATA_RTOL, atol=DATA_ATOL,
+                             sort_last=sort_last)
+    if index is not None:
+        return '{} first differ at index {}'.format(kind, index)
+    return None
+
+
+@_stage('coord_values')
+def coord_values_difference(ref_coord, ref_dims, tst_coord, tst_dims,
+                            mapping):
+    # Compare all the points and bounds of two coords, after transposing and
+    # flipping the test coord to match the reference one, according to the
+    # DimensionMapping of their cubes.
+    # Returns None if they match, or else a description of the first
+    # difference.
+    # This compares views of the arrays, a block at a time, so it makes no
+    # full-size copies and does not realise lazy arrays.
+    if isinstance(ref_coord, StoredCoord) or isinstance(tst_coord,
+                                                        StoredCoord):
+        # There are no values to compare, so all we can check is that they
+        # are the same in some orientation.
+        if (coord_fingerprint(ref_coord).canonical ==
+                coord_fingerprint(tst_coord).canonical):
+            return None
+        # Any change in the values, however small, changes their hash, so
+        # that alone is only a soft difference (see 'compare_coords') if
+        # the corner points still match, in the same kind of values.
+        ref_corners = _coord_corners(ref_coord)
+        tst_corners = mapped_array(_coord_corners(tst_coord), ref_dims,
+                                   tst_dims, mapping)
+        if (tst_corners is not None and
+                tst_corners.shape == ref_corners.shape and
+                (ref_corners.dtype == tst_corners.dtype or
+                 _is_numeric(ref_corners) and _is_numeric(tst_corners)) and
+                _values_close(ref_corners, tst_corners)):
+            return None
+        return ('values are not stored, and their hashes and corner points '
+                'differ')
+    tst_points = mapped_array(core_points(tst_coord), ref_dims, tst_dims,
+                              mapping)
+    difference = _values_difference('points', core_points(ref_coord),
+                                    tst_points)
+    if (difference is None and
+            ref_coord.has_bounds() and tst_coord.has_bounds()):
+        tst_bounds = mapped_array(core_bounds(tst_coord), ref_dims, tst_dims,
+                                  mapping)
+        difference = _values_difference('bounds', core_bounds(ref_coord),
+                                        tst_bounds, sort_last=True)
+    return difference
+
+
+def _coords_corners_match(ref, tst, name, mapping):
+    # Cheaply check a possible mapping, by comparing just the corner points
+    # of a coord in two CubeSummary under it.
+    # N.B. the corners of a transposed and flipped array are the corners of
+    # the original, transposed and flipped, so this needs no other values.
+    ref_corners = ref.corners(name)
+    tst_corners = mapped_array(tst.corners(name), ref.coord_dims[name],
+                               tst.coord_dims[name], mapping)
+    if tst_corners is None or tst_corners.shape != ref_corners.shape:
+        return False
+    return _values_close(ref_corners, tst_corners)
+
+
+@_stage('compare_data')
+def compare_data(c1, c2, mapping, rtol=DATA_RTOL, atol=DATA_ATOL):
+    # Compare the data of two cubes, after transposing and flipping that of
+    # c2 according to the DimensionMapping of c2 onto c1.
+    # The data is fetched and compared a block at a time, stopping at the
+    # first difference, so memory use is bounded and lazy data is never
+    # realised as a whole.
+    # Values must match within the tolerances (as for np.allclose), and any
+    # masks and fill-values must be the same.
+    # Returns (success, message), with an empty message for a match.
+    ref_data = core_data(c1)
+    tst_data = mapped_array(core_data(c2), tuple(range(c2.ndim)),
+                            tuple(range(c2.ndim)), mapping)
+    if tst_data is None or tst_data.shape != ref_data.shape:
+        return False, 'Cube data cannot be aligned.'
+    for start, ref_block, tst_block in _iter_block_pairs(ref_data, tst_data):
+        ref_mask = np.ma.getmaskarray(ref_block)
+        tst_mask = np.ma.getmaskarray(tst_block)
+        if (np.ma.isMaskedArray(ref_block) and
+                np.ma.isMaskedArray(tst_block) and
+                ref_block.fill_value != tst_block.fill_value):
+            msg = 'Cube {!r} data has different fill-values.'
+            return False, msg.format(c1.name())
+        problem, index = 'masks', _first_index(ref_mask != tst_mask, start)
+        if index is None:
+            differs = ~np.isclose(np.ma.getdata(tst_block),
+                                  np.ma.getdata(ref_block),
+                                  rtol=rtol, atol=atol)
+            problem, index = 'values', _first_index(differs & ~ref_mask,
+                                                    start)
+        if index is not None:
+            msg = 'Cube {!r} data has different {}, first at index {}.'
+            return False, msg.format(c1.name(), problem, index)
+    return True, ''
+
+
+@_stage('dimension_mapping')
+def solve_dimension_mapping(c1, c2):
+    # Work out the DimensionMapping of cube c2 onto cube c1.
+    # Either may also be a CubeSummary.
+    # Returns None if there is no possible mapping.
+    # Dimensions correspond if they have the same length and the same set of
+    # coords (see 'dimension_coords_map').  The direction of each is found
+    # from any one-dimensional coord on it.  Where that leaves more than one
+    # possibility, we pick the first under which the corners of all the
+    # multidimensional coords match.
+    ref, tst = cube_summary(c1), cube_summary(c2)
+    ref_shape, tst_shape = ref.cube.shape, tst.cube.shape
+    candidates = []
+    for ref_dim in range(len(ref_shape)):
+        tst_dims = [tst_dim for tst_dim in range(len(tst_shape))
+                    if (tst.dim_coords[tst_dim] == ref.dim_coords[ref_dim] and
+                        tst_shape[tst_dim] == ref_shape[ref_dim])]
+        if not tst_dims:
+            return None
+        candidates.append(tst_dims)
+
+    common_names = sorted(set(ref.coords) & set(tst.coords))
+    multidim_names = [name for name in common_names
+                      if len(ref.coord_dims[name]) > 1]
+
+    flip_results = {}
+
+    def dim_flip(ref_dim, tst_dim):
+        # Return whether a dimension is flipped, or None if we can't tell.
+        key = (ref_dim, tst_dim)
+        if key not in flip_results:
+            flip_results[key] = None
+            for name in common_names:
+                if (ref.coord_dims[name] != (ref_dim,) or
+                        tst.coord_dims[name] != (tst_dim,)):
+                    continue
+                ref_ends = ref.corners(name)
+                tst_ends = tst.corners(name)
+                if len(ref_ends) < 2 or len(tst_ends) != len(ref_ends):
+                    continue
+                same = _values_close(ref_ends, tst_ends)
+                flipped = _values_close(ref_ends, tst_ends[::-1])
+                if same != flipped:
+                    flip_results[key] = flipped
+                    break
+        return flip_results[key]
+
+    first_mapping = None
+    n_tried = 0
+    for dims in itertools.product(*candidates):
+        if len(set(dims)) != len(dims):
+            continue
+        flips = [dim_flip(ref_dim, tst_dim)
+                 for ref_dim, tst_dim in enumerate(dims)]
+        undecided = [ref_dim for ref_dim, flip in enumerate(flips)
+                     if flip is None]
+        for choice in itertools.product((False, True),
+                                        repeat=len(undecided)):
+            for ref_dim, flip in zip(undecided, choice):
+                flips[ref_dim] = flip
+            mapping = DimensionMapping(tuple(dims), tuple(flips))
+            if first_mapping is None:
+                first_mapping = mapping
+            if all(_coords_corners_match(ref, tst, name, mapping)
+                   for name in multidim_names):
+                return mapping
+            n_tried += 1
+            if n_tried >= MAX_MAPPING_CANDIDATES:
+                return first_mapping
+    return first_mapping
+
+
+def compare_cubes(c1, c2, check_data=False,
+                  rtol=DATA_RTOL, atol=DATA_ATOL, guard_lazy=False):
+    # If 'check_data' is set, also compare the data values, within the given
+    # tolerances (see 'compare_data').
+    # Either cube may also be given as its CubeSummary.
+    # If 'guard_lazy' is set, raise a LazyRealisationError if the comparison
+    # realises any lazy data or coord values of the cubes.
+    if guard_lazy:
+        with _lazy_guard([c1, c2]):
+            return _compare_cubes(c1, c2, check_data=check_data,
+                                  rtol=rtol, atol=atol)
+    return _compare_cubes(c1, c2, check_data=check_data, rtol=rtol, atol=atol)
+
+
+@_stage('compare_cubes')
+def _compare_cubes(c1, c2, check_data=False,
+                   rtol=DATA_RTOL, atol=DATA_ATOL):
     import numpy as np
 
+    ref, tst = cube_summary(c1), cube_summary(c2)
+    c1, c2 = ref.cube, tst.cube
     difference_msgs = []
 
     # Test sorted shapes, not actual, to allow flexible dimension ordering.
@@ -138,12 +1323,8 @@ def compare_cubes(c1, c2):
     # Check they have essentially the same list of coordinates.
     #
     # get coords sorted by name.
-    ref_names = sorted([c.name() for c in c1.coords()])
-    tst_names = sorted([c.name() for c in c2.coords()])
-    # Just check that all coords have different names, by which we can identify
-    # them, the contrary is very undesirable and confusing !
-    assert len(set(ref_names)) == len(ref_names)
-    assert len(set(tst_names)) == len(tst_names)
+    ref_names = ref.names
+    tst_names = tst.names
     if tst_names != ref_names:
         # Don't have the 'same' coords overall : Try to explain the difference.
         result_msg = 'Cubes have different sets of coords: '
@@ -162,47 +1343,57 @@ def compare_cubes(c1, c2):
     coord_names = ref_names
 
     # Check that the coord dimension mappings are equivalent.
-    def dimension_coords_map(cube):
-        # Return a dict of {dim: sorted tuple of coords mapped to dim}.
-        per_dim_coords = {dim:set() for dim in range(cube.ndim)}
-        for coord in cube.coords():
-            for dim in cube.coord_dims(coord):
-                # Include in the set of coords mapping to this dimension.
-                per_dim_coords[dim].add(coord.name())
-        # Return a dict with all the values recast as frozen sets, so we can
-        # more easily make sets of those.
-        return {dim:frozenset(coords_set)
-                for dim, coords_set in per_dim_coords.items()}
-
-    ref_dim_coords = dimension_coords_map(c1)
-    tst_dim_coords = dimension_coords_map(c2)
-    ref_coord_dim_groups = set(coords for coords in ref_dim_coords.values())
-    tst_coord_dim_groups = set(coords for coords in tst_dim_coords.values())
-    if ref_coord_dim_groups != tst_coord_dim_groups:
+    if ref.dim_groups != tst.dim_groups:
         # Note: this allows dimensions to appear in a different order in the
         # cube, or in a multidimensional coordinate.
         return False, 'Cubes have incompatible dimension mappings.'
-    elif ref_dim_coords != tst_dim_coords:
+    elif ref.dim_coords != tst.dim_coords:
         difference_msgs.append('Cubes have different dimension orders')
 
+    # Work out how the dimensions correspond, including their directions.
+    mapping = solve_dimension_mapping(ref, tst)
+
     # Finally compare the coords themselves, but allowing for possible
     # different dimension orderings and inverted dimension directions.
+    coord_pairs = []
     for name in coord_names:
-        ref_coord, tst_coord = (cube.coord(name) for cube in (c1, c2))
+        ref_coord, tst_coord = ref.coords[name], tst.coords[name]
+        ref_dims, tst_dims = ref.coord_dims[name], tst.coord_dims[name]
         match, result_msg = compare_coords(ref_coord, tst_coord)
         if not match:
             return False, result_msg
         elif result_msg:
+            # A 'soft' match : check that all the values really are the same,
+            # once we allow for the dimension order and directions.
+            difference = None
+            if mapping is not None:
+                difference = coord_values_difference(
+                    ref_coord, ref_dims, tst_coord, tst_dims, mapping)
+            if difference is not None:
+                msg = ('Coords {!r} have different values, even allowing '
+                       'for dimension order and direction : {}.')
+                return False, msg.format(name, difference)
             difference_msgs.append(result_msg)
-        elif ref_coord != tst_coord:
-            msg = 'Coords {} have unidentified difference?'
-            difference_msgs.append(msg.format(ref_coord.name()))
+        coord_pairs.append(CoordPair(name, ref_coord, ref_dims,
+                                     tst_coord, tst_dims, not result_msg))
+
+    if check_data:
+        if (mapping is None or core_data(c1) is None or
+                core_data(c2) is None):
+            # N.B. a StoredCube has no data.
+            difference_msgs.append('Cube data not compared')
+        else:
+            match, result_msg = compare_data(c1, c2, mapping,
+                                             rtol=rtol, atol=atol)
+            if not match:
+                return False, result_msg
 
     message = '; '.join(difference_msgs) or ''
 
     if not message:
         # Check if something doesn't match that we didn't already diagnose.
-        result, exact_message = cubes_equal_without_data(c1, c2)
+        result, exact_message = cubes_equal_without_data(c1, c2,
+                                                         coord_pairs)
         if not result:
             assert exact_message
             message = exact_message
@@ -210,25 +1401,538 @@ def compare_cubes(c1, c2):
     return True, message
 
 
-def compare_cubelists(cl1, cl2):
+# Metadata hashing, for the columnar cubelist join.
+
+def _canonical_text(value):
+    # Return a text standing for a metadata value, such that values which
+    # compare equal always give the same text (though unequal ones may too).
+    # Numbers are all treated as floats, and lists, tuples and arrays alike.
+    # Objects of other types are only distinguished by their type, unless
+    # they have an '_identity' (iris cell methods) or are compared by their
+    # attributes (iris coordinate systems).
+    if value is None:
+        return u'None'
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    if isinstance(value, type(u'')):
+        return u'"' + value + u'"'
+    if isinstance(value, numbers.Real):
+        return type(u'')(repr(float(value)))
+    if isinstance(value, numbers.Complex):
+        return type(u'')(repr(complex(value)))
+    if isinstance(value, Mapping):
+        items = sorted((_canonical_text(key), _canonical_text(item))
+                       for key, item in value.items())
+        return u'{' + u','.join(key + u':' + item
+                                for key, item in items) + u'}'
+    if isinstance(value, np.ndarray):
+        return _canonical_text(value.tolist())
+    if isinstance(value, (list, tuple)):
+        return u'[' + u','.join(_canonical_text(item)
+                                for item in value) + u']'
+    name = type(value).__name__
+    if hasattr(value, '_identity'):
+        return name + _canonical_text(value._identity())
+    if hasattr(value, 'definition') and hasattr(value, 'calendar'):
+        # Units.
+        return name + _canonical_text((value.definition, value.calendar))
+    if isinstance(value, CoordSystem):
+        # These compare by all their attributes, except for caches.
+        return name + _canonical_text(
+            {key: item for key, item in vars(value).items()
+             if key not in _COORD_SYSTEM_CACHES})
+    return name
+
+
+def _metadata_hash(values):
+    # Return a 63-bit integer hash of a tuple of metadata values.
+    text = _canonical_text(tuple(values))
+    return int(hashlib.sha1(text.encode('utf-8')).hexdigest()[:15], 16)
+
+
+class CubelistTable(object):
+    # A columnar summary of a cubelist, for finding the possible matches of
+    # its cubes with those of another all at once, by array operations.
+    # * 'cube_keys' : a hash for each cube of what must be the same for
+    #   'compare_cubes' to match two cubes, i.e. the cube signature and
+    #   metadata, and the names and metadata of its coords.
+    # * one row per coord, grouped by cube in order, and by name within each
+    #   cube ('coord_start' indexes the first row of each cube) : 'coord_min'
+    #   and 'coord_max', the range of its corner points ; 'coord_ndim' ;
+    #   'coord_bounded' ; and 'coord_numeric' (if False, the range is NaN).
+    @_stage('cubelist_table')
+    def __init__(self, cubes):
+        self.summaries = [cube_summary(cube) for cube in cubes]
+        cube_keys = []
+        starts, rows = [], []
+        for summary in self.summaries:
+            cube = summary.cube
+            coord_keys = []
+            starts.append(len(rows))
+            for name in summary.names:
+                coord = summary.coords[name]
+                coord_keys.append(_metadata_hash(
+                    (name,) + coord_metadata(coord)))
+                corners = summary.corners(name)
+                numeric = corners.dtype.kind in 'biuf' and corners.size > 0
+                if numeric:
+                    corners = np.asarray(corners, dtype=np.float64)
+                    low, high = corners.min(), corners.max()
+                else:
+                    low, high = np.nan, np.nan
+                rows.append((low, high, coord.ndim, coord.has_bounds(),
+                             numeric))
+            metadata_key, shape, names, dim_groups = summary.signature
+            dim_groups = sorted(sorted(group) for group in dim_groups)
+            cube_keys.append(_metadata_hash(
+                (metadata_key, shape, names, dim_groups, cube.units,
+                 cube.attributes, cube.cell_methods, coord_keys)))
+        self.cube_keys = np.array(cube_keys, dtype=np.int64)
+        self.coord_start = np.array(starts, dtype=np.int64)
+        self.n_coords = np.array([len(summary.names)
+                                  for summary in self.summaries],
+                                 dtype=np.int64)
+        columns = list(zip(*rows)) or [[]] * 5
+        self.coord_min = np.array(columns[0], dtype=np.float64)
+        self.coord_max = np.array(columns[1], dtype=np.float64)
+        self.coord_ndim = np.array(columns[2], dtype=np.int64)
+        self.coord_bounded = np.array(columns[3], dtype=bool)
+        self.coord_numeric = np.array(columns[4], dtype=bool)
+
+    @_stage('table_join')
+    def candidate_pairs(self, other):
+        """
+        Return the possible matches of the cubes of this table with those of
+        another, as arrays of (index here, index in other).
+
+        Pairs must have the same cube key, and the same range of values
+        for every numeric coord of the same dimensionality and boundedness,
+        as 'compare_coords' would need.  Other pairs cannot match.
+
+        """
+        # Join on the cube keys.
+        order = np.argsort(other.cube_keys, kind='mergesort')
+        sorted_keys = other.cube_keys[order]
+        lows = np.searchsorted(sorted_keys, self.cube_keys, side='left')
+        counts = np.searchsorted(sorted_keys, self.cube_keys,
+                                 side='right') - lows
+        i_self = np.repeat(np.arange(len(self.cube_keys)), counts)
+        i_other = order[_concatenated_ranges(lows, counts)]
+
+        # Check the coord values of the pairs.  Paired cubes have the same
+        # coord names, so their coord rows correspond.
+        n_coords = self.n_coords[i_self]
+        rows_self = _concatenated_ranges(self.coord_start[i_self], n_coords)
+        rows_other = _concatenated_ranges(other.coord_start[i_other],
+                                          n_coords)
+        comparable = (self.coord_numeric[rows_self] &
+                      other.coord_numeric[rows_other] &
+                      (self.coord_ndim[rows_self] ==
+                       other.coord_ndim[rows_other]) &
+                      (self.coord_bounded[rows_self] ==
+                       other.coord_bounded[rows_other]))
+        # N.B. the same test as np.allclose(tst, ref) in 'compare_coords'.
+        same_range = (np.isclose(other.coord_min[rows_other],
+                                 self.coord_min[rows_self], equal_nan=True) &
+                      np.isclose(other.coord_max[rows_other],
+                                 self.coord_max[rows_self], equal_nan=True))
+        rows_ok = ~comparable | same_range
+        pairs_ok = np.ones(len(i_self), dtype=bool)
+        has_coords = n_coords > 0
+        if np.any(has_coords):
+            offsets = (np.cumsum(n_coords) - n_coords)[has_coords]
+            pairs_ok[has_coords] = np.logical_and.reduceat(rows_ok, offsets)
+        return i_self[pairs_ok], i_other[pairs_ok]
+
+
+def _concatenated_ranges(starts, counts):
+    # Return the concatenation of the ranges [start, start + count).
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return (np.arange(np.sum(counts), dtype=np.int64) - offsets +
+            np.repeat(starts, counts))
+
+
+def compare_cubelists(cl1, cl2, check_data=False,
+                      rtol=DATA_RTOL, atol=DATA_ATOL, columnar=False,
+                      guard_lazy=False):
+    # If 'check_data' is set, also compare cube data (see 'compare_cubes').
+    # If 'columnar' is set, the possible cube pairs are first found all at
+    # once, from tables of the cube and coord properties (see
+    # 'CubelistTable'), so that only those pairs need comparing as objects.
+    # If 'guard_lazy' is set, raise a LazyRealisationError if the comparison
+    # realises any lazy data or coord values of the cubes.
+    if guard_lazy:
+        with _lazy_guard(list(cl1) + list(cl2)):
+            return compare_cubelists(cl1, cl2, check_data=check_data,
+                                     rtol=rtol, atol=atol, columnar=columnar)
+    # Fingerprint each coord, and summarise each cube, only once, however
+    # many comparisons it is in.
+    with fingerprints_cached(), summaries_cached():
+        return _compare_cubelists(cl1, cl2, check_data=check_data,
+                                  rtol=rtol, atol=atol, columnar=columnar)
+
+
+@_stage('compare_cubelists')
+def _compare_cubelists(cl1, cl2, check_data=False,
+                       rtol=DATA_RTOL, atol=DATA_ATOL, columnar=False):
+    # First compare cheap properties of all the cubes, regardless of order,
+    # and only compare cubes in detail if those all match.
+    summaries1 = [cube_summary(c1) for c1 in cl1]
+    summaries2 = [cube_summary(c2) for c2 in cl2]
+    signatures1 = [summary.signature for summary in summaries1]
+    signatures2 = [summary.signature for summary in summaries2]
+    mismatches = signature_mismatches(signatures1, signatures2)
     if len(cl1) != len(cl2):
-        return False, 'cubelists of different lengths'
-    set1 = set(cl1)
-    set2 = set(cl2)
+        msg = 'cubelists of different lengths : {} != {}'.format(len(cl1),
+                                                               len(cl2))
+        if mismatches:
+            msg += '\n' + mismatches_summary(mismatches)
+        return False, msg
+    if mismatches:
+        return False, ('cubelists have different cubes :\n' +
+                       mismatches_summary(mismatches))
+    # Each cube of the first list is only compared with its plausible
+    # partners, instead of with every remaining cube.
+    if columnar:
+        # The pairs which the cube and coord tables allow.
+        candidates = [[] for _ in summaries1]
+        for i1, i2 in zip(*CubelistTable(summaries1).candidate_pairs(
+                CubelistTable(summaries2))):
+            candidates[i1].append(i2)
+    else:
+        # Cubes with the same signature.
+        buckets = {}
+        for i2, summary2 in enumerate(summaries2):
+            buckets.setdefault(summary2.signature, []).append(i2)
+        candidates = [buckets.get(summary1.signature, [])
+                      for summary1 in summaries1]
+    # The indices of the cubes of the second list already matched.
+    matched = set()
     result_pairs = []
     messages = []
-    for c1 in set1:
+    for summary1, i2_candidates in zip(summaries1, candidates):
         found = False
-        for c2 in list(set2):
-            found, message = compare_cubes(c1, c2)
+        for i2 in i2_candidates:
+            if i2 in matched:
+                continue
+            summary2 = summaries2[i2]
+            found, message = compare_cubes(summary1, summary2,
+                                           check_data=check_data,
+                                           rtol=rtol, atol=atol)
             if found:
-                set2.remove(c2)
-                result_pairs.append((c1, c2))
+                matched.add(i2)
+                result_pairs.append((summary1.cube, summary2.cube))
                 if message:
                     messages.append(message)
                 break
         if not found:
             msg = 'cube#1:\n{}\n\n.. not found in ..\n\n{}'
-            return False, msg.format(c1, cl2)
-    assert set2 == set()
+            return False, msg.format(summary1.cube, cl2)
+    assert len(matched) == len(summaries2)
     return True, '; '.join(messages)
+
+
+# Stored cube summaries.
+#
+# A StoredCube records, without any data, all that the comparisons need of a
+# cube : its metadata, shape and coords, and for each coord its metadata,
+# shape, fingerprint and corner points (but not its points or bounds).
+# It converts to and from a JSON-compatible dict, so that the results of a
+# load can be saved and later compared with another load, e.g. by another
+# iris version, without loading the file again.
+# Anything which takes cubes, such as 'compare_cubelists', also takes
+# StoredCubes.  As they have no values, their coords can only be compared by
+# fingerprint and corners, and their data not at all.
+
+class _UnknownValue(object):
+    # A stored metadata value of a type we cannot restore.  It is unequal to
+    # anything, so that comparisons with it fail rather than pass.
+    def __init__(self, text):
+        self.text = text
+
+    def __eq__(self, other):
+        return False
+
+    def __ne__(self, other):
+        return True
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<unknown value {}>'.format(self.text)
+
+
+def _encoded(value):
+    # Return a JSON-compatible form of a metadata value, see '_decoded'.
+    # Anything other than None, bools, numbers, text and lists is stored as
+    # a dict, tagged with its type.
+    if value is None or isinstance(value, (bool, int, float, type(u''))):
+        return value
+    if isinstance(value, bytes):
+        return {'__bytes__': value.decode('latin-1')}
+    if isinstance(value, np.ndarray):
+        return {'__ndarray__': _encoded(value.tolist()),
+                'dtype': value.dtype.str}
+    if isinstance(value, np.generic):
+        return {'__scalar__': _encoded(value.item()),
+                'dtype': value.dtype.str}
+    if isinstance(value, STASH):
+        return {'__stash__': str(value)}
+    if isinstance(value, list):
+        return [_encoded(item) for item in value]
+    if isinstance(value, tuple):
+        return {'__tuple__': [_encoded(item) for item in value]}
+    if isinstance(value, Mapping):
+        return {'__dict__': [[_encoded(key), _encoded(item)]
+                             for key, item in value.items()]}
+    if isinstance(value, Unit):
+        return {'__unit__': str(value), 'calendar': value.calendar}
+    if isinstance(value, CellMethod):
+        return {'__cell_method__': [value.method,
+                                    _encoded(tuple(value.coord_names)),
+                                    _encoded(tuple(value.intervals)),
+                                    _encoded(tuple(value.comments))]}
+    if isinstance(value, CoordSystem):
+        # Stored by its public constructor parameters, not its attributes,
+        # which differ between iris versions.
+        params = {}
+        for name in _constructor_arg_names(type(value)):
+            if hasattr(value, name):
+                params[name] = getattr(value, name)
+        return {'__coord_system__': type(value).__name__,
+                'params': _encoded(params)}
+    if isinstance(value, numbers.Integral):
+        # e.g. a Python 2 'long'.
+        return int(value)
+    return {'__unknown__': '{}: {!r}'.format(type(value).__name__, value)}
+
+
+def _decoded(value):
+    # Return the metadata value stored by '_encoded'.
+    if isinstance(value, list):
+        return [_decoded(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if '__bytes__' in value:
+        return value['__bytes__'].encode('latin-1')
+    if '__ndarray__' in value:
+        return np.array(_decoded(value['__ndarray__']),
+                        dtype=np.dtype(str(value['dtype'])))
+    if '__scalar__' in value:
+        return np.dtype(str(value['dtype'])).type(
+            _decoded(value['__scalar__']))
+    if '__stash__' in value:
+        return STASH.from_msi(value['__stash__'])
+    if '__tuple__' in value:
+        return tuple(_decoded(item) for item in value['__tuple__'])
+    if '__dict__' in value:
+        return {_decoded(key): _decoded(item)
+                for key, item in value['__dict__']}
+    if '__unit__' in value:
+        return Unit(value['__unit__'], calendar=value['calendar'])
+    if '__cell_method__' in value:
+        method, coord_names, intervals, comments = value['__cell_method__']
+        return CellMethod(method, coords=_decoded(coord_names),
+                          intervals=_decoded(intervals),
+                          comments=_decoded(comments))
+    if '__coord_system__' in value:
+        if 'params' in value:
+            params = _decoded(value['params'])
+        else:
+            # Stored as its attributes, by an older version of this : take
+            # the private attributes of some iris versions as the public ones.
+            params = {key.lstrip('_'): item
+                      for key, item in _decoded(value['vars']).items()}
+        return _restored_coord_system(value['__coord_system__'], params)
+    return _UnknownValue(value.get('__unknown__'))
+
+
+def _constructor_arg_names(cls):
+    # Return the names of the arguments of a class constructor.
+    code = getattr(cls.__init__, '__code__', None)
+    if code is None:
+        return ()
+    return code.co_varnames[1:code.co_argcount]
+
+
+def _restored_coord_system(class_name, params):
+    # Rebuild a stored coord system by its constructor, in this iris version.
+    cls = getattr(iris.coord_systems, class_name, None)
+    if cls is None:
+        return _UnknownValue(class_name)
+    arg_names = _constructor_arg_names(cls)
+    kwargs = {name: item for name, item in params.items()
+              if name in arg_names}
+    candidates = [kwargs]
+    if issubclass(cls, GeogCS):
+        # The minor axis and the flattening are derived from each other, and
+        # cannot both be given.  Use whichever rebuilds both exactly, as the
+        # derived one may differ in its last digit.
+        candidates = [{name: item for name, item in kwargs.items()
+                       if name != omitted}
+                      for omitted in ('semi_minor_axis', 'inverse_flattening')]
+    restored = []
+    for candidate in candidates:
+        try:
+            coord_system = cls(**candidate)
+        except (TypeError, ValueError) as err:
+            restored.append(_UnknownValue('{}: {}'.format(class_name, err)))
+            continue
+        if all(getattr(coord_system, name, None) == item
+               for name, item in kwargs.items()):
+            return coord_system
+        restored.append(coord_system)
+    # None rebuilds exactly : prefer any that could be made.
+    restored.sort(key=lambda item: isinstance(item, _UnknownValue))
+    return restored[0]
+
+
+# The metadata attributes of a coord, as in 'coord_metadata'.
+_COORD_METADATA_NAMES = ('standard_name', 'long_name', 'var_name', 'units',
+                         'attributes', 'coord_system')
+
+
+class StoredCoord(object):
+    # A data-free stand-in for a coord, with its metadata, 'shape',
+    # boundedness, 'fingerprint' (a CoordFingerprint) and 'corners' (see
+    # '_corners').  It has no points or bounds.
+    # DimCoords also have 'circular'.
+    def __init__(self, name, metadata, shape, has_bounds, fingerprint,
+                 corners, circular=None):
+        self._name = name
+        for key in _COORD_METADATA_NAMES:
+            setattr(self, key, metadata[key])
+        self.shape = tuple(shape)
+        self.ndim = len(self.shape)
+        self._has_bounds = has_bounds
+        self.fingerprint = fingerprint
+        self.corners = corners
+        if circular is not None:
+            self.circular = circular
+
+    @classmethod
+    def from_coord(cls, coord, corners):
+        # Make the StoredCoord of a coord, given its corner points.
+        metadata = {key: getattr(coord, key)
+                    for key in _COORD_METADATA_NAMES}
+        fingerprint = coord_fingerprint(coord)
+        # Calculate the lazy parts now, while we have the coord.
+        fingerprint.canonical, fingerprint.endpoints
+        return cls(coord.name(), metadata, coord.shape, coord.has_bounds(),
+                   fingerprint, np.asarray(np.ma.getdata(corners)),
+                   getattr(coord, 'circular', None))
+
+    def name(self):
+        return self._name
+
+    def has_bounds(self):
+        return self._has_bounds
+
+    def core_points(self):
+        return None
+
+    def core_bounds(self):
+        return None
+
+    def to_dict(self):
+        # Return a JSON-compatible form of the coord, see 'from_dict'.
+        content = {key: _encoded(getattr(self, key))
+                   for key in _COORD_METADATA_NAMES}
+        content.update(name=self._name, shape=list(self.shape),
+                       has_bounds=self._has_bounds,
+                       fingerprint=self.fingerprint.to_dict(),
+                       corners=_encoded(self.corners),
+                       circular=getattr(self, 'circular', None))
+        return content
+
+    @classmethod
+    def from_dict(cls, content):
+        metadata = {key: _decoded(content[key])
+                    for key in _COORD_METADATA_NAMES}
+        return cls(content['name'], metadata, content['shape'],
+                   content['has_bounds'],
+                   CoordFingerprint.from_dict(content['fingerprint']),
+                   _decoded(content['corners']), content['circular'])
+
+    def __repr__(self):
+        return '<stored coord {!r}, shape {}>'.format(self._name, self.shape)
+
+
+class StoredCube(object):
+    # A data-free stand-in for a cube, with its 'metadata' (a CubeMetadata),
+    # 'shape', and a StoredCoord for each coord.  It has no data.
+    def __init__(self, name, metadata, shape, coords_and_dims):
+        self._name = name
+        self.metadata = metadata
+        for key, value in zip(metadata._fields, metadata):
+            setattr(self, key, value)
+        self.shape = tuple(shape)
+        self.ndim = len(self.shape)
+        # [(StoredCoord, dims)]
+        self._coords_and_dims = [(coord, tuple(dims))
+                                 for coord, dims in coords_and_dims]
+
+    @classmethod
+    def from_cube(cls, cube):
+        # Make the StoredCube of a cube.  A StoredCube is returned as it is.
+        if isinstance(cube, StoredCube):
+            return cube
+        summary = cube_summary(cube)
+        coords_and_dims = [(StoredCoord.from_coord(summary.coords[name],
+                                                   summary.corners(name)),
+                            summary.coord_dims[name])
+                           for name in summary.names]
+        return cls(cube.name(), cube.metadata, cube.shape, coords_and_dims)
+
+    def name(self):
+        return self._name
+
+    def coords(self):
+        return [coord for coord, _ in self._coords_and_dims]
+
+    def coord_dims(self, coord):
+        for stored_coord, dims in self._coords_and_dims:
+            if stored_coord is coord:
+                return dims
+        raise ValueError('{!r} is not a coord of {!r}.'.format(coord, self))
+
+    def core_data(self):
+        return None
+
+    def to_dict(self):
+        # Return a JSON-compatible form of the cube, see 'from_dict'.
+        return {'name': self._name,
+                'metadata': {key: _encoded(value)
+                             for key, value in zip(self.metadata._fields,
+                                                   self.metadata)},
+                'shape': list(self.shape),
+                'coords': [{'coord': coord.to_dict(), 'dims': list(dims)}
+                           for coord, dims in self._coords_and_dims]}
+
+    @classmethod
+    def from_dict(cls, content):
+        metadata = CubeMetadata(**{key: _decoded(value)
+                                   for key, value in
+                                   content['metadata'].items()})
+        coords_and_dims = [(StoredCoord.from_dict(item['coord']),
+                            item['dims'])
+                           for item in content['coords']]
+        return cls(content['name'], metadata, content['shape'],
+                   coords_and_dims)
+
+    def __repr__(self):
+        return "<stored 'Cube' of {} / ({}) {}>".format(self._name,
+                                                      self.units, self.shape)
+
+    def __str__(self):
+        lines = [repr(self)]
+        lines.extend('    {} : {}'.format(coord.name(), dims)
+                     for coord, dims in self._coords_and_dims)
+        return '\n'.join(lines)
+
+
+def stored_cubes(cubes):
+    # Return the StoredCube of each of some cubes.
+    # Each coord is only fingerprinted once, however many cubes share it.
+    with fingerprints_cached(), summaries_cached():
+        return [StoredCube.from_cube(cube) for cube in cubes]
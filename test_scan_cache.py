@@ -0,0 +1,93 @@
+from __future__ import (absolute_import, division, print_function)
+from six.moves import (filter, input, map, range, zip)  # noqa
+
+import os
+import shutil
+import tempfile
+
+import iris.tests as tests
+
+from scan_cache import ScanCache
+
+
+class TestScanCache(tests.IrisTest):
+    context = {'iris_version': '1.0', 'check_data': False}
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.temp_dir, 'cache.json')
+        self.path = os.path.join(self.temp_dir, 'test.pp')
+        with open(self.path, 'wb') as fo:
+            fo.write(b'\0' * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _store(self):
+        cache = ScanCache(self.cache_path, context=self.context)
+        return cache.store({'path': self.path, 'message': '  + OK'})
+
+    def test_hit(self):
+        self._store()
+        record = ScanCache(self.cache_path, context=self.context).lookup(
+            self.path)
+        self.assertEqual(record['message'], '  + OK')
+
+    def test_miss_unknown(self):
+        self._store()
+        cache = ScanCache(self.cache_path, context=self.context)
+        self.assertIsNone(cache.lookup(self.path + '.other'))
+
+    def test_miss_context_changed(self):
+        self._store()
+        for context in ({'iris_version': '2.0', 'check_data': False},
+                        {'iris_version': '1.0', 'check_data': True},
+                        {'iris_version': '1.0'}):
+            cache = ScanCache(self.cache_path, context=context)
+            self.assertIsNone(cache.lookup(self.path))
+
+    def test_miss_mtime_changed(self):
+        record = self._store()
+        os.utime(self.path, (record['mtime'] + 10, record['mtime'] + 10))
+        cache = ScanCache(self.cache_path, context=self.context)
+        self.assertIsNone(cache.lookup(self.path))
+        self.assertEqual(len(cache), 1)
+
+    def test_miss_size_changed(self):
+        record = self._store()
+        with open(self.path, 'ab') as fo:
+            fo.write(b'\0')
+        os.utime(self.path, (record['mtime'], record['mtime']))
+        cache = ScanCache(self.cache_path, context=self.context)
+        self.assertIsNone(cache.lookup(self.path))
+
+    def test_restored_after_change(self):
+        # A file re-compared after a change is found again.
+        record = self._store()
+        os.utime(self.path, (record['mtime'] + 10, record['mtime'] + 10))
+        self._store()
+        cache = ScanCache(self.cache_path, context=self.context)
+        self.assertIsNotNone(cache.lookup(self.path))
+        self.assertEqual(len(cache), 1)
+
+    def test_partial_line(self):
+        # The partial last line of an interrupted write is ignored.
+        self._store()
+        with open(self.cache_path, 'a') as fo:
+            fo.write('{"path": ')
+        cache = ScanCache(self.cache_path, context=self.context)
+        self.assertIsNotNone(cache.lookup(self.path))
+
+    def test_context_kept_apart(self):
+        # A context setting must not replace the record entry of that name.
+        context = {'check_data': False, 'stats': True}
+        stats = {'compare': {'calls': 1, 'time': 0.5, 'bytes': 0}}
+        cache = ScanCache(self.cache_path, context=context)
+        cache.store({'path': self.path, 'message': 'OK', 'stats': stats})
+        record = ScanCache(self.cache_path, context=context).lookup(self.path)
+        self.assertEqual(record['stats'], stats)
+        self.assertEqual(record['context'], context)
+
+
+if __name__ == '__main__':
+    tests.main()
@@ -0,0 +1,156 @@
+from __future__ import (absolute_import, division, print_function)
+from six.moves import (filter, input, map, range, zip)  # noqa
+
+import os
+import shutil
+import tempfile
+
+import iris.tests as tests
+
+from scan_db import ResultsDB, parse_scan_log
+from scan_report import write_record
+
+
+# Part of the printed output of an old scan, with skipped files commented out.
+_SCAN_LOG = """
+/data/PP/ukV1/ukVpmslont_first_field.pp             2.782Mb
+  + OK
+
+# /data/PP/ukV1/qv03Varres2.pp                   1630.154Mb
+  ((skip))
+
+/data/PP/orogFlow/orogFlow.pp                     220.439Mb
+  XXX normal load fails : unpack_from requires a buffer of at least 4 bytes
+"""
+
+
+class _TempDirTest(tests.IrisTest):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, name, text):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'w') as fo:
+            fo.write(text)
+        return path
+
+
+class TestParseScanLog(_TempDirTest):
+    def test_skipped_entries(self):
+        results = parse_scan_log(self._write('scan.txt', _SCAN_LOG))
+        self.assertEqual(
+            results,
+            [('/data/PP/ukV1/ukVpmslont_first_field.pp', 2.782, '  + OK',
+              False),
+             ('/data/PP/ukV1/qv03Varres2.pp', 1630.154, '  ((skip))', True),
+             ('/data/PP/orogFlow/orogFlow.pp', 220.439,
+              '  XXX normal load fails : unpack_from requires a buffer of '
+              'at least 4 bytes', False)])
+
+    def test_import_scan_log(self):
+        db = ResultsDB(os.path.join(self.temp_dir, 'results.db'))
+        run_id = db.import_scan_log(self._write('scan.txt', _SCAN_LOG))
+        rows = db.search('', run_id=run_id, failures_only=False)
+        outcomes = {row['path']: row['outcome'] for row in rows}
+        db.close()
+        self.assertEqual(outcomes,
+                         {'/data/PP/ukV1/ukVpmslont_first_field.pp': 'ok',
+                          '/data/PP/ukV1/qv03Varres2.pp': 'skip',
+                          '/data/PP/orogFlow/orogFlow.pp':
+                              'normal_load_fail'})
+
+
+def _record(path, outcome='ok', message='  + OK', seconds=1.0):
+    return {'path': path, 'size': 1000, 'outcome': outcome,
+            'message': message,
+            'phases': {name: {'time': seconds, 'peak_rss_mb': 10.0}
+                       for name in ('normal_load', 'structured_load',
+                                    'compare')}}
+
+
+class TestResultsDB(_TempDirTest):
+    def setUp(self):
+        super(TestResultsDB, self).setUp()
+        self.db = ResultsDB(os.path.join(self.temp_dir, 'results.db'))
+        self.old_run = self.db.start_run({'iris_version': '1.0',
+                                          'comparer_hash': 'abc',
+                                          'check_data': False},
+                                         label='old')
+        for record in (_record('a'), _record('b'),
+                       _record('c', 'match_fail', '  -- MATCH FAIL: x'),
+                       _record('d'), _record('e', 'skip', '  ((skip))')):
+            self.db.add_record(self.old_run, record)
+        self.new_run = self.db.start_run(label='new')
+        for record in (_record('a', seconds=3.0),
+                       _record('b', 'normal_load_fail',
+                               '  XXX normal load fails : bad 100%_header'),
+                       _record('c'), _record('d', seconds=2.0),
+                       _record('e', 'match_fail', '  -- MATCH FAIL: y')):
+            self.db.add_record(self.new_run, record)
+
+    def tearDown(self):
+        self.db.close()
+        super(TestResultsDB, self).tearDown()
+
+    def test_runs(self):
+        runs = self.db.runs()
+        self.assertEqual([(run['run_id'], run['label'], run['n_files'])
+                          for run in runs],
+                         [(self.old_run, 'old', 5), (self.new_run, 'new', 5)])
+        self.assertEqual(runs[0]['iris_version'], '1.0')
+        self.assertEqual(runs[0]['settings'], '{"check_data": false}')
+        self.assertEqual(self.db.latest_run_ids(2),
+                         [self.old_run, self.new_run])
+        self.assertEqual(self.db.previous_run_id(self.new_run), self.old_run)
+        self.assertIsNone(self.db.previous_run_id(self.old_run))
+
+    def test_outcome_changes(self):
+        rows = self.db.outcome_changes(self.old_run, self.new_run)
+        # N.B. the skipped file is not counted.
+        self.assertEqual([(row['path'], row['old_outcome'],
+                           row['new_outcome']) for row in rows],
+                         [('b', 'ok', 'normal_load_fail'),
+                          ('c', 'match_fail', 'ok')])
+
+    def test_regressions(self):
+        rows = self.db.outcome_changes(self.old_run, self.new_run,
+                                       regressions=True)
+        self.assertEqual([row['path'] for row in rows], ['b'])
+
+    def test_slowest(self):
+        rows = self.db.slowest(2)
+        self.assertEqual([(row['path'], row['total_time']) for row in rows],
+                         [('a', 9.0), ('d', 6.0)])
+        rows = self.db.slowest(1, run_id=self.old_run)
+        self.assertEqual([row['run_id'] for row in rows], [self.old_run])
+
+    def test_search(self):
+        rows = self.db.search('load')
+        self.assertEqual([(row['run_id'], row['path']) for row in rows],
+                         [(self.new_run, 'b')])
+        # Wildcard characters match only themselves.
+        self.assertEqual(len(self.db.search('100%_h')), 1)
+        self.assertEqual(self.db.search('bad_100'), [])
+        self.assertEqual(self.db.search('load%bad'), [])
+        rows = self.db.search('OK', run_id=self.old_run, failures_only=False)
+        self.assertEqual([row['path'] for row in rows], ['a', 'b', 'd'])
+
+    def test_import_report(self):
+        path = os.path.join(self.temp_dir, 'report.json')
+        with open(path, 'w') as fo:
+            write_record(fo, _record('x', 'match_fail'))
+            write_record(fo, _record('y'))
+            write_record(fo, _record('x'))
+        run_id = self.db.import_report(path)
+        self.assertEqual(self.db.latest_run_ids(1), [run_id])
+        rows = self.db.search('', run_id=run_id, failures_only=False)
+        self.assertEqual([(row['path'], row['outcome'], row['total_time'])
+                          for row in rows],
+                         [('x', 'ok', 3.0), ('y', 'ok', 3.0)])
+
+
+if __name__ == '__main__':
+    tests.main()
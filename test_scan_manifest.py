@@ -0,0 +1,104 @@
+from __future__ import (absolute_import, division, print_function)
+from six.moves import (filter, input, map, range, zip)  # noqa
+
+import os
+import shutil
+import struct
+import tempfile
+
+import iris.tests as tests
+
+from scan_manifest import FileManifest, file_type
+
+
+class TestFileManifest(tests.IrisTest):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.base_path = os.path.join(self.temp_dir, 'data')
+        self.manifest_path = os.path.join(self.temp_dir, 'manifest.json')
+        os.makedirs(os.path.join(self.base_path, 'sub'))
+        self._write('a.pp', struct.pack('>i', 64 * 4))
+        self._write('sub/b.ff', struct.pack('>q', 20))
+        self._write('sub/notes.txt', b'text')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, name, content):
+        path = os.path.join(self.base_path, name)
+        dirpath = os.path.dirname(path)
+        # Keep the directory time, as a file changed in place would.
+        dir_stat = os.stat(dirpath)
+        with open(path, 'wb') as fo:
+            fo.write(content)
+        os.utime(dirpath, (dir_stat.st_atime, dir_stat.st_mtime))
+        return path
+
+    def _touch_dir(self, name):
+        # Mark a directory as changed, as adding a file would.
+        dirpath = os.path.join(self.base_path, name)
+        mtime = os.stat(dirpath).st_mtime + 10
+        os.utime(dirpath, (mtime, mtime))
+
+    def _entries(self, manifest):
+        return [(os.path.relpath(entry.path, self.base_path), entry.size,
+                 entry.type)
+                for entry in manifest.files(self.base_path)]
+
+    def test_refresh(self):
+        manifest = FileManifest(self.manifest_path)
+        manifest.refresh(self.base_path)
+        expected = [('a.pp', 4, 'pp'), (os.path.join('sub', 'b.ff'), 8, 'ff'),
+                    (os.path.join('sub', 'notes.txt'), 4, None)]
+        self.assertEqual(self._entries(manifest), expected)
+        # Saved, and read back without listing again.
+        self.assertEqual(self._entries(FileManifest(self.manifest_path)),
+                         expected)
+
+    def test_dirpath_only(self):
+        manifest = FileManifest()
+        manifest.refresh(self.base_path)
+        self.assertEqual([os.path.basename(entry.path)
+                          for entry in manifest.files(self.base_path,
+                                                      dirpath_only=True)],
+                         ['a.pp'])
+
+    def test_file_added(self):
+        manifest = FileManifest(self.manifest_path)
+        manifest.refresh(self.base_path)
+        self._write('sub/c.pp', struct.pack('>i', 64 * 4))
+        self._touch_dir('sub')
+        manifest = FileManifest(self.manifest_path)
+        manifest.refresh(self.base_path)
+        self.assertIn((os.path.join('sub', 'c.pp'), 4, 'pp'),
+                      self._entries(manifest))
+
+    def test_file_changed_in_place(self):
+        # A file changed in place is only noticed when files are rechecked.
+        manifest = FileManifest(self.manifest_path)
+        manifest.refresh(self.base_path)
+        self._write('sub/notes.txt', struct.pack('>i', 64 * 4) + b'\0' * 4)
+        manifest.refresh(self.base_path)
+        self.assertIn((os.path.join('sub', 'notes.txt'), 4, None),
+                      self._entries(manifest))
+        manifest.refresh(self.base_path, recheck_files=True)
+        self.assertIn((os.path.join('sub', 'notes.txt'), 8, 'pp'),
+                      self._entries(manifest))
+
+    def test_dir_removed(self):
+        manifest = FileManifest(self.manifest_path)
+        manifest.refresh(self.base_path)
+        shutil.rmtree(os.path.join(self.base_path, 'sub'))
+        self._touch_dir('.')
+        manifest.refresh(self.base_path)
+        self.assertEqual(self._entries(manifest), [('a.pp', 4, 'pp')])
+        self.assertEqual(manifest.dirs(self.base_path), [self.base_path])
+
+
+class TestFileType(tests.IrisTest):
+    def test_unreadable(self):
+        self.assertIsNone(file_type('/no/such/file'))
+
+
+if __name__ == '__main__':
+    tests.main()
@@ -0,0 +1,211 @@
+from __future__ import (absolute_import, division, print_function)
+from six.moves import (filter, input, map, range, zip)  # noqa
+
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+import iris
+from iris.coords import DimCoord
+from iris.cube import Cube
+import iris.fileformats.pp as pp
+import iris.tests as tests
+from iris.tests import mock
+import numpy as np
+
+from scan_manifest import ManifestEntry, file_type
+from scan_pp_ff_files import (_compare_kwargs, budget_sample_files,
+                              compare_file, compare_file_within_budget,
+                              file_timeout, parallel_compare_files,
+                              pipelined_compare_files, tst_compare_sample)
+
+
+class _FakeFileTest(tests.IrisTest):
+    def setUp(self):
+        # A file which looks like PP : only its size and first word are used.
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'test.pp')
+        with open(self.path, 'wb') as fo:
+            fo.write(struct.pack('>i', 64 * 4) + b'\0' * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+
+class TestLoadOnce(tests.IrisTest):
+    def setUp(self):
+        # A PP file of two fields which differ only in pseudo-level.  The
+        # normal load merges these, but the structured load does not.
+        self.temp_dir = tempfile.mkdtemp()
+        cube = Cube(np.zeros((2, 3), dtype=np.float32),
+                    standard_name='air_temperature', units='K')
+        cube.add_dim_coord(DimCoord([0.0, 1.0], standard_name='latitude',
+                                    units='degrees'), 0)
+        cube.add_dim_coord(DimCoord([0.0, 1.0, 2.0],
+                                    standard_name='longitude',
+                                    units='degrees'), 1)
+        cube.attributes['STASH'] = pp.STASH(1, 0, 16203)
+        one_path = os.path.join(self.temp_dir, 'one.pp')
+        iris.save(cube, one_path)
+        self.path = os.path.join(self.temp_dir, 'two.pp')
+        with open(self.path, 'wb') as fo:
+            for pseudo_level in (1, 2):
+                field, = pp.load(one_path)
+                lbuser = list(field.lbuser)
+                lbuser[4] = pseudo_level
+                field.lbuser = tuple(lbuser)
+                field.save(fo)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_same_cubes(self):
+        record = compare_file(self.path)
+        self.assertEqual((record['n_normal'], record['n_structured']), (1, 2))
+        once_record = compare_file(self.path, load_once=True)
+        self.assertEqual((once_record['n_normal'],
+                          once_record['n_structured']), (1, 2))
+        self.assertEqual(once_record['outcome'], record['outcome'])
+
+
+class TestCompareFileWithinBudget(_FakeFileTest):
+    def test_chunks_unreadable(self):
+        # A file over the budget, whose field headers can't be read.
+        with mock.patch('scan_pp_ff_files.read_fields',
+                        side_effect=IOError('bad header')):
+            record = compare_file_within_budget(self.path,
+                                                memory_budget_mb=1.0e-4)
+        self.assertEqual(record['outcome'], 'normal_load_fail')
+        self.assertEqual(record['message'],
+                         '  XXX normal load fails : bad header')
+        self.assertEqual(record['file_type'], 'pp')
+
+    def test_file_type(self):
+        # Files are classified as in the manifest.
+        with open(self.path, 'wb') as fo:
+            fo.write(struct.pack('>q', 20) + b'\0' * 1000)
+        with mock.patch('scan_pp_ff_files.read_fields',
+                        side_effect=IOError('bad header')):
+            record = compare_file_within_budget(self.path,
+                                                memory_budget_mb=1.0e-4)
+        self.assertEqual(record['file_type'], file_type(self.path))
+        self.assertEqual(record['file_type'], 'ff')
+
+
+class TestParallelCompareFiles(_FakeFileTest):
+    def test_hang_timed_out(self):
+        # By default, a worker which hangs is killed after a time.
+        def hang(*args, **kwargs):
+            time.sleep(60)
+
+        with mock.patch('scan_pp_ff_files.compare_file_within_budget',
+                        side_effect=hang), \
+                mock.patch('scan_pp_ff_files.DEFAULT_TIMEOUT', 0.5):
+            start_time = time.time()
+            (filename, _, record), = parallel_compare_files(
+                [self.path], 1, poll_interval=0.05)
+        self.assertLess(time.time() - start_time, 30)
+        self.assertEqual(filename, self.path)
+        self.assertEqual(record['outcome'], 'worker_timeout')
+
+
+class TestFileTimeout(tests.IrisTest):
+    def test_default(self):
+        self.assertEqual(file_timeout(0.0), 600.0)
+        self.assertEqual(file_timeout(1000.0), 1600.0)
+
+    def test_given(self):
+        self.assertEqual(file_timeout(1000.0, 30.0), 30.0)
+        self.assertEqual(file_timeout(1000.0, 0), 0)
+
+
+class TestPipelinedCompareFiles(_FakeFileTest):
+    def test_load_fail(self):
+        with mock.patch('scan_pp_ff_files.normal_load',
+                        side_effect=ValueError('bad header')), \
+                mock.patch('scan_pp_ff_files.compare_cubelists') as compare:
+            results = list(pipelined_compare_files([self.path]))
+        (filename, _, record), = results
+        self.assertEqual(filename, self.path)
+        self.assertEqual(record['outcome'], 'normal_load_fail')
+        self.assertEqual(record['message'],
+                         '  XXX normal load fails : bad header')
+        self.assertEqual(compare.call_count, 0)
+
+
+class _FakeCache(object):
+    # A results cache with results for some paths.
+    def __init__(self, paths):
+        self.paths = paths
+
+    def lookup(self, path):
+        return {'path': path} if path in self.paths else None
+
+
+class TestBudgetSampleFiles(tests.IrisTest):
+    def setUp(self):
+        # Three small files in 'a', one in 'b', and a bigger one in 'b'.
+        sizes = [('a/1', 1000), ('a/2', 1000), ('a/3', 1000), ('b/1', 1000),
+                 ('b/big', 5 * 10 ** 6)]
+        self.entries = [ManifestEntry(path, size, 0.0, 'pp')
+                        for path, size in sizes]
+
+    def test_round_robin(self):
+        paths = list(budget_sample_files(self.entries))
+        self.assertEqual(sorted(paths), sorted(entry.path
+                                               for entry in self.entries))
+        # One from each (directory, size band) group in turn, until only
+        # the files of 'a' are left.
+        self.assertEqual([path[:2] for path in paths],
+                         ['a/', 'b/', 'b/', 'a/', 'a/'])
+        self.assertEqual(paths[1:3], ['b/1', 'b/big'])
+
+    def test_seed(self):
+        self.assertEqual(list(budget_sample_files(self.entries, seed=1)),
+                         list(budget_sample_files(self.entries, seed=1)))
+
+    def test_budget(self):
+        # The big file does not fit, but the small ones still do.
+        paths = list(budget_sample_files(self.entries, byte_budget_mb=0.003))
+        self.assertEqual(len(paths), 3)
+        self.assertNotIn('b/big', paths)
+
+    def test_cached_first_and_free(self):
+        cache = _FakeCache({'a/1', 'a/2'})
+        paths = list(budget_sample_files(self.entries, byte_budget_mb=0.002,
+                                         cache=cache))
+        # The uncached file of 'a' comes first, and the cached ones do not
+        # use up the budget.
+        a_paths = [path for path in paths if path.startswith('a/')]
+        self.assertEqual(a_paths[0], 'a/3')
+        self.assertEqual(sorted(a_paths), ['a/1', 'a/2', 'a/3'])
+        self.assertIn('b/1', paths)
+        self.assertNotIn('b/big', paths)
+
+
+class TestCompareSample(tests.IrisTest):
+    def test_cache_context(self):
+        # The sample must look up the same cached results as the scan uses.
+        with mock.patch('scan_pp_ff_files.datazoo_manifest'), \
+                mock.patch('scan_pp_ff_files._scan_cache') as scan_cache, \
+                mock.patch('scan_pp_ff_files.tst_compare_all_files') as scan:
+            tst_compare_sample('FF', cache_path='cache.json', check_data=True,
+                               summaries_path='summaries', stats=True)
+        (_, context), _ = scan_cache.call_args
+        _, kwargs = scan.call_args
+        self.assertEqual(context,
+                         _compare_kwargs(check_data=kwargs['check_data'],
+                                         load_once=kwargs['load_once'],
+                                         summaries_path=kwargs[
+                                             'summaries_path'],
+                                         against=kwargs['against'],
+                                         loader=kwargs['loader'],
+                                         stats=kwargs['stats']))
+        self.assertEqual(kwargs['summaries_path'], 'summaries')
+        self.assertTrue(kwargs['stats'])
+
+
+if __name__ == '__main__':
+    tests.main()
@@ -0,0 +1,88 @@
+from __future__ import (absolute_import, division, print_function)
+from six.moves import (filter, input, map, range, zip)  # noqa
+
+import os
+import shutil
+import tempfile
+
+import iris.tests as tests
+
+from scan_report import diff_reports, read_report, write_record
+
+
+def _record(path, outcome='ok', message='  + OK', seconds=1.0):
+    return {'path': path, 'outcome': outcome, 'message': message,
+            'phases': {'normal_load': {'time': seconds, 'peak_rss_mb': 1.0}}}
+
+
+def _paths(entries):
+    return [path for path, _, _ in entries]
+
+
+class TestDiffReports(tests.IrisTest):
+    def _diffs(self, old_records, new_records):
+        return diff_reports({record['path']: record
+                             for record in old_records},
+                            {record['path']: record
+                             for record in new_records})
+
+    def test_same(self):
+        records = [_record('a'), _record('b', 'match_fail', '  -- MATCH')]
+        diffs = self._diffs(records, records)
+        self.assertEqual(diffs, {key: [] for key in diffs})
+
+    def test_outcomes(self):
+        old = [_record('regressed'), _record('fixed', 'match_fail'),
+               _record('changed', 'match_fail', '  -- MATCH FAIL: x'),
+               _record('message', 'match_fail', '  -- MATCH FAIL: y'),
+               _record('removed'), _record('skipped', 'skip')]
+        new = [_record('regressed', 'normal_load_fail'), _record('fixed'),
+               _record('changed', 'structured_load_fail'),
+               _record('message', 'match_fail', '  -- MATCH FAIL: z'),
+               _record('added'), _record('skipped')]
+        diffs = self._diffs(old, new)
+        self.assertEqual({key: _paths(entries)
+                          for key, entries in diffs.items()},
+                         {'regressions': ['regressed'], 'fixes': ['fixed'],
+                          'changed': ['changed', 'message'],
+                          'slowdowns': [], 'speedups': [],
+                          'added': ['added'], 'removed': ['removed']})
+        (_, old_record, new_record), = diffs['added']
+        self.assertIsNone(old_record)
+        self.assertEqual(new_record['path'], 'added')
+
+    def test_times(self):
+        old = [_record('slower', seconds=2.0), _record('much_slower'),
+               _record('faster', seconds=4.0), _record('slightly_slower'),
+               _record('briefly_slower', seconds=0.1)]
+        new = [_record('slower', seconds=4.0),
+               _record('much_slower', seconds=10.0),
+               _record('faster', seconds=1.0),
+               _record('slightly_slower', seconds=1.4),
+               _record('briefly_slower', seconds=0.5)]
+        diffs = self._diffs(old, new)
+        # Biggest changes first, and small absolute changes ignored.
+        self.assertEqual(_paths(diffs['slowdowns']),
+                         ['much_slower', 'slower'])
+        self.assertEqual(_paths(diffs['speedups']), ['faster'])
+        self.assertEqual(diffs['changed'], [])
+
+
+class TestReadReport(tests.IrisTest):
+    def test_last_record(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'report.json')
+            with open(path, 'w') as fo:
+                write_record(fo, _record('a', 'match_fail'))
+                write_record(fo, _record('b'))
+                write_record(fo, _record('a'))
+            records = read_report(path)
+        finally:
+            shutil.rmtree(temp_dir)
+        self.assertEqual(sorted(records), ['a', 'b'])
+        self.assertEqual(records['a']['outcome'], 'ok')
+
+
+if __name__ == '__main__':
+    tests.main()
@@ -0,0 +1,81 @@
+from __future__ import (absolute_import, division, print_function)
+from six.moves import (filter, input, map, range, zip)  # noqa
+
+import iris.tests as tests
+from iris.tests import mock
+
+from scan_scheduler import MIN_RATIO, MemoryModel
+
+
+def _record(path, size_mb, used_mb, file_type='pp', **kwargs):
+    # A result record of a comparison which used 'used_mb' of memory.
+    record = {'path': path, 'size': int(size_mb * 1.0e6),
+              'file_type': file_type, 'base_rss_mb': 100.0,
+              'phases': {'normal_load': {'time': 1.0,
+                                         'peak_rss_mb': 100.0 + used_mb}}}
+    record.update(kwargs)
+    return record
+
+
+class TestMemoryModel(tests.IrisTest):
+    def setUp(self):
+        self.model = MemoryModel(100.0, memory_limit_mb=300.0)
+        # Don't read the files to find their types.
+        patch = mock.patch('scan_scheduler.file_type', return_value='pp')
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_default(self):
+        self.assertEqual(self.model.ratio('/a/x.pp'), 1.0)
+        self.assertEqual(self.model.chunk_budget_mb('/a/x.pp'), 100.0)
+        self.assertEqual(self.model.estimate_mb('/a/x.pp', 50.0e6), 50.0)
+        # Never more than the budget, as a bigger file is compared in parts.
+        self.assertEqual(self.model.estimate_mb('/a/x.pp', 500.0e6), 100.0)
+
+    def test_learnt(self):
+        self.model.observe(_record('/a/x.pp', 10.0, 40.0))
+        self.model.observe(_record('/b/y.pp', 10.0, 20.0))
+        # By directory where known, and else by type : the worst case.
+        self.assertEqual(self.model.ratio('/a/z.pp'), 4.0)
+        self.assertEqual(self.model.ratio('/b/z.pp'), 2.0)
+        self.assertEqual(self.model.ratio('/c/z.pp'), 4.0)
+        self.assertEqual(self.model.chunk_budget_mb('/b/z.pp'), 50.0)
+        self.assertEqual(self.model.estimate_mb('/b/z.pp', 20.0e6), 40.0)
+
+    def test_chunked(self):
+        self.model.observe(_record('/a/x.pp', 10.0, 40.0, n_chunks=2))
+        self.assertEqual(self.model.ratio('/a/x.pp'), 8.0)
+
+    def test_ignored(self):
+        self.model.observe({'path': '/a/x.pp', 'size': 1000,
+                            'file_type': 'pp'})
+        self.model.observe(_record('/a/x.ff', 10.0, 40.0, file_type='ff'))
+        self.assertEqual(self.model.ratio('/a/x.pp'), 1.0)
+
+    def test_min_ratio(self):
+        self.model.observe(_record('/a/x.pp', 10.0, 0.0))
+        self.assertEqual(self.model.ratio('/a/x.pp'), MIN_RATIO)
+
+    def test_admission(self):
+        self.assertTrue(self.model.can_start(0.0, 100.0))
+        self.assertTrue(self.model.can_start(200.0, 100.0))
+        self.assertFalse(self.model.can_start(250.0, 100.0))
+        # There can always be one, however big.
+        self.assertTrue(self.model.can_start(0.0, 1000.0))
+
+    def test_unlimited(self):
+        with mock.patch('scan_scheduler.available_memory_mb',
+                        return_value=None):
+            model = MemoryModel(100.0)
+        self.assertIsNone(model.memory_limit_mb)
+        self.assertTrue(model.can_start(1.0e6, 100.0))
+
+    def test_default_limit(self):
+        with mock.patch('scan_scheduler.available_memory_mb',
+                        return_value=1000.0):
+            model = MemoryModel(100.0)
+        self.assertEqual(model.memory_limit_mb, 800.0)
+
+
+if __name__ == '__main__':
+    tests.main()
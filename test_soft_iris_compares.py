@@ -2,16 +2,42 @@ from __future__ import (absolute_import, division, print_function)
 from six.moves import (filter, input, map, range, zip)  # noqa
 import six
 
+import json
+import unittest
+
 import iris.tests as tests
 
 import numpy as np
+try:
+    import dask.array as da
+except ImportError:
+    # Older iris (1.x) has biggus instead.
+    da = None
 
+from iris.coord_systems import GeogCS, RotatedGeogCS
 from iris.cube import Cube, CubeList
 from iris.coords import DimCoord, AuxCoord
+from iris.tests import mock
 
-from soft_iris_compares import (compare_coords,
+from soft_iris_compares import (_decoded,
+                                _encoded,
+                                compare_coords,
                                 compare_cubes,
-                                compare_cubelists)
+                                compare_cubelists,
+                                coord_fingerprint,
+                                cube_summary,
+                                cubelist_mismatches,
+                                CubelistTable,
+                                cubes_equal_without_data,
+                                corner_values,
+                                first_difference,
+                                fingerprints_cached,
+                                instrumented,
+                                LazyRealisationError,
+                                solve_dimension_mapping,
+                                StoredCube,
+                                stored_cubes,
+                                summaries_cached)
 
 def liststrings(item):
     if isinstance(item, six.string_types):
@@ -38,6 +64,130 @@ def _check_compare_result(testcase, func, item1, item2, msg='', err=''):
         testcase.assertFalse(result)
 
 
+class LazyArray(object):
+    # A minimal lazy array, which records how it is indexed and realised.
+    def __init__(self, array, parent=None):
+        self._array = array
+        self._parent = parent
+        self.shape = array.shape
+        self.ndim = array.ndim
+        self.keys = []
+        self.n_computes = 0
+
+    def __getitem__(self, keys):
+        self.keys.append(keys)
+        return LazyArray(self._array[keys], parent=self)
+
+    def compute(self):
+        # Count all computes on the original array.
+        original = self
+        while original._parent is not None:
+            original = original._parent
+        original.n_computes += 1
+        return self._array
+
+
+class CountingSource(object):
+    # A source of values for a dask array, which records how it is read.
+    def __init__(self, array):
+        self._array = array
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.ndim = array.ndim
+        self.reads = []
+
+    def __getitem__(self, keys):
+        self.reads.append(keys)
+        return self._array[keys]
+
+
+class TestCornerValues(tests.IrisTest):
+    def test_1d(self):
+        result = corner_values(np.array([3, 1, 2]))
+        self.assertArrayEqual(result, [2, 3])
+
+    def test_3d(self):
+        array = np.arange(24).reshape((2, 3, 4))
+        result = corner_values(array)
+        self.assertArrayEqual(result, [0, 3, 8, 11, 12, 15, 20, 23])
+
+    def test_length_one_dims(self):
+        array = np.arange(3).reshape((1, 3))
+        result = corner_values(array)
+        self.assertArrayEqual(result, [0, 0, 2, 2])
+
+    def test_lazy_single_fetch(self):
+        array = LazyArray(np.arange(24).reshape((2, 3, 4)))
+        result = corner_values(array)
+        self.assertArrayEqual(result, [0, 3, 8, 11, 12, 15, 20, 23])
+        self.assertEqual(len(array.keys), 1)
+        self.assertEqual(array.n_computes, 1)
+
+
+class TestFirstDifference(tests.IrisTest):
+    def test_same(self):
+        array = np.arange(24.0).reshape((2, 3, 4))
+        self.assertIsNone(first_difference(array, array.copy()))
+
+    def test_index(self):
+        ref = np.arange(24.0).reshape((2, 3, 4))
+        tst = ref.copy()
+        tst[1, 2, 0] += 1.0
+        tst[1, 2, 3] += 1.0
+        self.assertEqual(first_difference(ref, tst, block_size=4), (1, 2, 0))
+
+    def test_tolerance(self):
+        ref = np.arange(4.0)
+        tst = ref + 1.0e-9
+        self.assertEqual(first_difference(ref, tst), (0,))
+        self.assertIsNone(first_difference(ref, tst, atol=1.0e-8))
+
+    def test_sort_last(self):
+        ref = np.array([[0.5, 1.5], [1.5, 2.5]])
+        tst = ref[:, ::-1]
+        self.assertEqual(first_difference(ref, tst), (0, 0))
+        self.assertIsNone(first_difference(ref, tst, sort_last=True))
+        tst = tst.copy()
+        tst[1, 0] = 3.0
+        self.assertEqual(first_difference(ref, tst, sort_last=True), (1,))
+
+    def test_lazy_early_exit(self):
+        values = np.arange(100.0).reshape((10, 10))
+        ref = LazyArray(values)
+        tst_values = values.copy()
+        tst_values[2, 5] = -1.0
+        tst = LazyArray(tst_values)
+        self.assertEqual(first_difference(ref, tst, block_size=20), (2, 5))
+        # Only the blocks up to the difference were fetched.
+        self.assertEqual(ref.keys, [slice(0, 2), slice(2, 4)])
+        self.assertEqual(ref.n_computes, 2)
+
+    @unittest.skipIf(da is None, 'Test requires dask.')
+    def test_transposed_chunks(self):
+        # The blocks follow the chunks of both arrays, so the chunks of a
+        # transposed one, which run across the reference ones, are not read
+        # once for every block.
+        values = np.arange(1200.0).reshape((40, 30))
+        ref = da.from_array(values, chunks=(20, 30))
+        tst_values = values.T.copy()
+        tst_values[20, 35] = -1.0
+        source = CountingSource(tst_values)
+        tst = da.from_array(source, chunks=(15, 40)).T
+        del source.reads[:]
+        self.assertEqual(first_difference(ref, tst, block_size=300),
+                         (35, 20))
+        self.assertEqual(first_difference(values, tst, block_size=300),
+                         (35, 20))
+        # Each chunk is read twice in each comparison, not for every block.
+        self.assertEqual(len(source.reads), 8)
+
+    def test_strings(self):
+        ref = np.array(['a', 'b', 'c'])
+        self.assertIsNone(first_difference(ref, ref.astype('U5')))
+        self.assertEqual(first_difference(ref, np.array(['a', 'b', 'd'])),
+                         (2,))
+
+
 class TestCoordsMetadata(tests.IrisTest):
     def setUp(self):
         self.ref_co_1d = DimCoord([1, 2])
@@ -107,11 +257,36 @@ class TestCoordsMetadata(tests.IrisTest):
         c2.var_name = 'q'
         self._coords_eq(c1, c2, err=self.msg_metadata)
 
+    def test_fail_circular_differ(self):
+        c1 = self.co_a
+        c2 = c1.copy()
+        c2.circular = True
+        self._coords_eq(c1, c2, err=self.msg_metadata)
+
+    def test_fail_boundedness_differ(self):
+        c1 = self.co_a
+        c2 = c1.copy()
+        c2.guess_bounds()
+        self._coords_eq(c1, c2, err=self.msg_metadata)
+
     #
     # NOTE: coord_system is also a possible metadata mismatch.
     # ?? should we ignore that one ??
     # probably not, leave it in.
     #
+    def test_fail_coord_systems_differ(self):
+        c1 = self.co_a
+        c2 = c1.copy()
+        c2.coord_system = GeogCS(6371229.0)
+        self._coords_eq(c1, c2, err=self.msg_metadata)
+
+    def test_no_array_copies(self):
+        c1 = self.co_a
+        c2 = c1.copy()
+        c2.attributes['this'] = 'that'
+        with mock.patch.object(DimCoord, 'copy') as copy_call:
+            self._coords_eq(c1, c2, err=self.msg_metadata)
+        self.assertEqual(copy_call.call_count, 0)
 
 
 class TestCoordsValues(tests.IrisTest):
@@ -175,6 +350,78 @@ class TestCoordsValues(tests.IrisTest):
         self._coords_eq(c1, c2, msg='different points arrays')
 
 
+class TestCoordFingerprint(tests.IrisTest):
+    def setUp(self):
+        self.coord = AuxCoord(np.arange(24).reshape((2, 3, 4)),
+                              long_name='a')
+
+    def test_same_values(self):
+        c1 = self.coord
+        c2 = AuxCoord(np.arange(24.0).reshape((2, 3, 4)), long_name='b')
+        print1, print2 = coord_fingerprint(c1), coord_fingerprint(c2)
+        self.assertTrue(print1.exact_match(print2))
+        self.assertEqual(print1.canonical, print2.canonical)
+
+    def test_transposed_inverted(self):
+        c1 = self.coord
+        c2 = c1.copy(c1.points.transpose((2, 0, 1))[::-1, :, ::-1])
+        print1, print2 = coord_fingerprint(c1), coord_fingerprint(c2)
+        self.assertFalse(print1.exact_match(print2))
+        self.assertEqual(print1.canonical, print2.canonical)
+
+    def test_inverted_bounds(self):
+        c1 = DimCoord([1, 2, 3, 4], long_name='a')
+        c1.guess_bounds()
+        c2 = c1[::-1]
+        print1, print2 = coord_fingerprint(c1), coord_fingerprint(c2)
+        self.assertFalse(print1.exact_match(print2))
+        self.assertEqual(print1.canonical, print2.canonical)
+
+    def test_different_values(self):
+        c1 = self.coord
+        points = c1.points.transpose((2, 0, 1)).copy()
+        points[1, 1, 1] = 99
+        c2 = c1.copy(points)
+        self.assertNotEqual(coord_fingerprint(c1).canonical,
+                            coord_fingerprint(c2).canonical)
+
+    def test_ambiguous_orientation(self):
+        # Both profiles are symmetric, and they are the same.
+        c1 = AuxCoord([[1, 2, 3], [2, 0, 2], [3, 2, 1]], long_name='a')
+        canonical = coord_fingerprint(c1).canonical
+        for points in (c1.points[::-1], c1.points[:, ::-1],
+                       c1.points.T, c1.points.T[::-1]):
+            c2 = c1.copy(points)
+            self.assertEqual(coord_fingerprint(c2).canonical, canonical)
+        c2 = c1.copy([[1, 2, 3], [2, 0, 2], [3, 2, 2]])
+        self.assertNotEqual(coord_fingerprint(c2).canonical, canonical)
+
+    def test_big_integers(self):
+        # Values which float64 can't tell apart.
+        c1 = AuxCoord(np.array([2 ** 53, 1], dtype=np.int64), long_name='a')
+        c2 = c1.copy(c1.points + np.array([1, 0]))
+        self.assertFalse(coord_fingerprint(c1).exact_match(
+            coord_fingerprint(c2)))
+
+    def test_strings(self):
+        c1 = AuxCoord(['one', 'two', 'three'], long_name='a')
+        c2 = c1.copy(c1.points.astype('U8'))
+        c3 = c1.copy(['one', 'two', 'four'])
+        print1 = coord_fingerprint(c1)
+        self.assertTrue(print1.exact_match(coord_fingerprint(c2)))
+        self.assertFalse(print1.exact_match(coord_fingerprint(c3)))
+        self.assertEqual(compare_coords(c1, c2), (True, ''))
+        self.assertEqual(compare_coords(c1, c3),
+                         (False, "Coords 'a' have significantly different "
+                                 "values."))
+
+    def test_memoised(self):
+        c1 = self.coord
+        self.assertIsNot(coord_fingerprint(c1), coord_fingerprint(c1))
+        with fingerprints_cached():
+            self.assertIs(coord_fingerprint(c1), coord_fingerprint(c1))
+
+
 class TestCubesMetadata(tests.IrisTest):
     def setUp(self):
         self.ref_cube_a = Cube([1, 2, 3], long_name='a')
@@ -325,6 +572,560 @@ class TestCubesDimsAndCoords(tests.IrisTest):
         c2.coord('x').attributes['extra'] = 1
         self._cubes_eq(c1, c2, err="Coords 'x' have different metadata")
 
+    def test_fail_boundedness_differs(self):
+        c1 = self.cube_a
+        c2 = c1.copy()
+        c2.coord('x').guess_bounds()
+        self._cubes_eq(c1, c2, err="Coords 'x' have different metadata")
+
+    def test_multidim_transpose_invert(self):
+        c1 = self.cube_a
+        co_2x3 = AuxCoord(np.arange(6).reshape(2, 3), long_name='twod')
+        c1.add_aux_coord(co_2x3, (0, 1))
+        c2 = c1[::-1, ::-1]
+        c2.transpose((1, 0))
+        msg = ['Cubes have different dimension orders',
+               'Coords \'twod\' have different points arrays']
+        self._cubes_eq(c1, c2, msg=msg)
+
+    def test_fail_multidim_interior_differs(self):
+        c1 = self.cube_a
+        c2 = c1.copy()
+        points = np.arange(6).reshape(2, 3)
+        c1.add_aux_coord(AuxCoord(points, long_name='twod'), (0, 1))
+        points = points.copy()
+        points[:, 1] = points[::-1, 1]
+        c2.add_aux_coord(AuxCoord(points, long_name='twod'), (0, 1))
+        err = ["Coords 'twod' have different values, even allowing for",
+               'points first differ at index (0, 1)']
+        self._cubes_eq(c1, c2, err=err)
+
+    def test_string_coord_mapping(self):
+        # A string coord can decide the direction of a dimension.
+        c1 = Cube(np.zeros((3, 2)), long_name='a')
+        c1.add_aux_coord(AuxCoord(['p', 'q', 'r'], long_name='label'), 0)
+        c1.add_dim_coord(self.y_coord, 1)
+        c1.add_aux_coord(AuxCoord([['a', 'b'], ['c', 'd'], ['e', 'f']],
+                                  long_name='names'), (0, 1))
+        c2 = c1[::-1]
+        c2.transpose((1, 0))
+        self.assertEqual(solve_dimension_mapping(c1, c2),
+                         ((1, 0), (True, False)))
+
+
+class TestCubesEqualWithoutData(tests.IrisTest):
+    def setUp(self):
+        self.cube = Cube(np.zeros((2, 2)), long_name='a')
+        self.cube.add_dim_coord(DimCoord([11, 12], long_name='x'), 1)
+        self.cube.add_dim_coord(DimCoord([21, 22], long_name='y'), 0)
+        self.twod_points = np.arange(4).reshape(2, 2)
+
+    def test_self_eq(self):
+        c1 = self.cube
+        c2 = c1.copy()
+        self.assertEqual(cubes_equal_without_data(c1, c2), (True, ''))
+
+    def test_fail_points_differ(self):
+        c1 = self.cube
+        c2 = c1.copy()
+        c2.coord('x').points = [11, 14]
+        result, msg = cubes_equal_without_data(c1, c2)
+        self.assertFalse(result)
+        self.assertEqual(
+            msg, "Coords ['x'] do not compare: 'x' has different points, "
+                 "first at index (1,).")
+
+    def test_fail_coord_dims_differ(self):
+        c1 = self.cube
+        c2 = c1.copy()
+        c1.add_aux_coord(AuxCoord(self.twod_points, long_name='twod'), (0, 1))
+        c2.add_aux_coord(AuxCoord(self.twod_points, long_name='twod'), (1, 0))
+        result, msg = cubes_equal_without_data(c1, c2)
+        self.assertFalse(result)
+        self.assertIn("'twod' has dimensions (0, 1) and (1, 0)", msg)
+
+    def test_compare_cubes_coord_dims_differ(self):
+        c1 = self.cube
+        c2 = c1.copy()
+        c1.add_aux_coord(AuxCoord(self.twod_points, long_name='twod'), (0, 1))
+        c2.add_aux_coord(AuxCoord(self.twod_points, long_name='twod'), (1, 0))
+        msg = "Coords ['twod'] do not compare: 'twod' has dimensions"
+        _check_compare_result(self, compare_cubes, c1, c2, msg=msg)
+
+
+
+class TestCubeSummary(tests.IrisTest):
+    def setUp(self):
+        self.cube = Cube([[1, 2, 3], [4, 5, 6]], long_name='a')
+        self.cube.add_dim_coord(DimCoord([11, 12, 13], long_name='x'), 1)
+        self.cube.add_dim_coord(DimCoord([21, 22], long_name='y'), 0)
+        self.cube.add_aux_coord(AuxCoord([1], long_name='z'))
+
+    def test_contents(self):
+        summary = cube_summary(self.cube)
+        self.assertEqual(summary.names, ['x', 'y', 'z'])
+        self.assertEqual(summary.coord_dims, {'x': (1,), 'y': (0,), 'z': ()})
+        self.assertEqual(summary.dim_coords, {0: frozenset(['y']),
+                                              1: frozenset(['x'])})
+
+    def test_memoised(self):
+        with summaries_cached():
+            summary = cube_summary(self.cube)
+            self.assertIs(cube_summary(self.cube), summary)
+        self.assertIsNot(cube_summary(self.cube), summary)
+
+    def test_compare_summaries(self):
+        # Comparing summaries needs no more coord lookups on the cubes.
+        c1 = self.cube
+        c2 = c1.copy()
+        c2.transpose((1, 0))
+        s1, s2 = cube_summary(c1), cube_summary(c2)
+        with mock.patch.object(Cube, 'coords', side_effect=AssertionError), \
+                mock.patch.object(Cube, 'coord', side_effect=AssertionError):
+            result, msg = compare_cubes(s1, s2)
+        self.assertTrue(result)
+        self.assertIn('Cubes have different dimension orders', msg)
+
+
+class TestCubesData(tests.IrisTest):
+    def setUp(self):
+        self.cube_a = Cube(np.arange(6.0).reshape((2, 3)), long_name='a')
+        self.cube_a.add_dim_coord(DimCoord([11, 12, 13], long_name='x'), 1)
+        self.cube_a.add_dim_coord(DimCoord([21, 22], long_name='y'), 0)
+
+    def _cubes_eq(self, c1, c2, msg='', err=''):
+        def compare_with_data(c1, c2):
+            return compare_cubes(c1, c2, check_data=True)
+        _check_compare_result(self, compare_with_data, c1, c2,
+                              msg=msg, err=err)
+
+    def test_self_eq(self):
+        c1 = self.cube_a
+        self._cubes_eq(c1, c1)
+
+    def test_transpose_invert(self):
+        c1 = self.cube_a
+        c2 = c1[:, ::-1]
+        c2.transpose((1, 0))
+        self._cubes_eq(c1, c2, msg='Cubes have different dimension orders')
+
+    def test_within_tolerance(self):
+        c1 = self.cube_a
+        c2 = c1.copy(c1.data + 1.0e-9)
+        self._cubes_eq(c1, c2)
+
+    def test_fail_values_differ(self):
+        c1 = self.cube_a
+        c2 = c1.copy()
+        c2.data[1, 2] += 1.0
+        self._cubes_eq(c1, c2, err="Cube 'a' data has different values, "
+                                   "first at index (1, 2)")
+
+    def test_fail_masks_differ(self):
+        c1 = self.cube_a
+        c2 = c1.copy(np.ma.masked_array(c1.data, mask=[[0, 1, 0], [0, 0, 0]]))
+        self._cubes_eq(c1, c2, err="Cube 'a' data has different masks")
+
+    def test_data_ignored_by_default(self):
+        c1 = self.cube_a
+        c2 = c1.copy(c1.data + 1.0)
+        _check_compare_result(self, compare_cubes, c1, c2)
+
+
+class TestCubelists(tests.IrisTest):
+    def setUp(self):
+        cube_a = Cube([[1, 2, 3], [4, 5, 6]], long_name='a')
+        cube_a.add_dim_coord(DimCoord([11, 12, 13], long_name='x'), 1)
+        cube_a.add_dim_coord(DimCoord([21, 22], long_name='y'), 0)
+        cube_b = cube_a.copy()
+        cube_b.rename('b')
+        cube_c = cube_a[0]
+        cube_c.rename('c')
+        self.cubes = [cube_a, cube_b, cube_c]
+
+    def _cubelists_eq(self, cl1, cl2, msg='', err=''):
+        _check_compare_result(self, compare_cubelists, cl1, cl2,
+                              msg=msg, err=err)
+
+    def test_self_eq(self):
+        cl1 = CubeList(self.cubes)
+        self._cubelists_eq(cl1, cl1)
+
+    def test_reordered(self):
+        cl1 = CubeList(self.cubes)
+        cl2 = CubeList(self.cubes[::-1])
+        self._cubelists_eq(cl1, cl2)
+
+    def test_soft_differences(self):
+        cl1 = CubeList(self.cubes)
+        cube_a, cube_b, cube_c = [cube.copy() for cube in self.cubes]
+        cube_b.transpose((1, 0))
+        cl2 = CubeList([cube_c, cube_a, cube_b])
+        self._cubelists_eq(cl1, cl2,
+                           msg='Cubes have different dimension orders')
+
+    def test_fail_lengths_differ(self):
+        cl1 = CubeList(self.cubes)
+        cl2 = CubeList(self.cubes[:-1])
+        self._cubelists_eq(cl1, cl2,
+                           err=['cubelists of different lengths : 3 != 2',
+                                "names : only in #1 = ['c'], "
+                                "only in #2 = []"])
+
+    def test_fail_names_differ(self):
+        cl1 = CubeList(self.cubes)
+        cube_a, cube_b, cube_c = [cube.copy() for cube in self.cubes]
+        cube_b.rename('d')
+        cl2 = CubeList([cube_a, cube_b, cube_c])
+        self._cubelists_eq(cl1, cl2,
+                           err=['cubelists have different cubes',
+                                "names : only in #1 = ['b'], "
+                                "only in #2 = ['d']"])
+
+    def test_mismatches(self):
+        cube_a, cube_b, cube_c = self.cubes
+        cl1 = CubeList([cube_a, cube_b, cube_c])
+        cl2 = CubeList([cube_a, cube_a, cube_c])
+        mismatches = cubelist_mismatches(cl1, cl2)
+        self.assertEqual([mismatch.kind for mismatch in mismatches],
+                         ['names', 'metadata'])
+        self.assertEqual(dict(mismatches[0].only_in_1), {'b': 1})
+        self.assertEqual(dict(mismatches[0].only_in_2), {'a': 1})
+        self.assertEqual(cubelist_mismatches(cl1, cl1[::-1]), [])
+
+    def test_fail_not_found(self):
+        cl1 = CubeList(self.cubes)
+        cube_a, cube_b, cube_c = [cube.copy() for cube in self.cubes]
+        cube_b.coord('x').attributes['extra'] = 1
+        cl2 = CubeList([cube_a, cube_b, cube_c])
+        self._cubelists_eq(cl1, cl2, err='not found')
+
+    def test_columnar(self):
+        cl1 = CubeList(self.cubes)
+        cube_a, cube_b, cube_c = [cube.copy() for cube in self.cubes]
+        cube_b.transpose((1, 0))
+        cl2 = CubeList([cube_c, cube_a, cube_b])
+        self.assertEqual(compare_cubelists(cl1, cl1, columnar=True),
+                         (True, ''))
+        self.assertEqual(compare_cubelists(cl1, cl2, columnar=True),
+                         compare_cubelists(cl1, cl2))
+        cube_b = cube_b.copy()
+        cube_b.coord('x').points = [11, 12, 14]
+        cl2 = CubeList([cube_c, cube_a, cube_b])
+        result, message = compare_cubelists(cl1, cl2, columnar=True)
+        self.assertFalse(result)
+        self.assertIn('not found', message)
+
+
+class TestCubelistTable(tests.IrisTest):
+    def setUp(self):
+        cube = Cube([[1, 2, 3], [4, 5, 6]], long_name='a')
+        cube.add_dim_coord(DimCoord([11, 12, 13], long_name='x'), 1)
+        cube.add_dim_coord(DimCoord([21, 22], long_name='y'), 0)
+        self.cube = cube
+
+    def test_candidate_pairs(self):
+        cube_a = self.cube
+        # Same coord ranges, so a candidate, even though not equal.
+        cube_b = cube_a.copy()
+        cube_b.coord('x').points = [11, 11.5, 13]
+        # Different coord range.
+        cube_c = cube_a.copy()
+        cube_c.coord('y').points = [21, 23]
+        # Different metadata.
+        cube_d = cube_a.copy()
+        cube_d.units = 'm'
+        table1 = CubelistTable([cube_a, cube_d])
+        table2 = CubelistTable([cube_c, cube_b, cube_d, cube_a])
+        i1, i2 = table1.candidate_pairs(table2)
+        self.assertEqual(sorted(zip(i1.tolist(), i2.tolist())),
+                         [(0, 1), (0, 3), (1, 2)])
+
+    def test_dtypes_ignored(self):
+        cube = self.cube.copy()
+        cube.coord('x').points = cube.coord('x').points.astype(np.float32)
+        i1, i2 = CubelistTable([self.cube]).candidate_pairs(
+            CubelistTable([cube]))
+        self.assertEqual(list(zip(i1, i2)), [(0, 0)])
+
+
+class TestStoredCubes(tests.IrisTest):
+    def setUp(self):
+        cube = Cube(np.arange(6.0).reshape((2, 3)), long_name='a',
+                    units='K')
+        cube.attributes['source'] = 'model'
+        cube.add_dim_coord(DimCoord([11, 12, 13], long_name='x',
+                                    coord_system=GeogCS(6371229.0)), 1)
+        cube.add_dim_coord(DimCoord([21, 22], long_name='y'), 0)
+        cube.coord('x').guess_bounds()
+        cube.add_aux_coord(AuxCoord(np.arange(6).reshape(2, 3),
+                                    long_name='twod'), (0, 1))
+        self.cube = cube
+
+    def _stored(self, cubes):
+        # Store some cubes, via JSON.
+        return [StoredCube.from_dict(json.loads(json.dumps(stored.to_dict())))
+                for stored in stored_cubes(cubes)]
+
+    def test_self_eq(self):
+        cubes = [self.cube, self.cube[0]]
+        stored = self._stored(cubes)
+        self.assertEqual(compare_cubelists(stored, cubes), (True, ''))
+        self.assertEqual(compare_cubelists(cubes[::-1], stored,
+                                           columnar=True),
+                         (True, ''))
+
+    def test_contents(self):
+        stored, = self._stored([self.cube])
+        self.assertEqual(stored.name(), 'a')
+        self.assertEqual(stored.shape, (2, 3))
+        self.assertEqual(stored.metadata, self.cube.metadata)
+        self.assertEqual([(coord.name(), stored.coord_dims(coord))
+                          for coord in stored.coords()],
+                         [('twod', (0, 1)), ('x', (1,)), ('y', (0,))])
+
+    def test_transpose_invert(self):
+        stored = self._stored([self.cube])
+        cube = self.cube[::-1, ::-1]
+        cube.transpose((1, 0))
+        result, msg = compare_cubelists(stored, [cube])
+        self.assertTrue(result)
+        self.assertIn('Cubes have different dimension orders', msg)
+
+    def test_data_not_compared(self):
+        stored = self._stored([self.cube])
+        self.assertEqual(compare_cubelists(stored, [self.cube],
+                                           check_data=True),
+                         (True, 'Cube data not compared'))
+
+    def test_string_coord(self):
+        self.cube.add_aux_coord(AuxCoord(['p', 'q'], long_name='label'), 0)
+        cube = self.cube.copy()
+        self.assertEqual(compare_cubes(self.cube, cube), (True, ''))
+        self.assertEqual(compare_cubelists([self.cube], [cube]), (True, ''))
+        stored = self._stored([self.cube])
+        self.assertEqual(compare_cubelists(stored, [cube]), (True, ''))
+        self.assertTrue(compare_cubelists(stored, [cube[::-1]])[0])
+
+    def test_ambiguous_orientation(self):
+        cube = Cube(np.zeros((3, 3)), long_name='a')
+        cube.add_dim_coord(DimCoord([1, 2, 3], long_name='y'), 0)
+        cube.add_dim_coord(DimCoord([4, 5, 6], long_name='x'), 1)
+        cube.add_aux_coord(AuxCoord([[1, 2, 3], [2, 0, 2], [3, 2, 1]],
+                                    long_name='twod'), (0, 1))
+        stored = self._stored([cube])
+        result, msg = compare_cubelists(stored, [cube[::-1]])
+        self.assertTrue(result)
+        self.assertIn("Coords 'twod' have different points arrays", msg)
+
+    def test_interior_differs(self):
+        # Only the hash of the interior values is stored, so any change in
+        # those, however large, is a soft difference.
+        stored = self._stored([self.cube])
+        cube = self.cube.copy()
+        cube.coord('twod').points = [[0, 1, 2], [3, 9, 5]]
+        self.assertEqual(compare_cubelists(stored, [cube]),
+                         (True, "Coords 'twod' values differ (hash only)."))
+
+    def test_values_rounded(self):
+        points = np.arange(6.0).reshape(2, 3)
+        self.cube.coord('twod').points = points
+        stored = self._stored([self.cube])
+        cube = self.cube.copy()
+        points = points.copy()
+        points[0, 0] = -0.0
+        points[1, 1] += 1.0e-12
+        cube.coord('twod').points = points
+        self.assertEqual(compare_cubelists(stored, [cube]),
+                         (True, "Coords 'twod' values differ (hash only)."))
+
+    def test_fail_corners_moved(self):
+        stored = self._stored([self.cube])
+        cube = self.cube.copy()
+        cube.coord('twod').points = [[2, 1, 0], [3, 4, 5]]
+        result, msg = compare_cubelists(stored, [cube])
+        self.assertFalse(result)
+        self.assertIn('not found', msg)
+
+    def test_fail_metadata_differs(self):
+        stored = self._stored([self.cube])
+        cube = self.cube.copy()
+        cube.attributes['source'] = 'other'
+        result, msg = compare_cubelists(stored, [cube])
+        self.assertFalse(result)
+
+
+class TestStoredCoordSystems(tests.IrisTest):
+    def _restored(self, coord_system):
+        # Store a coord system and restore it, via JSON.
+        return _decoded(json.loads(json.dumps(_encoded(coord_system))))
+
+    def test_sphere(self):
+        self.assertEqual(self._restored(GeogCS(6371229.0)),
+                         GeogCS(6371229.0))
+
+    def test_ellipsoids(self):
+        for ellipsoid in (GeogCS(6378137.0, inverse_flattening=298.257223563),
+                          GeogCS(6378137.0, 6356752.314245179)):
+            self.assertEqual(self._restored(ellipsoid), ellipsoid)
+
+    def test_rotated(self):
+        coord_system = RotatedGeogCS(37.5, 177.5,
+                                     ellipsoid=GeogCS(6371229.0))
+        self.assertEqual(self._restored(coord_system), coord_system)
+
+    def test_old_layout(self):
+        # Stored as the attributes of an iris version which keeps the
+        # ellipsoid parameters as public attributes.
+        stored = {'__coord_system__': 'GeogCS',
+                  'vars': {'__dict__': [['semi_major_axis', 6371229.0],
+                                        ['semi_minor_axis', 6371229.0],
+                                        ['inverse_flattening', 0.0],
+                                        ['longitude_of_prime_meridian',
+                                         0.0]]}}
+        coord_system = _decoded(json.loads(json.dumps(stored)))
+        self.assertEqual(coord_system, GeogCS(6371229.0))
+        self.assertEqual(repr(coord_system), repr(GeogCS(6371229.0)))
+
+    def test_unknown(self):
+        stored = {'__coord_system__': 'NoSuchCS', 'params': {'__dict__': []}}
+        self.assertNotEqual(_decoded(stored), GeogCS(6371229.0))
+
+
+class TestInstrumented(tests.IrisTest):
+    def setUp(self):
+        self.cube = Cube(np.arange(6.0).reshape((2, 3)), long_name='a')
+        self.cube.add_dim_coord(DimCoord([11, 12, 13], long_name='x'), 1)
+        self.cube.add_dim_coord(DimCoord([21, 22], long_name='y'), 0)
+
+    def test_stages(self):
+        with instrumented() as stats:
+            compare_cubes(self.cube, self.cube.copy(), check_data=True)
+        stages = stats.as_dict()
+        self.assertEqual(stages['compare_cubes']['calls'], 1)
+        self.assertEqual(stages['compare_data']['calls'], 1)
+        self.assertEqual(stages['compare_data']['bytes'], 2 * 6 * 8)
+        self.assertGreater(stages['fingerprint']['bytes'], 0)
+        self.assertGreaterEqual(stages['compare_cubes']['time'],
+                                stages['compare_data']['time'])
+
+    def test_nested(self):
+        with instrumented() as outer:
+            compare_cubes(self.cube, self.cube)
+            with instrumented() as inner:
+                compare_cubes(self.cube, self.cube)
+        self.assertEqual(outer.as_dict()['compare_cubes']['calls'], 2)
+        self.assertEqual(inner.as_dict()['compare_cubes']['calls'], 1)
+
+    def test_not_recorded_outside(self):
+        with instrumented() as stats:
+            pass
+        compare_cubes(self.cube, self.cube)
+        self.assertEqual(stats.as_dict(), {})
+
+
+@unittest.skipIf(da is None, 'Test requires dask.')
+class TestLazyGuard(tests.IrisTest):
+    # N.B. the cubes are large, so that realising any of them would show.
+    def _cube(self, shape=(50, 1000, 1000)):
+        cube = Cube(da.zeros(shape, dtype=np.float32,
+                             chunks=(10,) + shape[1:]),
+                    long_name='big')
+        for dim, n in enumerate(shape):
+            cube.add_dim_coord(DimCoord(np.arange(n, dtype=float),
+                                        long_name='dim{}'.format(dim)), dim)
+        points = da.arange(float(shape[1] * shape[2]),
+                           chunks=shape[1] * shape[2] // 4)
+        points = points.reshape(shape[1:])
+        bounds = da.stack([points - 0.5, points + 0.5], axis=-1)
+        cube.add_aux_coord(AuxCoord(points, bounds=bounds,
+                                    long_name='twod'), (1, 2))
+        return cube
+
+    def _assert_lazy(self, *cubes):
+        for cube in cubes:
+            self.assertTrue(cube.has_lazy_data())
+            self.assertTrue(cube.coord('twod').has_lazy_points())
+            self.assertTrue(cube.coord('twod').has_lazy_bounds())
+
+    def test_cubes_stay_lazy(self):
+        c1, c2 = self._cube(), self._cube()
+        c2 = c2[:, ::-1]
+        c2.transpose((0, 2, 1))
+        result, msg = compare_cubes(c1, c2, check_data=True, guard_lazy=True)
+        self.assertTrue(result)
+        self.assertIn('Cubes have different dimension orders', msg)
+        self._assert_lazy(c1, c2)
+
+    def test_cubelists_stay_lazy(self):
+        c1, c2 = self._cube(), self._cube()
+        for columnar in (False, True):
+            result, _ = compare_cubelists([c1, c2], [c2, c1],
+                                          check_data=True, columnar=columnar,
+                                          guard_lazy=True)
+            self.assertTrue(result)
+        self._assert_lazy(c1, c2)
+
+    def test_failure_stays_lazy(self):
+        c1, c2 = self._cube(), self._cube()
+        c2.coord('twod').points = c2.coord('twod').lazy_points() + 1.0
+        result, msg = compare_cubelists([c1], [c2], guard_lazy=True)
+        self.assertFalse(result)
+        self.assertIn('not found', msg)
+        self._assert_lazy(c1, c2)
+
+    def _guarded_failure(self, realising_compare, shape=(2, 3, 4)):
+        # Return the LazyRealisationError message of a guarded comparison,
+        # with 'realising_compare' in place of 'cubes_equal_without_data'.
+        c1, c2 = self._cube(shape), self._cube(shape)
+        with mock.patch('soft_iris_compares.cubes_equal_without_data',
+                        side_effect=realising_compare):
+            # Without the guard, this goes unnoticed.
+            self.assertEqual(compare_cubes(c1, self._cube(shape)),
+                             (True, ''))
+            with self.assertRaises(LazyRealisationError) as context:
+                compare_cubelists([c1], [c2], guard_lazy=True)
+        return str(context.exception)
+
+    def test_realisation_detected(self):
+        def realising_compare(c1, c2, coord_pairs=None):
+            c2.data
+            c2.coord('twod').points
+            return True, ''
+        self.assertEqual(self._guarded_failure(realising_compare),
+                         "Comparison realised lazy values : "
+                         "cube 'big' data, cube 'big' coord 'twod' points, "
+                         "2 computes not by block-wise fetches.")
+
+    def test_coord_equality_detected(self):
+        # Comparing lazy coords computes them, but keeps them lazy.
+        def realising_compare(c1, c2, coord_pairs=None):
+            c1.coord('twod') == c2.coord('twod')
+            return True, ''
+        # N.B. the points and bounds may be computed separately.
+        six.assertRegex(self, self._guarded_failure(realising_compare),
+                        r'^Comparison realised lazy values : '
+                        r'\d+ computes not by block-wise fetches\.$')
+
+    def test_full_fetch_detected(self):
+        def realising_compare(c1, c2, coord_pairs=None):
+            np.asarray(c1.core_data())
+            return True, ''
+        self.assertEqual(self._guarded_failure(realising_compare),
+                         "Comparison realised lazy values : "
+                         "1 computes not by block-wise fetches.")
+
+    def test_big_fetch_detected(self):
+        # A block-wise fetch, but with far bigger blocks.
+        def realising_compare(c1, c2, coord_pairs=None):
+            first_difference(c1.core_data(), c2.core_data(),
+                             block_size=10 ** 8)
+            return True, ''
+        self.assertEqual(self._guarded_failure(realising_compare,
+                                               shape=(4, 1000, 1000)),
+                         "Comparison realised lazy values : "
+                         "2 fetches of more than a block, of up to 4000000 "
+                         "values.")
 
 if __name__ == '__main__':
     import sys